@@ -1,12 +1,49 @@
 #!/usr/local/sbin/charm-env python3
 
+from datetime import datetime
+import os
 import re
+import shutil
 import subprocess
 import sys
 
-from etcdctl import EtcdCtl
-
-from charmhelpers.core.hookenv import action_get, action_set, action_fail, action_name
+from etcdctl import EtcdCtl, etcdctl_command
+from etcd_benchmark import (
+    BENCHMARK_TIMEOUT,
+    CHECK_PERF_TIMEOUT,
+    benchmark_tool,
+    check_perf_command,
+    parse_benchmark,
+    parse_check_perf,
+    range_command,
+    run_prefix,
+)
+from etcd_gateway import DEFAULT_ENDPOINT
+from etcd_backup import SNAPSHOT_UNIT_KEY, load_index
+from etcd_chunkstore import ChunkStore
+from etcd_maintenance import HISTORY_KEY, rolling_defrag
+from etcd_lib import human_size
+from etcd_profile import format_report, load_records, summarize
+from etcd_snapshot import (
+    CODECS,
+    DEFAULT_CODEC,
+    SnapshotError,
+    archive_name,
+    write_archive,
+)
+
+from charms import layer
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    action_get,
+    action_set,
+    action_fail,
+    action_name,
+    config,
+    is_leader,
+    leader_get,
+    local_unit,
+)
 
 
 CTL = EtcdCtl()
@@ -46,82 +83,323 @@ requires_etcd_v2 = requires_etcd_version(r"2\..*", human_version="2.x")
 requires_etcd_v3 = requires_etcd_version(r"3\..*", human_version="3.x")
 
 
+def alarm_results(alarms):
+    """Action results for a list of Alarm records: one line per alarm, and
+    the alarms of each member under alarms.<member id>."""
+    results = {
+        "output": "\n".join(
+            "memberID:{:x} alarm:{}".format(a.member_id, a.name) for a in alarms
+        ),
+        "count": len(alarms),
+    }
+    for alarm in alarms:
+        key = "alarms.{:x}".format(alarm.member_id)
+        results[key] = ",".join(filter(None, [results.get(key), alarm.name]))
+    return results
+
+
 @requires_etcd_v3
 def alarm_disarm():
-    """Call `etcdctl alarm disarm`."""
+    """Deactivate every alarm raised in the cluster, reporting which."""
     try:
-        output = CTL.run("alarm disarm")
-        action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+        alarms = CTL.alarm_list()
+        CTL.alarm_disarm()
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now("Failed to disarm the alarms: {}".format(e.output or e.stderr))
+    action_set(alarm_results(alarms))
 
 
 @requires_etcd_v3
 def alarm_list():
-    """Call `etcdctl alarm list`."""
+    """List the alarms raised in the cluster."""
     try:
-        output = CTL.run("alarm list")
-        action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+        alarms = CTL.alarm_list()
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now("Failed to list the alarms: {}".format(e.output or e.stderr))
+    action_set(alarm_results(alarms))
+
+
+# Keys the range workloads read, written under the benchmark prefix
+BENCHMARK_SEED_KEYS = 10
+BENCHMARK_VALUE = "x" * 1024
+
+
+@requires_etcd_v3
+def benchmark():
+    """Measure what the local member, or with cluster=true the whole
+    cluster, sustains: etcdctl check perf at the requested load and, when
+    etcd's benchmark tool is installed, linearizable and serializable range
+    workloads. Every key is written under a prefix unique to the run, which
+    is deleted afterwards."""
+    load = action_get("load")
+    endpoints = DEFAULT_ENDPOINT
+    if action_get("cluster"):
+        try:
+            members = CTL.member_list()
+        except EtcdCtl.CommandFailed as e:
+            action_fail_now("Failed to list the members: {}".format(e.output))
+        endpoints = ",".join(m.client_urls[0] for m in members if m.client_urls)
+    prefix = run_prefix()
+    results = {"prefix": prefix, "endpoints": endpoints}
+    try:
+        try:
+            command = check_perf_command(load, prefix)
+        except ValueError as e:
+            action_fail_now(str(e))
+        try:
+            output = CTL.run(command, endpoints, timeout=CHECK_PERF_TIMEOUT)
+        except EtcdCtl.CommandFailed as e:
+            # check perf exits non-zero when the cluster fails a check
+            output = e.output
+        check_perf = parse_check_perf(output or "")
+        if "throughput" not in check_perf:
+            action_fail_now("check perf did not complete: {}".format(output))
+        results.update(("check-perf." + k, v) for k, v in check_perf.items())
+
+        tool = benchmark_tool()
+        if tool:
+            opts = layer.options("tls-client")
+            tls = {
+                "cacert": opts["ca_certificate_path"],
+                "cert": opts["server_certificate_path"],
+                "key": opts["server_key_path"],
+            }
+            for i in range(BENCHMARK_SEED_KEYS):
+                CTL.run(["put", "{}{:04d}".format(prefix, i), BENCHMARK_VALUE])
+            for name, consistency in (
+                ("range-linearizable", "l"),
+                ("range-serializable", "s"),
+            ):
+                command = range_command(tool, endpoints, tls, load, prefix, consistency)
+                proc = subprocess.run(
+                    command, capture_output=True, text=True, timeout=BENCHMARK_TIMEOUT
+                )
+                if proc.returncode != 0:
+                    action_fail_now("benchmark {} failed: {}".format(name, proc.stderr))
+                stats = parse_benchmark(proc.stdout)
+                results.update(("{}.{}".format(name, k), v) for k, v in stats.items())
+        else:
+            results["benchmark"] = "not installed, only check perf was run"
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now("Benchmark failed: {}".format(e.output))
+    except subprocess.TimeoutExpired as e:
+        action_fail_now("Benchmark failed: {}".format(e))
+    finally:
+        try:
+            CTL.run(["del", "--prefix", prefix], endpoints)
+        except EtcdCtl.CommandFailed as e:
+            action_set({"cleanup": "failed to delete {}: {}".format(prefix, e.output)})
+    action_set(results)
 
 
 @requires_etcd_v3
 def compact():
     """Call `etcdctl compact`."""
-
-    def get_latest_revision():
+    revision = action_get("revision")
+    if not revision:
         try:
-            output = CTL.run("endpoint status --write-out json")
-        except subprocess.CalledProcessError as e:
-            action_fail_now(
-                "Failed to determine latest revision for " "compaction: {}".format(e)
-            )
-
-        m = re.search(r'"revision":(\d*)', output)
-        if not m:
+            revision = CTL.endpoint_status()[0].revision
+        except (EtcdCtl.CommandFailed, IndexError) as e:
             action_fail_now(
-                "Failed to get revision from 'endpoint status' "
-                "output: {}".format(output)
+                "Failed to determine latest revision for compaction: {}".format(e)
             )
-        return m.group(1)
-
-    revision = action_get("revision") or get_latest_revision()
-    physical = "true" if action_get("physical") else "false"
-    command = "compact {} --physical={}".format(revision, physical)
     try:
-        output = CTL.run(command)
+        output = CTL.compact(revision, physical=action_get("physical"))
         action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
+    except EtcdCtl.CommandFailed as e:
         action_fail_now(e.output)
 
 
+def compaction_history():
+    """Report the compactions the leader scheduled and how fast the key
+    history grows."""
+    history = unitdata.kv().get(HISTORY_KEY, [])
+    lines = []
+    for record in history:
+        growth = record["growth_per_hour"]
+        lines.append(
+            "{} revision {} (+{}) took {}s, db {} ({} in use), {} revisions/h".format(
+                datetime.fromtimestamp(record["time"]).strftime("%Y-%m-%d %H:%M:%S"),
+                record["revision"],
+                record["compacted"] or "?",
+                record["took"],
+                human_size(record["db_size"]),
+                human_size(record["db_size_in_use"]),
+                "?" if growth is None else "{:.0f}".format(growth),
+            )
+        )
+    if not history:
+        lines.append("No scheduled compactions on this unit")
+    action_set(dict(output="\n".join(lines), count=len(history)))
+
+
 @requires_etcd_v3
 def defrag():
-    """Call `etcdctl defrag`."""
+    """Call `etcdctl defrag` on this member or, with cluster=true, on every
+    fragmented member in turn."""
+    if not action_get("cluster"):
+        try:
+            output = CTL.defrag()
+            action_set(dict(output=output))
+        except EtcdCtl.CommandFailed as e:
+            action_fail_now(e.output)
+        return
+
+    if not is_leader():
+        action_fail_now("A cluster-wide defrag must run on the leader unit")
     try:
-        output = CTL.run("defrag")
-        action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+        results = rolling_defrag(CTL, action_get("threshold"))
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now("Rolling defrag stopped: {}".format(e.output))
+    lines = [
+        "{}: {} -> {}".format(name, human_size(before), human_size(after))
+        for name, before, after in results
+    ]
+    action_set(dict(output="\n".join(lines) or "No member needed a defrag"))
+
+
+def v2_data_dir():
+    """Return the data dir of an etcd 2 member."""
+    data_dir = "/var/snap/etcd/current/{}.etcd/".format(local_unit().replace("/", ""))
+    if not os.path.isdir(data_dir):
+        data_dir = "/var/snap/etcd/current/"
+    return data_dir
+
+
+def snapshot():
+    """Save a consistent snapshot of the cluster data and stream it into a
+    compressed archive, computing its size and checksum in the same pass.
+    With format=chunks the snapshot goes into a deduplicating chunk store
+    in target instead, writing only the chunks that changed."""
+    target = action_get("target")
+    keys_version = action_get("keys-version")
+    codec = action_get("compression") or DEFAULT_CODEC
+    chunked = action_get("format") == "chunks"
+    if keys_version not in ("v2", "v3"):
+        action_fail_now("keys-version must be either v2 or v3")
+    if codec not in CODECS:
+        action_fail_now(
+            "compression must be one of {}".format(", ".join(sorted(CODECS)))
+        )
+    if chunked and keys_version != "v3":
+        action_fail_now("format=chunks requires keys-version v3")
+
+    stamp = datetime.now().strftime("%Y-%m-%d-%H.%M.%S")
+    archive = os.path.join(target, archive_name("etcd-snapshot-" + stamp, codec))
+    workdir = os.path.join(target, os.environ["JUJU_ACTION_UUID"])
+    os.makedirs(workdir)
+    try:
+        if keys_version == "v3":
+            # snapshot save streams a consistent copy from the running member,
+            # unlike copying member/snap/db while etcd writes to it.
+            db = os.path.join(workdir, "db")
+            CTL.snapshot_save(db)
+            members = {"db": db}
+        else:
+            backup = os.path.join(workdir, "backup")
+            cmd = [etcdctl_command(), "backup", "--data-dir", v2_data_dir()]
+            cmd += ["--backup-dir", backup]
+            subprocess.check_call(cmd, env=dict(os.environ, ETCDCTL_API="2"))
+            members = {".": backup}
+        if chunked:
+            store = ChunkStore(target)
+            manifest = store.put(db, "etcd-snapshot-" + stamp)
+        else:
+            size, sha256 = write_archive(archive, members, codec)
+    except (EtcdCtl.CommandFailed, subprocess.CalledProcessError, SnapshotError) as e:
+        action_fail_now("Snapshot failed: {}".format(e))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if chunked:
+        path = store.manifest_path(manifest["name"])
+        action_set(
+            {
+                "snapshot.manifest": path,
+                "snapshot.size": human_size(manifest["size"]),
+                "snapshot.written": human_size(manifest["stored"]),
+                "snapshot.reused": human_size(manifest["reused"]),
+                "snapshot.chunks": len(manifest["chunks"]),
+                "snapshot.sha256": manifest["sha256"],
+                "snapshot.version": CTL.version(),
+                "copy.cmd": "juju scp -- -r {}:{} .".format(local_unit(), target),
+            }
+        )
+        return
+
+    action_set(
+        {
+            "snapshot.path": archive,
+            "snapshot.size": human_size(size),
+            "snapshot.sha256": sha256,
+            "snapshot.compression": codec,
+            "snapshot.version": CTL.version(),
+            "copy.cmd": "juju scp {}:{} .".format(local_unit(), archive),
+        }
+    )
+
+
+def list_snapshots():
+    """List the scheduled snapshots kept on this unit."""
+    entries = load_index(config("snapshot_target_dir"))
+    lines = []
+    for entry in entries:
+        started = datetime.fromtimestamp(entry["started"])
+        lines.append(
+            "{} {} {}s {} sha256:{}".format(
+                started.strftime("%Y-%m-%d %H:%M:%S"),
+                human_size(entry["size"]),
+                entry["duration"],
+                entry["path"],
+                entry["sha256"],
+            )
+        )
+    unit = leader_get(SNAPSHOT_UNIT_KEY)
+    if not entries:
+        lines.append("No scheduled snapshots on this unit")
+    if unit and unit != local_unit():
+        lines.append("Scheduled snapshots are currently taken on {}".format(unit))
+    action_set({"output": "\n".join(lines), "count": len(entries)})
+
+
+def profile_report():
+    """Summarise the hook and handler timings recorded on this unit."""
+    records = load_records()
+    hook = action_get("hook")
+    if hook:
+        records = [r for r in records if r["hook"] == hook]
+    summary = summarize(records)
+    output = format_report(summary)
+    if not summary:
+        output = "No profiling data on this unit"
+        if not config("profiling"):
+            output += ", set the profiling config option to record some"
+    action_set({"output": output, "hooks": len(summary)})
 
 
 def health():
-    """Call etcdctl cluster-health"""
-    try:
-        output = CTL.cluster_health(True)
-        action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+    """Report the health of every cluster member"""
+    health = CTL.cluster_health()
+    output = "\n".join(str(endpoint) for endpoint in health)
+    if all(endpoint.healthy for endpoint in health):
+        output += "\ncluster is healthy"
+    else:
+        output += "\ncluster is unhealthy"
+    action_set(dict(output=output))
 
 
 if __name__ == "__main__":
     ACTIONS = {
         "alarm-disarm": alarm_disarm,
         "alarm-list": alarm_list,
+        "benchmark": benchmark,
         "compact": compact,
+        "compaction-history": compaction_history,
         "defrag": defrag,
         "health": health,
+        "list-snapshots": list_snapshots,
+        "profile-report": profile_report,
+        "snapshot": snapshot,
     }
 
     action = action_name()
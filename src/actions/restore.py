@@ -12,12 +12,16 @@ from charmhelpers.core.hookenv import resource_get
 from charmhelpers.core.hookenv import is_leader
 from charmhelpers.core.hookenv import _run_atstart
 from charmhelpers.core.hookenv import _run_atexit
-from charmhelpers.core.host import chdir
 from charmhelpers.core.host import service_start
 from charmhelpers.core.host import service_stop
 from etcd_lib import get_ingress_address, build_uri
 from etcdctl import EtcdCtl
 from etcd_databag import EtcdDatabag
+from etcd_restore import ParallelRestore
+from etcd_retry import retry, RetryExhausted
+from etcd_chunkstore import open_manifest
+from etcd_snapshot import SnapshotError, extract_db, restore_db
+from etcd_snapshot import write_archive
 from shlex import split
 from subprocess import check_call
 from subprocess import check_output
@@ -29,7 +33,6 @@ from uuid import uuid4
 import hashlib
 import os
 import sys
-import time
 import yaml
 
 # Import charm layers and start reactive
@@ -51,6 +54,16 @@ CLUSTER_ADDRESS = get_ingress_address("cluster")
 SKIP_BACKUP = action_get("skip-backup")
 SNAPSHOT_ARCHIVE = resource_get("snapshot")
 TARGET_PATH = action_get("target")
+MODE = action_get("mode")
+MANIFEST = action_get("manifest")
+
+ETCD_CONFIG = "/var/snap/etcd/common/etcd.conf.yml"
+# Seconds to keep retrying membership calls while the cluster settles
+RETRY_DEADLINE = 30
+
+# The forked etcd uses the default client URL and may replay a large WAL
+FORKED_ENDPOINT = "http://localhost:2379"
+FORKED_TIMEOUT = 120
 
 
 def preflight_check():
@@ -58,7 +71,14 @@ def preflight_check():
     if not is_leader():
         action_fail("This action can only be run on the leader unit")
         sys.exit(0)
-    if not SNAPSHOT_ARCHIVE:
+    if MANIFEST:
+        if MODE == "parallel":
+            action_fail("Restoring from a manifest requires mode=rejoin")
+            sys.exit(0)
+        if not os.path.isfile(MANIFEST):
+            action_fail("Manifest {} not found".format(MANIFEST))
+            sys.exit(0)
+    elif not SNAPSHOT_ARCHIVE:
         action_fail("Missing snapshot. See: README.md")
         sys.exit(0)
 
@@ -68,90 +88,85 @@ def render_backup():
     if not os.path.isdir(ETCD_DATA_DIR) and SKIP_BACKUP:
         msg = "Backup set to True, but no data found to backup"
         action_set({"backup.error": msg})
-    if not os.path.isdir(ETCD_DATA_DIR):
+    if not os.path.isdir(ETCD_DATA_DIR) or SKIP_BACKUP:
         return
 
-    with chdir(ETCD_DATA_DIR):
-        if not SKIP_BACKUP:
-            log("Backing up existing data found in {}".format(ETCD_DATA_DIR))
-            archive_path = "{}/{}".format(TARGET_PATH, ARCHIVE)
-            cmd = "tar cvf {0} {1}".format(archive_path, ".")
-            check_call(split(cmd))
-            backup_sum = shasum_file(archive_path)
-            action_set({"backup.path": archive_path, "backup.sha256sum": backup_sum})
+    log("Backing up existing data found in {}".format(ETCD_DATA_DIR))
+    os.makedirs(TARGET_PATH, exist_ok=True)
+    backup_path = os.path.join(TARGET_PATH, ARCHIVE)
+    snapshot = os.path.join(TARGET_PATH, "etcd-data-{}.db".format(DATESTAMP))
+    try:
+        # A consistent online snapshot of the backend, without the WAL and
+        # snapshot files a copy of the data dir would drag along. It is
+        # archived as the db of a v3 snapshot, so it can be restored as is.
+        EtcdCtl().snapshot_save(snapshot)
+        _, backup_sum = write_archive(backup_path, {"db": snapshot})
+    except EtcdCtl.CommandFailed:
+        # etcd 2, or a member that is not running
+        log("snapshot save failed, archiving the data dir instead", "WARNING")
+        _, backup_sum = write_archive(backup_path, {".": ETCD_DATA_DIR})
+    finally:
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+    action_set({"backup.path": backup_path, "backup.sha256sum": backup_sum})
 
 
 def unpack_resource():
     """Grab the resource path, and unpack it into $PATH"""
-    cmd = "tar xvf {0} -C {1}".format(SNAPSHOT_ARCHIVE, ETCD_DATA_DIR)
+    cmd = "tar xf {0} -C {1}".format(SNAPSHOT_ARCHIVE, ETCD_DATA_DIR)
     check_call(split(cmd))
 
 
-def is_v3_backup():
-    """See if the backup file does not contain a wal file indicating a v3 backup"""
-    # ETCD v3 doesn't contain a wal file which leads to below command to fail
-    # With that we can differentiate between v3 and v2&v1
-    cmd = "tar -tvf {0} --wildcards '*/wal'".format(SNAPSHOT_ARCHIVE)
-    try:
-        check_call(split(cmd))
-    except CalledProcessError:
-        return True
-    return False
+def load_etcd_config():
+    with open(ETCD_CONFIG, "r") as configfile:
+        return yaml.safe_load(configfile)
 
 
-def restore_v3_backup():
-    """Apply a v3 backup"""
-    cmd = "mkdir -p /root/tmp/restore-v3"
-    check_call(split(cmd))
+def extract_resource(db):
+    """Stream the db out of the snapshot resource into db."""
+    return extract_db(SNAPSHOT_ARCHIVE, db)
 
-    cmd = "tar xvf {0} -C /root/tmp/restore-v3".format(SNAPSHOT_ARCHIVE)
-    check_call(split(cmd))
 
-    configfile = open("/var/snap/etcd/common/etcd.conf.yml", "r")
-    config = yaml.safe_load(configfile)
-    # Use the insecure 4001 port we have open in our deployment
-    environ = dict(os.environ, ETCDCTL_API="3")
-    cmd = (
-        "/snap/bin/etcdctl --endpoints=https://127.0.0.1:2379 snapshot "
-        "restore /root/tmp/restore-v3/db --skip-hash-check "
-        "--data-dir='/root/tmp/restore-v3/etcd' "
-        "--initial-cluster='{}' --initial-cluster-token='{}' "
-        "--initial-advertise-peer-urls='{}' --name='{}'"
-    )
+def extract_manifest(db):
+    """Reassemble the chunked backup named by the manifest param into db,
+    verifying it against the manifest."""
+    store, name = open_manifest(MANIFEST)
+    store.assemble(name, db)
+    return True
+
+
+def restore_v3_backup():
+    """Apply a v3 backup, from the manifest param if given or else from the
+    snapshot resource. Returns False if the archive holds no v3 db."""
+    config = load_etcd_config()
 
     if "initial-cluster" in config and config["initial-cluster"]:
         # configuration contains initilization params
-        cmd = cmd.format(
-            config["initial-cluster"],
-            config["initial-cluster-token"],
-            config["initial-advertise-peer-urls"],
-            config["name"],
-        )
+        initial_cluster = config["initial-cluster"]
+        initial_cluster_token = config["initial-cluster-token"]
+        initial_urls = config["initial-advertise-peer-urls"]
     else:
         # configuration does not contain initilization params
         # probably coming from an etcd upgrades from etcd2
-        initial_cluster = (
-            f"{config['name']}={build_uri('https', CLUSTER_ADDRESS, 2380)}"
+        initial_cluster = "{}={}".format(
+            config["name"], build_uri("https", CLUSTER_ADDRESS, 2380)
         )
         initial_cluster_token = CLUSTER_ADDRESS
         initial_urls = build_uri("https", CLUSTER_ADDRESS, 2380)
-        cmd = cmd.format(
-            initial_cluster, initial_cluster_token, initial_urls, config["name"]
-        )
-
-    configfile.close()
-    check_call(split(cmd), env=environ)
-
-    # Make sure we do not have anything left from any old deployments
-    cmd = "rm -rf {}/member".format(config["data-dir"])
-    check_call(split(cmd))
-
-    cmd = "cp -r /root/tmp/restore-v3/etcd/member {}".format(config["data-dir"])
-    check_call(split(cmd))
 
-    # Clean up
-    cmd = "rm -rf /root/tmp/restore-v3"
-    check_call(split(cmd))
+    verified = restore_db(
+        extract_manifest if MANIFEST else extract_resource,
+        config["data-dir"],
+        config["name"],
+        initial_cluster,
+        initial_cluster_token,
+        initial_urls,
+    )
+    if verified is None:
+        return False
+    if not verified:
+        log("Snapshot carries no integrity hash, restored it unchecked", "WARNING")
+    return True
 
 
 def start_etcd_forked():
@@ -175,51 +190,27 @@ def pkill_etcd(pid=""):
 
 def probe_forked_etcd():
     """Block until the forked etcd instance has started and return"""
-    output = b""
-    loop = 0
-    MAX_WAIT = 10
-
-    while b"http://localhost" not in output:
-        try:
-            output = check_output(split("/snap/bin/etcd.etcdctl member list"))
-            loop = loop + 1
-        except Exception:
-            log("Still waiting on forked etcd instance...")
-            output = b""
-            loop = loop + 1
-        time.sleep(1)
-        if loop > MAX_WAIT:
-            raise TimeoutError("Timed out waiting for forked etcd.")
+    try:
+        EtcdCtl().wait_until_ready(FORKED_ENDPOINT, FORKED_TIMEOUT)
+    except EtcdCtl.CommandFailed as e:
+        raise TimeoutError("Timed out waiting for forked etcd.") from e
 
 
 def reconfigure_client_advertise():
     """Reconfigure the backup to use host network addresses for client advertise
     instead of the assumed localhost addressing"""
 
-    loop = 0
-    MAX_WAIT = 10
-
-    while loop < MAX_WAIT:
-        try:
-            cmd = "/snap/bin/etcd.etcdctl member list"
-            members = check_output(split(cmd), env={"ETCDCTL_API": "2"})
-            member_id = members.split(b":")[0].decode("utf-8")
-            break
-        except CalledProcessError as ex:
-            loop = loop + 1
-            log(
-                "{}/{} member list failed during reconfiguring client advertise, retrying...".format(
-                    loop, MAX_WAIT
-                ),
-                "WARNING",
-            )
-            if loop == MAX_WAIT:
-                log(
-                    "All member list tries failed during reconfiguring client advertise! Raising...",
-                    "ERROR",
-                )
-                raise Exception("All member list tries failed") from ex
-            time.sleep(1)
+    cmd = "/snap/bin/etcd.etcdctl member list"
+    try:
+        members = retry(
+            lambda: check_output(split(cmd), env={"ETCDCTL_API": "2"}),
+            deadline=RETRY_DEADLINE,
+            retry_on=CalledProcessError,
+            describe="member list during reconfiguring client advertise",
+        )
+    except RetryExhausted as ex:
+        raise Exception("All member list tries failed") from ex
+    member_id = members.split(b":")[0].decode("utf-8")
 
     raw_update = "/snap/bin/etcd.etcdctl member update {0} {1}"
     update_cmd = raw_update.format(
@@ -252,35 +243,55 @@ def dismantle_cluster():
 
     my_name = etcd_conf.unit_name
     endpoint = build_uri("https", etcd_conf.cluster_address, etcd_conf.port)
-    for name, data in etcdctl.member_list(endpoint).items():
-        if name != my_name:
+    for member in etcdctl.member_list(endpoint):
+        name = member.name or member.unit_id
+        if member.name != my_name:
             log("Disconnecting {}".format(name), hookenv.DEBUG)
-            loop = 0
-            MAX_WAIT = 10
-
-            while loop < MAX_WAIT:
-                try:
-                    etcdctl.unregister(data["unit_id"], endpoint)
-                    break
-                except EtcdCtl.CommandFailed as ex:
-                    # Back-off timer to let cluster settle
-                    loop = loop + 1
-                    log("Disconnecting {} failed, retrying...".format(name), "WARNING")
-                    if loop == MAX_WAIT:
-                        log(
-                            "All tries for disconnecting the member {} failed! Raising...".format(
-                                name
-                            ),
-                            "ERROR",
-                        )
-                        raise Exception(
-                            "Disconnecting a member from cluster failed"
-                        ) from ex
-                    time.sleep(1)
+            # Back off to let the cluster settle between attempts
+            try:
+                retry(
+                    lambda: etcdctl.unregister(member.unit_id, endpoint),
+                    deadline=RETRY_DEADLINE,
+                    retry_on=EtcdCtl.CommandFailed,
+                    describe="Disconnecting {}".format(name),
+                )
+            except (RetryExhausted, EtcdCtl.CommandFailed) as ex:
+                raise Exception("Disconnecting a member from cluster failed") from ex
 
     etcd_conf.cluster_state = "new"
     conf_path = os.path.join(etcd_conf.etcd_conf_dir, "etcd.conf.yml")
-    render("etcd3.conf", conf_path, etcd_conf.__dict__, owner="root", group="root")
+    render("etcd3.conf", conf_path, etcd_conf.context(), owner="root", group="root")
+
+
+def parallel_restore():
+    """Restore the snapshot on every member at the same time, as etcd
+    upstream recommends, instead of restoring the leader alone and having
+    every follower wipe its data and rejoin in turn.
+
+    The request is published with the current members as the initial
+    cluster, a fresh token and the checksum of the snapshot before anything
+    is touched. Every member then stops etcd and acknowledges it, and only
+    once all of them have does the leader restore itself and have the others
+    restore with the same settings. See etcd_restore for the phases."""
+    etcdctl = EtcdCtl()
+    members = [m for m in etcdctl.member_list() if m.started and m.peer_urls]
+    config = load_etcd_config()
+    if config["name"] not in [m.name for m in members]:
+        action_fail("This unit is not a started member of the cluster")
+        sys.exit(0)
+    initial_cluster = ",".join("{}={}".format(m.name, m.peer_urls[0]) for m in members)
+
+    log("Requesting every member to stop for the restore")
+    restore = ParallelRestore.start(initial_cluster, shasum_file(SNAPSHOT_ARCHIVE))
+    service_stop(opts["etcd_daemon_process"])
+    action_set(
+        {
+            "restore.id": restore.id,
+            "restore.members": len(members),
+            "restore.status": "Restoring once every member has stopped, "
+            "see juju status",
+        }
+    )
 
 
 def rebuild_cluster():
@@ -294,11 +305,19 @@ if __name__ == "__main__":
     log("Performing etcd snapshot restore")
     preflight_check()
     render_backup()
+    if MODE == "parallel":
+        parallel_restore()
+        _run_atexit()
+        sys.exit(0)
     dismantle_cluster()
     service_stop(opts["etcd_daemon_process"])
-    if is_v3_backup():
-        log("v3 backup detected, restoring...", "INFO")
-        restore_v3_backup()
+    try:
+        restored = restore_v3_backup()
+    except SnapshotError as e:
+        action_fail("Restore failed: {}".format(e))
+        sys.exit(0)
+    if restored:
+        log("v3 backup restored", "INFO")
     else:
         log("v2 backup detected, restoring...", "INFO")
         unpack_resource()
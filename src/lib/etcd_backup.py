@@ -0,0 +1,247 @@
+from datetime import datetime
+from subprocess import DEVNULL, CalledProcessError, check_call
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from etcd_chunkstore import ChunkStore
+from etcd_snapshot import DEFAULT_CODEC, SnapshotError, archive_name, write_archive
+
+# Scheduled snapshots are taken by a systemd timer the charm installs on a
+# single unit, chosen by the leader and published under SNAPSHOT_UNIT_KEY in
+# leader data, so only one member pays for a snapshot at a time. The timer
+# runs this module as a script outside of any hook, which is why it must not
+# import charmhelpers: everything it needs is in the SETTINGS file the charm
+# writes next to the units.
+SNAPSHOT_UNIT_KEY = "snapshot_unit"
+SETTINGS = "/var/snap/etcd/common/snapshot-schedule.json"
+TIMER = "etcd-snapshot"
+PREFIX = "etcd-snapshot-"
+INDEX = "index.json"
+
+# (name, lowest, highest) of each field of a cron expression
+CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day of month", 1, 31),
+    ("month", 1, 12),
+    ("day of week", 0, 7),
+)
+CRON_MACROS = {
+    "@hourly": "hourly",
+    "@daily": "daily",
+    "@midnight": "daily",
+    "@weekly": "weekly",
+    "@monthly": "monthly",
+    "@yearly": "yearly",
+    "@annually": "yearly",
+}
+WEEKDAYS = ("Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+
+def _cron_values(field, name, low, high):
+    """Expand one cron field into the sorted values it matches, or None
+    for a bare *."""
+    if field == "*":
+        return None
+    values = set()
+    for part in field.split(","):
+        rng, slash, step = part.partition("/")
+        try:
+            step = int(step) if step else 1
+            if rng == "*":
+                start, end = low, high
+            elif "-" in rng:
+                start, end = (int(v) for v in rng.split("-", 1))
+            else:
+                start = int(rng)
+                # "5/10" means every 10th value from 5 onwards
+                end = high if slash else start
+        except ValueError:
+            raise ValueError("Invalid {} field {!r}".format(name, field))
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(
+                "{} field {!r} is outside {}-{}".format(name, field, low, high)
+            )
+        values.update(range(start, end + 1, step))
+    return sorted(values)
+
+
+def cron_to_oncalendar(expr):
+    """Convert a cron expression ("minute hour day-of-month month
+    day-of-week", or a macro like @daily) to a systemd OnCalendar spec.
+
+    Raises ValueError if the expression is not valid. When both the day of
+    month and the day of week are restricted, systemd requires both to
+    match where cron accepts either.
+    """
+    expr = expr.strip()
+    if expr in CRON_MACROS:
+        return CRON_MACROS[expr]
+    fields = expr.split()
+    if len(fields) != len(CRON_FIELDS):
+        raise ValueError(
+            "Expected 5 fields (minute hour day-of-month month day-of-week) "
+            "in {!r}".format(expr)
+        )
+    minute, hour, dom, month, dow = (
+        _cron_values(field, *spec) for field, spec in zip(fields, CRON_FIELDS)
+    )
+
+    def fmt(values):
+        if values is None:
+            return "*"
+        return ",".join("{:02d}".format(v) for v in values)
+
+    spec = "*-{}-{} {}:{}:00".format(fmt(month), fmt(dom), fmt(hour), fmt(minute))
+    if dow is not None:
+        days = []
+        for day in dow:
+            if WEEKDAYS[day] not in days:
+                days.append(WEEKDAYS[day])
+        spec = "{} {}".format(",".join(days), spec)
+    return spec
+
+
+def designate(units, current=None, raft_leader=None):
+    """Pick the unit that takes scheduled snapshots out of units.
+
+    The current choice is kept while it is still a member and not the raft
+    leader, so the timer does not move around needlessly. Otherwise the
+    first unit that is not the raft leader is picked, falling back to the
+    leader when it is the only member.
+    """
+    if current in units and current != raft_leader:
+        return current
+    followers = [u for u in sorted(units) if u != raft_leader]
+    if followers:
+        return followers[0]
+    return raft_leader if raft_leader in units else None
+
+
+def load_index(target):
+    """Return the snapshots recorded in target's index, oldest first."""
+    try:
+        with open(os.path.join(target, INDEX)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return []
+
+
+def save_index(target, entries):
+    """Atomically replace target's index with entries."""
+    path = os.path.join(target, INDEX)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(entries, fp, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def expired(entries, count=0, days=0, now=None):
+    """Return the entries that fall outside the retention policy: beyond the
+    newest count snapshots, or older than days. A limit of 0 disables it.
+    The newest snapshot is always kept, so a failing timer never prunes
+    the last good copy."""
+    now = time.time() if now is None else now
+    newest_first = sorted(entries, key=lambda e: e["started"], reverse=True)
+    drop = []
+    for i, entry in enumerate(newest_first[1:], start=1):
+        if (count and i >= count) or (days and now - entry["started"] > days * 86400):
+            drop.append(entry)
+    return drop
+
+
+def prune(target, entries, count=0, days=0):
+    """Delete expired snapshots and forget ones that were removed by hand.
+    Returns the entries that remain."""
+    drop = expired(entries, count, days)
+    for entry in drop:
+        try:
+            os.remove(entry["path"])
+        except FileNotFoundError:
+            pass
+    if any(entry.get("format") == "chunks" for entry in drop):
+        # Removing the manifest above released its chunks
+        ChunkStore(target).gc()
+    return [e for e in entries if e not in drop and os.path.exists(e["path"])]
+
+
+def take_snapshot(settings):
+    """Save a snapshot of the local member into the target directory,
+    returning its index entry."""
+    target = settings["target"]
+    codec = settings.get("compression", DEFAULT_CODEC)
+    started = time.time()
+    stamp = datetime.fromtimestamp(started).strftime("%Y-%m-%d-%H.%M.%S")
+    archive = os.path.join(target, archive_name(PREFIX + stamp, codec))
+    env = dict(
+        os.environ,
+        ETCDCTL_API="3",
+        ETCDCTL_CACERT=settings["cacert"],
+        ETCDCTL_CERT=settings["cert"],
+        ETCDCTL_KEY=settings["key"],
+    )
+    fmt = settings.get("format", "archive")
+    workdir = tempfile.mkdtemp(prefix=".snapshot-", dir=target)
+    try:
+        db = os.path.join(workdir, "db")
+        cmd = [settings["etcdctl"], "--endpoints", settings["endpoint"]]
+        check_call(cmd + ["snapshot", "save", db], env=env, stdout=DEVNULL)
+        if fmt == "chunks":
+            # size is what had to be written, sha256 that of the db
+            store = ChunkStore(target)
+            manifest = store.put(db, PREFIX + stamp)
+            archive = store.manifest_path(manifest["name"])
+            size, sha256 = manifest["stored"], manifest["sha256"]
+        else:
+            size, sha256 = write_archive(archive, {"db": db}, codec)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "path": archive,
+        "started": started,
+        "duration": round(time.time() - started, 3),
+        "size": size,
+        "sha256": sha256,
+        "format": fmt,
+        "compression": codec,
+        "unit": settings.get("unit", ""),
+    }
+
+
+def run(settings):
+    """Take a scheduled snapshot, record it in the index and apply the
+    retention policy. Overlapping runs wait for each other."""
+    target = settings["target"]
+    os.makedirs(target, mode=0o700, exist_ok=True)
+    with open(os.path.join(target, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entry = take_snapshot(settings)
+        entries = load_index(target) + [entry]
+        entries = prune(
+            target,
+            entries,
+            settings.get("retention_count", 0),
+            settings.get("retention_days", 0),
+        )
+        save_index(target, entries)
+    return entry
+
+
+def main(path=SETTINGS):
+    with open(path) as fp:
+        settings = json.load(fp)
+    try:
+        entry = run(settings)
+    except (CalledProcessError, SnapshotError, OSError) as e:
+        print("Scheduled snapshot failed: {}".format(e), file=sys.stderr)
+        return 1
+    print("Saved {path} ({size} bytes, sha256 {sha256}) in {duration}s".format(**entry))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,110 @@
+import re
+import shutil
+import uuid
+
+# Benchmarks write under a prefix of their own, unique to each run, which is
+# deleted afterwards whether or not the run succeeded.
+PREFIX = "/charm-benchmark/"
+
+# etcdctl check perf runs for a minute at every load level
+CHECK_PERF_TIMEOUT = 120
+BENCHMARK_TIMEOUT = 300
+LOADS = ("s", "m", "l", "xl")
+
+# (connections, clients, requests) of the benchmark tool for each load
+# level, scaled like the load levels of check perf.
+BENCHMARK_LOADS = {
+    "s": (1, 50, 10000),
+    "m": (10, 200, 50000),
+    "l": (50, 500, 200000),
+    "xl": (100, 1000, 500000),
+}
+
+_CHECK_PERF = {
+    # Each line reads differently whether the check passed or failed
+    "throughput": re.compile(r"Throughput (?:is|too low:) (\d+) writes/s"),
+    "slowest": re.compile(r"Slowest request took (?:too long: )?([\d.]+)s"),
+    "stddev": re.compile(r"Stddev (?:is|too high:) ([\d.]+)s"),
+}
+_SUMMARY = re.compile(
+    r"^\s*(Total|Slowest|Fastest|Average|Stddev|Requests/sec):\s*([\d.]+)"
+)
+_PERCENTILE = re.compile(r"^\s*([\d.]+)% in ([\d.]+) secs")
+
+
+def run_prefix():
+    """A prefix no other run, nor any client, writes to."""
+    return "{}{}/".format(PREFIX, uuid.uuid4().hex)
+
+
+def prefix_end(prefix):
+    """The end of the range holding every key under prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def check_perf_command(load, prefix):
+    """Arguments of etcdctl check perf at a load level, writing only under
+    prefix. It is not allowed to compact or defrag, which would affect every
+    client of the cluster."""
+    if load not in LOADS:
+        raise ValueError(
+            "Unknown load {}, expected one of {}".format(load, ", ".join(LOADS))
+        )
+    return ["check", "perf", "--load={}".format(load), "--prefix={}".format(prefix)]
+
+
+def parse_check_perf(output):
+    """Extract the results of etcdctl check perf. Its exit status fails the
+    run when any check fails, so the output is parsed either way."""
+    result = {"result": "FAIL"}
+    for key, pattern in _CHECK_PERF.items():
+        match = pattern.search(output)
+        if match:
+            result[key] = float(match.group(1))
+    lines = [line.strip() for line in output.strip().splitlines()]
+    if lines and lines[-1] == "PASS":
+        result["result"] = "PASS"
+    return result
+
+
+def benchmark_tool():
+    """Path of etcd's benchmark tool, which the etcd snap does not ship, or
+    None."""
+    return shutil.which("benchmark")
+
+
+def range_command(tool, endpoints, tls, load, prefix, consistency="l"):
+    """Command of a benchmark range workload reading the keys under prefix.
+    consistency is "l" for linearizable or "s" for serializable reads."""
+    conns, clients, total = BENCHMARK_LOADS[load]
+    return [
+        tool,
+        "--endpoints={}".format(endpoints),
+        "--cacert={}".format(tls["cacert"]),
+        "--cert={}".format(tls["cert"]),
+        "--key={}".format(tls["key"]),
+        "--conns={}".format(conns),
+        "--clients={}".format(clients),
+        "range",
+        prefix,
+        prefix_end(prefix),
+        "--total={}".format(total),
+        "--consistency={}".format(consistency),
+    ]
+
+
+def parse_benchmark(output):
+    """Extract the summary and latency percentiles of a benchmark tool run,
+    keyed for action_set, e.g. requests-per-sec and p99."""
+    result = {}
+    for line in output.splitlines():
+        match = _SUMMARY.match(line)
+        if match:
+            key = match.group(1).lower().replace("/", "-per-")
+            result[key] = float(match.group(2))
+            continue
+        match = _PERCENTILE.match(line)
+        if match:
+            key = "p" + match.group(1).replace(".", "")
+            result[key] = float(match.group(2))
+    return result
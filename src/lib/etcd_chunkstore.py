@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from etcd_snapshot import SnapshotError
+
+# A deduplicating store for snapshot dbs. Each backup is split into chunks
+# that are stored once, zlib compressed, under the sha256 of their content,
+# plus a manifest listing the chunks in order:
+#
+#     <root>/chunks/ab/ab12...ef      zlib(chunk)
+#     <root>/manifests/<name>.json    {"sha256": ..., "chunks": [...], ...}
+#
+# bbolt is copy-on-write: a transaction writes the pages it changes, and
+# their parents up to the root, to free pages, reusing the ones earlier
+# transactions released, and only grows the file when it runs out. No page
+# ever moves to another offset, and snapshot save copies the file in page
+# order, so fixed-size chunks that are a multiple of the page size line up
+# from one backup to the next and only chunks holding a rewritten page are
+# stored again. Content-defined chunking would find nothing more: every page
+# header carries the page's own id, so a page copied elsewhere differs
+# anyway. Because freed pages are scattered, how much is reused depends on
+# the write load, and a defrag rewrites everything; each manifest records
+# the bytes it found already stored as "reused" so this can be checked.
+CHUNK_SIZE = 64 * 1024
+MANIFEST_VERSION = 1
+COMPRESS_LEVEL = 1
+
+
+def open_manifest(path):
+    """Return the ChunkStore holding the manifest at path, and the name of
+    the manifest in it."""
+    path = os.path.abspath(path)
+    name = os.path.basename(path)
+    if not name.endswith(".json"):
+        raise SnapshotError("{} is not a backup manifest".format(path))
+    return ChunkStore(os.path.dirname(os.path.dirname(path))), name[: -len(".json")]
+
+
+class ChunkStore:
+    """Backups stored as deduplicated chunks under root."""
+
+    def __init__(self, root):
+        self.root = root
+        self.chunk_dir = os.path.join(root, "chunks")
+        self.manifest_dir = os.path.join(root, "manifests")
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, name + ".json")
+
+    @contextmanager
+    def locked(self):
+        """Serialise writers, so gc never removes a chunk a concurrent put
+        found already stored."""
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        with open(os.path.join(self.root, "chunks.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(data)
+        os.replace(path + ".tmp", path)
+
+    def put(self, source, name):
+        """Store the file at source as the backup called name, writing only
+        the chunks the store does not hold yet. Returns the manifest, which
+        also records how many bytes had to be written, and how many were
+        found in the store already."""
+        digest = hashlib.sha256()
+        chunks = []
+        stored = reused = 0
+        size = 0
+        with self.locked(), open(source, "rb") as fp:
+            for data in iter(lambda: fp.read(CHUNK_SIZE), b""):
+                digest.update(data)
+                size += len(data)
+                chunk = hashlib.sha256(data).hexdigest()
+                chunks.append(chunk)
+                path = self.chunk_path(chunk)
+                if os.path.exists(path):
+                    reused += len(data)
+                else:
+                    packed = zlib.compress(data, COMPRESS_LEVEL)
+                    self._write(path, packed)
+                    stored += len(packed)
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "name": name,
+                "created": time.time(),
+                "size": size,
+                "sha256": digest.hexdigest(),
+                "chunk_size": CHUNK_SIZE,
+                "chunks": chunks,
+                "stored": stored,
+                "reused": reused,
+            }
+            self._write(self.manifest_path(name), json.dumps(manifest).encode())
+        return manifest
+
+    def load(self, name):
+        try:
+            with open(self.manifest_path(name)) as fp:
+                manifest = json.load(fp)
+        except FileNotFoundError:
+            raise SnapshotError("No backup called {} in {}".format(name, self.root))
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise SnapshotError(
+                "Unsupported manifest version {}".format(manifest.get("version"))
+            )
+        return manifest
+
+    def names(self):
+        """Return the names of the stored backups."""
+        try:
+            files = os.listdir(self.manifest_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(f[: -len(".json")] for f in files if f.endswith(".json"))
+
+    def assemble(self, name, dest):
+        """Reassemble the backup called name into dest, verifying every
+        chunk and the whole file against the manifest. Returns the
+        manifest."""
+        manifest = self.load(name)
+        digest = hashlib.sha256()
+        with open(dest, "wb") as out:
+            for chunk in manifest["chunks"]:
+                try:
+                    with open(self.chunk_path(chunk), "rb") as fp:
+                        data = zlib.decompress(fp.read())
+                except (OSError, zlib.error) as e:
+                    raise SnapshotError("Chunk {} is unreadable: {}".format(chunk, e))
+                if hashlib.sha256(data).hexdigest() != chunk:
+                    raise SnapshotError("Chunk {} is corrupt".format(chunk))
+                digest.update(data)
+                out.write(data)
+        if digest.hexdigest() != manifest["sha256"]:
+            raise SnapshotError("{} does not match its manifest".format(name))
+        return manifest
+
+    def remove(self, name):
+        """Forget the backup called name. Its chunks are freed by gc."""
+        try:
+            os.remove(self.manifest_path(name))
+        except FileNotFoundError:
+            pass
+
+    def gc(self):
+        """Delete the chunks no manifest refers to. Returns the number of
+        chunks and bytes freed."""
+        freed = size = 0
+        with self.locked():
+            referenced = set()
+            for name in self.names():
+                referenced.update(self.load(name)["chunks"])
+            for dirpath, _, files in os.walk(self.chunk_dir):
+                for chunk in files:
+                    if chunk not in referenced:
+                        path = os.path.join(dirpath, chunk)
+                        size += os.path.getsize(path)
+                        os.remove(path)
+                        freed += 1
+        return freed, size
@@ -0,0 +1,153 @@
+from etcd_gateway import EtcdGateway, GatewayError
+from etcd_metrics import scrape, summarize
+from etcd_records import Alarm
+from etcd_retry import BREAKER, reset_budget
+
+from collections import deque
+from subprocess import PIPE, CalledProcessError, TimeoutExpired, check_output
+import json
+import os
+import sys
+import time
+
+# A small resident agent that polls the local member through the native
+# gateway client and caches what it finds as JSON, one file per collector,
+# for the NRPE plugins to read. Every round reuses the same keep-alive TLS
+# connection, instead of forking etcdctl and doing a full handshake for
+# every check. Like etcd_backup, it runs outside of hooks from the settings
+# file the charm writes.
+SETTINGS = "/var/snap/etcd/common/collector.json"
+SERVICE = "etcd-collector"
+CACHE_DIR = "/var/lib/nagios"
+# Seconds between collection rounds
+INTERVAL = 60
+# Seconds of /metrics history the performance checks summarise. Long enough
+# that a p99 has observations behind it and one leader change in the window
+# is not an alarm on its own.
+METRICS_WINDOW = 900
+
+# etcd before 3.4 serves the gateway under another path, so its alarms are
+# listed with etcdctl instead.
+ETCDCTL = "/snap/bin/etcd.etcdctl"
+ETCDCTL_TIMEOUT = 10
+
+
+def cache_path(name, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, "etcd-{}.json".format(name))
+
+
+def write_cache(path, data=None, error=None, interval=INTERVAL, now=None):
+    """Atomically replace the cache at path. Readers judge staleness by
+    the timestamp and interval."""
+    cache = {
+        "timestamp": time.time() if now is None else now,
+        "interval": interval,
+        "data": data,
+        "error": error,
+    }
+    with open(path + ".tmp", "w") as fp:
+        json.dump(cache, fp)
+    os.chmod(path + ".tmp", 0o644)
+    os.replace(path + ".tmp", path)
+
+
+def etcdctl_alarm_list(gateway, endpoint):
+    """List the alarms with etcdctl, using the certificates of the gateway.
+    Raises GatewayError like the gateway does."""
+    command = [
+        ETCDCTL,
+        "--endpoints={}".format(endpoint),
+        "--cacert={}".format(gateway.ca_path),
+        "--cert={}".format(gateway.cert_path),
+        "--key={}".format(gateway.key_path),
+        "alarm",
+        "list",
+        "--write-out=json",
+    ]
+    try:
+        out = check_output(
+            command,
+            env=dict(os.environ, ETCDCTL_API="3"),
+            stderr=PIPE,
+            timeout=ETCDCTL_TIMEOUT,
+        )
+        return [Alarm.from_json(a) for a in json.loads(out).get("alarms") or []]
+    except CalledProcessError as e:
+        error = e.stderr.decode("utf-8", "replace").strip() or str(e)
+        raise GatewayError("etcdctl alarm list: {}".format(error)) from e
+    except (TimeoutExpired, OSError, ValueError) as e:
+        raise GatewayError("etcdctl alarm list: {}".format(e)) from e
+
+
+def collect_alarms(gateway, endpoint):
+    """The alarms raised anywhere in the cluster."""
+    try:
+        alarms = gateway.alarm_list(endpoint)
+    except GatewayError:
+        alarms = etcdctl_alarm_list(gateway, endpoint)
+    return [
+        {"member_id": "{:x}".format(alarm.member_id), "alarm": alarm.name}
+        for alarm in alarms
+    ]
+
+
+class MetricsCollector:
+    """Summarise /metrics over a sliding window. Only the reduced scrapes
+    of the window are kept in memory, to compute histogram and counter
+    deltas between the oldest and the newest."""
+
+    def __init__(self, window=METRICS_WINDOW, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.scrapes = deque()
+
+    def __call__(self, gateway, endpoint):
+        now = self.clock()
+        self.scrapes.append((now, scrape(gateway.metrics(endpoint))))
+        # Keep the newest scrape that is at least a window old
+        while len(self.scrapes) > 2 and self.scrapes[1][0] <= now - self.window:
+            self.scrapes.popleft()
+        (then, old), (_, new) = self.scrapes[0], self.scrapes[-1]
+        summary = summarize(old, new, now - then)
+        summary["window"] = round(now - then)
+        return summary
+
+
+# Each collector is called with the gateway and the local endpoint, and
+# returns JSON-serialisable data cached as etcd-<name>.json.
+COLLECTORS = {
+    "alarms": collect_alarms,
+    "metrics": MetricsCollector(),
+}
+
+
+def collect(gateway, settings, now=None):
+    """Run every collector once, caching its data or its error."""
+    # Each round gets the full time budget and a closed circuit again
+    reset_budget()
+    BREAKER.reset()
+    cache_dir = settings.get("cache_dir", CACHE_DIR)
+    interval = settings.get("interval", INTERVAL)
+    for name, collector in COLLECTORS.items():
+        # A collector may have an endpoint of its own, e.g. metrics_endpoint
+        endpoint = settings.get(name + "_endpoint", settings["endpoint"])
+        try:
+            data, error = collector(gateway, endpoint), None
+        except GatewayError as e:
+            data, error = None, str(e)
+        write_cache(cache_path(name, cache_dir), data, error, interval, now)
+
+
+def main(path=SETTINGS):
+    with open(path) as fp:
+        settings = json.load(fp)
+    gateway = EtcdGateway(settings["cacert"], settings["cert"], settings["key"])
+    interval = settings.get("interval", INTERVAL)
+    while True:
+        started = time.monotonic()
+        collect(gateway, settings)
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
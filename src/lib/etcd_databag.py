@@ -1,19 +1,30 @@
 from charms import layer
 from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import log
+from charmhelpers.core.hookenv import ERROR
+from charmhelpers.core.hookenv import WARNING
 from charmhelpers.core.hookenv import is_leader
 from charmhelpers.core.hookenv import leader_get, leader_set
 from charmhelpers.core import unitdata
 from charms.reactive import is_state
 from etcd_lib import (
+    DEFAULT_QUOTA_BYTES,
     get_ingress_address,
     get_bind_address,
     build_uri,
     get_snapshot_count,
+    quota_problem,
 )
+from etcdctl import etcd_version
+from packaging.version import InvalidVersion, Version
+from subprocess import CalledProcessError
+
+from functools import cached_property
 
 import string
 import random
 import os
+import yaml
 
 
 class EtcdDatabag:
@@ -31,8 +42,13 @@ class EtcdDatabag:
      'heartbeat-interval': '100',
      'election-timeout': '1000',
      'snapshot-count': '100000',
+     'auto_compaction_mode': 'periodic',
+     'auto_compaction_retention': '0',
+     'quota_backend_bytes': 0,
      'port': '2380',
      'management_port': '2379',
+     'metrics_port': 0,
+     'metrics_scheme': 'https',
      'ca_certificate': '/etc/ssl/etcd/ca.crt',
      'server_certificate': '/etc/ssl/etcd/server.crt',
      'server_key': '/etc/ssl/etcd/server.key',
@@ -44,48 +60,231 @@ class EtcdDatabag:
     def __init__(self):
         self.db = unitdata.kv()
         self.build_uri = build_uri
-        self.cluster_bind_address = self.get_bind_address("cluster")
-        self.port = config("port")
-        self.listen_client_urls = [
-            build_uri("https", self.get_bind_address("db"), self.port)
-        ]
+
+    # Settings are computed on first access and then kept for the life of
+    # the bag, so handlers only pay for the network-get, leader-get and
+    # config lookups they actually use.
+
+    @cached_property
+    def cluster_bind_address(self):
+        return self.get_bind_address("cluster")
+
+    @cached_property
+    def port(self):
+        return config("port")
+
+    @cached_property
+    def listen_client_urls(self):
+        urls = [build_uri("https", self.get_bind_address("db"), self.port)]
         if config("bind_with_insecure_http"):
-            self.listen_client_urls.insert(0, build_uri("http", "127.0.0.1", 4001))
-        self.advertise_urls = [build_uri("https", get_ingress_address("db"), self.port)]
-        self.management_port = config("management_port")
-        self.heartbeat_interval = config("heartbeat_interval")
-        self.election_timeout = config("election_timeout")
-        self.snapshot_count = get_snapshot_count(
-            config("snapshot_count"), config("channel")
+            urls.insert(0, build_uri("http", "127.0.0.1", 4001))
+        return urls
+
+    @cached_property
+    def metrics_port(self):
+        # 0 serves metrics on the client port only
+        port = config("metrics_port") or 0
+        if port and not self.etcd_3_3_or_later:
+            log("metrics_port needs etcd 3.3 or later, ignoring it", WARNING)
+            return 0
+        return port
+
+    @cached_property
+    def metrics_scheme(self):
+        scheme = config("metrics_scheme")
+        if scheme not in ("https", "http"):
+            log("Unknown metrics_scheme {}, using https".format(scheme), WARNING)
+            return "https"
+        return scheme
+
+    @cached_property
+    def listen_metrics_urls(self):
+        if not self.metrics_port:
+            return []
+        address = self.get_bind_address("db")
+        urls = [build_uri(self.metrics_scheme, address, self.metrics_port)]
+        if address != "0.0.0.0":
+            # The etcd-collector scrapes the local member over loopback
+            urls.append(build_uri(self.metrics_scheme, "127.0.0.1", self.metrics_port))
+        return urls
+
+    @cached_property
+    def advertise_urls(self):
+        return [build_uri("https", get_ingress_address("db"), self.port)]
+
+    @cached_property
+    def management_port_problem(self):
+        """Why the configured management port cannot be applied, or None.
+        Every member's peer URL would have to move at once, which a rolling
+        restart cannot do without losing quorum."""
+        port = config("management_port")
+        if not self._applied_management_port or port == self._applied_management_port:
+            return None
+        return "management_port cannot change on a running cluster, set it back to {}".format(
+            self._applied_management_port
         )
-        # Live polled properties
-        self.cluster_address = get_ingress_address("cluster")
-        self.unit_name = os.getenv("JUJU_UNIT_NAME").replace("/", "")
 
+    @cached_property
+    def management_port(self):
+        if self.management_port_problem:
+            log(self.management_port_problem, ERROR)
+            return self._applied_management_port
+        return config("management_port")
+
+    @cached_property
+    def heartbeat_interval(self):
+        return config("heartbeat_interval")
+
+    @cached_property
+    def election_timeout(self):
+        return config("election_timeout")
+
+    @cached_property
+    def snapshot_count(self):
+        return get_snapshot_count(config("snapshot_count"), config("channel"))
+
+    @cached_property
+    def etcd_3_3_or_later(self):
+        # auto-compaction-mode and listen-metrics-urls came with etcd 3.3
+        version = config("channel").split("/")[0]
+        if version == "auto":
+            try:
+                version = etcd_version()
+            except (ValueError, OSError, CalledProcessError):
+                # Not installed yet, "auto" installs the latest release
+                return True
+        try:
+            return Version(version) >= Version("3.3")
+        except InvalidVersion:
+            return True
+
+    @cached_property
+    def auto_compaction_mode(self):
+        mode = config("auto_compaction_mode")
+        if mode not in ("periodic", "revision"):
+            log("Unknown auto_compaction_mode {}, using periodic".format(mode), WARNING)
+            return "periodic"
+        return mode
+
+    @cached_property
+    def auto_compaction_retention(self):
+        # etcd treats 0 as disabled
+        return config("auto_compaction_retention") or "0"
+
+    @cached_property
+    def _applied_conf(self):
+        # The config etcd runs with, as last rendered
+        path = os.path.join(self.etcd_conf_dir, "etcd.conf.yml")
+        try:
+            with open(path) as fp:
+                return yaml.safe_load(fp) or {}
+        except (OSError, yaml.YAMLError):
+            return {}
+
+    @cached_property
+    def _applied_quota(self):
+        try:
+            return int(self._applied_conf.get("quota-backend-bytes") or 0)
+        except ValueError:
+            return 0
+
+    @cached_property
+    def _applied_management_port(self):
+        url = self._applied_conf.get("listen-peer-urls") or ""
+        port = url.rpartition(":")[2]
+        return int(port) if port.isdigit() else None
+
+    @cached_property
+    def quota_problem(self):
+        """Why the configured quota cannot be applied, or None. Only a quota
+        that differs from the one in effect is checked."""
+        quota = config("quota_backend_bytes") or 0
+        if quota == self._applied_quota:
+            return None
+        # 0 is etcd's own default of 2GiB
+        return quota_problem(quota or DEFAULT_QUOTA_BYTES, self.etcd_data_dir)
+
+    @cached_property
+    def quota_backend_bytes(self):
+        if self.quota_problem:
+            # Falling back to etcd's default could put the cluster over
+            # its quota, so the quota in effect is kept instead
+            log(
+                "{}, keeping {}".format(self.quota_problem, self._applied_quota),
+                ERROR,
+            )
+            return self._applied_quota
+        return config("quota_backend_bytes") or 0
+
+    @cached_property
+    def cluster_address(self):
+        return get_ingress_address("cluster")
+
+    @cached_property
+    def unit_name(self):
+        return os.getenv("JUJU_UNIT_NAME").replace("/", "")
+
+    @cached_property
+    def _tls_opts(self):
         # Pull the TLS certificate paths from layer data
-        tls_opts = layer.options("tls-client")
-        ca_path = tls_opts["ca_certificate_path"]
-        crt_path = tls_opts["server_certificate_path"]
-        key_path = tls_opts["server_key_path"]
+        return layer.options("tls-client")
 
+    @cached_property
+    def _etcd_opts(self):
         # Pull the static etcd configuration from layer-data
-        etcd_opts = layer.options("etcd")
-        self.etcd_conf_dir = etcd_opts["etcd_conf_dir"]
+        return layer.options("etcd")
+
+    @cached_property
+    def etcd_conf_dir(self):
+        return self._etcd_opts["etcd_conf_dir"]
+
+    @cached_property
+    def etcd_data_dir(self):
         # This getter determines the current context of the storage path
         # depending on if durable storage is mounted.
-        self.etcd_data_dir = self.storage_path()
-        self.etcd_daemon = etcd_opts["etcd_daemon_process"]
+        return self.storage_path()
 
-        self.ca_certificate = ca_path
-        self.server_certificate = crt_path
-        self.server_key = key_path
+    @cached_property
+    def etcd_daemon(self):
+        return self._etcd_opts["etcd_daemon_process"]
 
-        self.tls_cipher_suites = config("tls_cipher_suites")
+    @cached_property
+    def ca_certificate(self):
+        return self._tls_opts["ca_certificate_path"]
 
-        # Cluster concerns
-        self.cluster = self.db.get("etcd.cluster", "")
-        self.token = self.cluster_token()
-        self.cluster_state = self.db.get("etcd.cluster-state", "existing")
+    @cached_property
+    def server_certificate(self):
+        return self._tls_opts["server_certificate_path"]
+
+    @cached_property
+    def server_key(self):
+        return self._tls_opts["server_key_path"]
+
+    @cached_property
+    def tls_cipher_suites(self):
+        return config("tls_cipher_suites")
+
+    # Cluster concerns
+
+    @cached_property
+    def cluster(self):
+        return self.db.get("etcd.cluster", "")
+
+    @cached_property
+    def token(self):
+        return self.cluster_token()
+
+    @cached_property
+    def cluster_state(self):
+        return self.db.get("etcd.cluster-state", "existing")
+
+    def context(self):
+        """Return the full dict of data shown above, plus any attributes set
+        on the bag, for rendering templates and building requests."""
+        for name, attr in vars(EtcdDatabag).items():
+            if isinstance(attr, cached_property) and not name.startswith("_"):
+                getattr(self, name)
+        return {k: v for k, v in vars(self).items() if not k.startswith("_")}
 
     def set_cluster(self, value):
         """Set the cluster string for peer registration"""
@@ -119,12 +318,10 @@ class EtcdDatabag:
         attach durable storage, which is mounted in /media. We need a common
         method to determine which storage path we are concerned with"""
 
-        etcd_opts = layer.options("etcd")
-
         if is_state("data.volume.attached"):
             return "/media/etcd/data"
         else:
-            return etcd_opts["etcd_data_dir"]
+            return self._etcd_opts["etcd_data_dir"]
 
     def get_bind_address(self, endpoint_name):
         """Returns the address that the service binds to. If the config
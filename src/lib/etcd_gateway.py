@@ -0,0 +1,300 @@
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlsplit
+import json
+import socket
+import ssl
+import time
+
+from etcd_lib import build_uri
+from etcd_records import Alarm, EndpointHealth, EndpointStatus, Member
+from etcd_retry import BREAKER, BudgetExhausted, CircuitOpen, bounded_timeout
+
+
+DEFAULT_ENDPOINT = "https://127.0.0.1:2379"
+DEFAULT_TIMEOUT = 5
+
+# Seconds to wait for a (re)started member to become ready. Polling starts
+# fast so a quick start is noticed at once, then backs off so a slow host
+# replaying its WAL is not hammered.
+READY_TIMEOUT = 60
+POLL_INITIAL = 0.1
+POLL_MAX = 2
+
+# Connections are kept open for the lifetime of the hook process, so every
+# EtcdGateway instance talking to the same endpoint reuses a single TLS session.
+_CONNECTIONS = {}
+_SSL_CONTEXTS = {}
+
+
+class GatewayError(Exception):
+    pass
+
+
+class NotReady(GatewayError):
+    pass
+
+
+def ssl_context(ca_path, cert_path, key_path):
+    """Return a mutual-TLS context for the given certificate paths. Contexts
+    are cached per hook so the certificates are only loaded once."""
+    key = (ca_path, cert_path, key_path)
+    if key not in _SSL_CONTEXTS:
+        context = ssl.create_default_context(cafile=ca_path)
+        context.load_cert_chain(cert_path, key_path)
+        # etcd certificates are issued for addresses, not for hostnames
+        # we can rely on, and we always talk to the member we name.
+        context.check_hostname = False
+        _SSL_CONTEXTS[key] = context
+    return _SSL_CONTEXTS[key]
+
+
+def close_connections():
+    """Close every pooled connection."""
+    for conn in _CONNECTIONS.values():
+        conn.close()
+    _CONNECTIONS.clear()
+
+
+class EtcdGateway:
+    """Native client for the etcd v3 gRPC JSON gateway (etcd 3.4+). Exposes
+    the same public methods as EtcdCtl, returning the same records, without
+    forking etcdctl for every request."""
+
+    def __init__(self, ca_path, cert_path, key_path, timeout=DEFAULT_TIMEOUT):
+        self.ca_path = ca_path
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self.timeout = timeout
+
+    def _connection(self, endpoint):
+        url = urlsplit(endpoint)
+        key = (url.scheme, url.netloc)
+        conn = _CONNECTIONS.get(key)
+        if conn is None:
+            if url.scheme == "https":
+                context = ssl_context(self.ca_path, self.cert_path, self.key_path)
+                conn = HTTPSConnection(
+                    url.hostname, url.port, timeout=self.timeout, context=context
+                )
+            else:
+                conn = HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+            _CONNECTIONS[key] = conn
+        return key, conn
+
+    def request(self, endpoint, path, body=None, method="POST", raw=False):
+        """Send a request to a single endpoint and return the decoded JSON
+        response, or its text when raw is True. A stale pooled connection is
+        re-dialed once. Requests share the hook-wide time budget and
+        per-endpoint circuit breaker with the etcdctl backend."""
+        try:
+            BREAKER.check(endpoint)
+            timeout = bounded_timeout(self.timeout)
+        except (CircuitOpen, BudgetExhausted) as e:
+            raise GatewayError(str(e)) from e
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload else {}
+        for attempt in range(2):
+            key, conn = self._connection(endpoint)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (HTTPException, OSError) as e:
+                conn.close()
+                _CONNECTIONS.pop(key, None)
+                if attempt:
+                    BREAKER.record_failure(endpoint)
+                    raise GatewayError("{} {}: {}".format(endpoint, path, e)) from e
+                continue
+            BREAKER.record_success(endpoint)
+            if response.status != 200:
+                raise GatewayError(
+                    "{} {}: HTTP {} {}".format(
+                        endpoint, path, response.status, data.decode("utf-8", "replace")
+                    )
+                )
+            if raw:
+                return data.decode("utf-8", "replace")
+            try:
+                return json.loads(data or b"{}")
+            except ValueError as e:
+                raise GatewayError("{} {}: invalid JSON".format(endpoint, path)) from e
+
+    def call(self, endpoints, path, body=None, method="POST"):
+        """Send a request to the first reachable endpoint in a comma
+        separated endpoint string."""
+        error = None
+        for endpoint in (endpoints or DEFAULT_ENDPOINT).split(","):
+            try:
+                return self.request(endpoint.strip(), path, body, method)
+            except GatewayError as e:
+                error = e
+        raise error
+
+    def probe_ready(self, endpoint, timeout=DEFAULT_TIMEOUT):
+        """Check once whether a single endpoint accepts connections and
+        reports itself healthy on /health. Returns None when it is ready,
+        otherwise the reason it is not. The check bypasses the connection
+        pool and the circuit breaker, as failures are expected while the
+        member starts."""
+        url = urlsplit(endpoint)
+        try:
+            socket.create_connection((url.hostname, url.port), timeout).close()
+        except OSError as e:
+            return "port {} is closed: {}".format(url.port, e)
+        if url.scheme == "https":
+            context = ssl_context(self.ca_path, self.cert_path, self.key_path)
+            conn = HTTPSConnection(
+                url.hostname, url.port, timeout=timeout, context=context
+            )
+        else:
+            conn = HTTPConnection(url.hostname, url.port, timeout=timeout)
+        try:
+            conn.request("GET", "/health")
+            data = conn.getresponse().read()
+        except (HTTPException, OSError) as e:
+            return "/health failed: {}".format(e)
+        finally:
+            conn.close()
+        try:
+            result = json.loads(data or b"{}")
+        except ValueError:
+            return "/health returned invalid JSON"
+        if str(result.get("health")).lower() != "true":
+            return "/health reports {}".format(result.get("reason") or "unhealthy")
+        return None
+
+    def wait_until_ready(self, endpoint=DEFAULT_ENDPOINT, timeout=READY_TIMEOUT):
+        """Block until the endpoint is ready, polling at growing intervals,
+        and return the seconds waited. Raises NotReady with the last reason
+        once timeout, or the hook time budget, runs out."""
+        start = time.monotonic()
+        try:
+            deadline = start + bounded_timeout(timeout)
+        except BudgetExhausted as e:
+            raise NotReady(str(e)) from e
+        interval = POLL_INITIAL
+        while True:
+            remaining = max(deadline - time.monotonic(), POLL_INITIAL)
+            reason = self.probe_ready(endpoint, min(self.timeout, remaining))
+            now = time.monotonic()
+            if reason is None:
+                return now - start
+            if now + interval > deadline:
+                raise NotReady(
+                    "{} not ready after {:.1f}s: {}".format(
+                        endpoint, now - start, reason
+                    )
+                )
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_MAX)
+
+    def _members(self, endpoints=None):
+        return self.call(endpoints, "/v3/cluster/member/list", {}).get("members", [])
+
+    def register(self, cluster_data):
+        """Add this unit as a member of the cluster, returning the initial
+        cluster string in the same form as EtcdCtl.register."""
+        peer_url = build_uri(
+            "https", cluster_data["cluster_address"], cluster_data["management_port"]
+        )
+        resp = self.call(
+            cluster_data["leader_address"],
+            "/v3/cluster/member/add",
+            {"peerURLs": [peer_url]},
+        )
+        new_id = resp.get("member", {}).get("ID")
+        cluster = []
+        for member in resp.get("members", []):
+            name = member.get("name", "")
+            if member.get("ID") == new_id:
+                name = cluster_data["unit_name"]
+            for url in member.get("peerURLs", []):
+                cluster.append("{}={}".format(name, url))
+        return {"cluster": ",".join(cluster)}
+
+    def unregister(self, unit_id, leader_address=None):
+        """Remove a member by its hex unit_id."""
+        body = {"ID": str(int(unit_id, 16))}
+        return self.call(leader_address, "/v3/cluster/member/remove", body)
+
+    def member_list(self, leader_address=None):
+        """Return the cluster members as Member records."""
+        return [Member.from_json(m) for m in self._members(leader_address)]
+
+    def member_update(self, unit_id, uri):
+        """Update the peer URL of the member identified by unit_id."""
+        body = {"ID": str(int(unit_id, 16)), "peerURLs": [uri]}
+        return self.call(None, "/v3/cluster/member/update", body)
+
+    def move_leader(self, unit_id, endpoints=None):
+        """Transfer raft leadership to the member with the hex unit_id."""
+        body = {"targetID": str(int(unit_id, 16))}
+        return self.call(endpoints, "/v3/maintenance/transfer-leadership", body)
+
+    def compact(self, revision, physical=False, endpoints=None):
+        """Discard the key history before revision."""
+        body = {"revision": str(revision), "physical": physical}
+        return self.call(endpoints, "/v3/kv/compaction", body)
+
+    def alarm_list(self, endpoints=None):
+        """Return the alarms raised in the cluster as Alarm records."""
+        out = self.call(endpoints, "/v3/maintenance/alarm", {"action": "GET"})
+        return [Alarm.from_json(a) for a in out.get("alarms") or []]
+
+    def alarm_disarm(self, endpoints=None):
+        """Deactivate every alarm raised in the cluster."""
+        for alarm in self.alarm_list(endpoints):
+            body = {
+                "action": "DEACTIVATE",
+                "memberID": str(alarm.member_id),
+                "alarm": alarm.name,
+            }
+            self.call(endpoints, "/v3/maintenance/alarm", body)
+
+    def _client_urls(self, endpoints=None, cluster=False):
+        if cluster:
+            return [
+                m.client_urls[0] for m in self.member_list(endpoints) if m.client_urls
+            ]
+        return [e.strip() for e in (endpoints or DEFAULT_ENDPOINT).split(",")]
+
+    def cluster_health(self):
+        """Query /health on every member, returning EndpointHealth records."""
+        return self.endpoint_health(cluster=True)
+
+    def endpoint_health(self, endpoints=None, cluster=False):
+        """Query /health on the given endpoints, or on every member when
+        cluster is True, returning EndpointHealth records."""
+        health = []
+        for url in self._client_urls(endpoints, cluster):
+            start = time.monotonic()
+            try:
+                result = self.request(url, "/health", method="GET")
+            except GatewayError as e:
+                health.append(EndpointHealth(url, False, error=str(e)))
+                continue
+            took = time.monotonic() - start
+            healthy = str(result.get("health")).lower() == "true"
+            error = "" if healthy else result.get("reason", "unhealthy")
+            health.append(EndpointHealth(url, healthy, took, error))
+        return health
+
+    def endpoint_status(self, endpoints=None, cluster=False):
+        """Return EndpointStatus records for the given endpoints, or for
+        every member when cluster is True."""
+        return [
+            EndpointStatus(url, self.request(url, "/v3/maintenance/status", {}))
+            for url in self._client_urls(endpoints, cluster)
+        ]
+
+    def metrics(self, endpoint=DEFAULT_ENDPOINT):
+        """Return the Prometheus metrics page of a single endpoint."""
+        return self.request(endpoint, "/metrics", method="GET", raw=True)
+
+    def version(self):
+        """Return the version of the local etcd server."""
+        return self.call(None, "/version", method="GET")["etcdserver"]
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from ipaddress import ip_address
 from packaging.version import Version
 
@@ -7,9 +8,15 @@ from charmhelpers.core.hookenv import (
     unit_private_ip,
 )
 
+import hashlib
 import json
+import os
+import shutil
+import yaml
 
 GRAFANA_DASHBOARD_FILE = "grafana_dashboard.json.j2"
+# The backend quota etcd applies when quota-backend-bytes is 0
+DEFAULT_QUOTA_BYTES = 2 * 1024**3
 
 
 def build_uri(schema, address, port) -> str:
@@ -24,16 +31,24 @@ def build_uri(schema, address, port) -> str:
     return f"{schema}://{address}:{port}"
 
 
+@lru_cache(maxsize=None)
+def cached_network_get(endpoint_name):
+    """network-get is a round trip to the juju agent, and bindings do not
+    change while a hook runs, so each endpoint is only queried once per hook.
+    Callers must not modify the returned data."""
+    return network_get(endpoint_name)
+
+
 def get_ingress_addresses(endpoint_name):
     """Returns all ingress-addresses belonging to the named endpoint, if
     available. Falls back to private-address if necessary."""
     try:
-        data = network_get(endpoint_name)
+        data = cached_network_get(endpoint_name)
     except NotImplementedError:
         return [unit_private_ip()]
 
     if "ingress-addresses" in data:
-        return data["ingress-addresses"]
+        return list(data["ingress-addresses"])
     else:
         return [unit_private_ip()]
 
@@ -82,7 +97,7 @@ def get_bind_address(endpoint_name):
     bind address
     """
     try:
-        data = network_get(endpoint_name)
+        data = cached_network_get(endpoint_name)
     except NotImplementedError:
         return unit_private_ip()
 
@@ -145,3 +160,88 @@ def render_grafana_dashboard(datasource):
             jinja_env_args=jinja_args,
         )
     )
+
+
+def human_size(num_bytes):
+    """Format a byte count using binary units, e.g. 1536 -> '1.5KiB'"""
+    size = float(num_bytes)
+    if abs(size) < 1024:
+        return "{}B".format(int(size))
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024
+        if abs(size) < 1024:
+            return "{:.1f}{}".format(size, unit)
+    return "{:.1f}TiB".format(size / 1024)
+
+
+def quota_problem(quota, data_dir):
+    """Return why a backend quota of quota bytes does not suit the member
+    in data_dir, or None if it does. It must be above the size of the
+    database, or etcd raises NOSPACE as soon as it starts, and fit on the
+    volume: the database can grow into the space it already uses and
+    whatever is free on the volume."""
+    try:
+        free = shutil.disk_usage(data_dir).free
+    except OSError:
+        return None
+    db = os.path.join(data_dir, "member", "snap", "db")
+    size = os.path.getsize(db) if os.path.exists(db) else 0
+    if quota <= size:
+        return "quota_backend_bytes {} is below the {} database".format(
+            human_size(quota), human_size(size)
+        )
+    available = free + size
+    if quota <= available:
+        return None
+    return "quota_backend_bytes {} exceeds the {} available to etcd".format(
+        human_size(quota), human_size(available)
+    )
+
+
+def content_hash(content) -> str:
+    """Return the sha256 hex digest of rendered file content."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_hash(path):
+    """Return the sha256 hex digest of a file, or None if it does not exist."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(65536), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def _config_settings(content):
+    """Parse an etcd config as either the v3 yaml file or the v2
+    environment file of KEY="value" lines."""
+    try:
+        data = yaml.safe_load(content)
+    except yaml.YAMLError:
+        data = None
+    if isinstance(data, dict):
+        return data
+    settings = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#") and "=" in line:
+            key, value = line.split("=", 1)
+            settings[key.strip()] = value.strip()
+    return settings
+
+
+def changed_config_keys(old, new):
+    """Return the sorted setting names whose values differ between two
+    rendered etcd configs."""
+    old_settings = _config_settings(old or "")
+    new_settings = _config_settings(new or "")
+    return sorted(
+        key
+        for key in set(old_settings) | set(new_settings)
+        if old_settings.get(key) != new_settings.get(key)
+    )
@@ -0,0 +1,214 @@
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import log
+
+from etcd_lib import DEFAULT_QUOTA_BYTES, human_size
+from etcd_retry import RetryExhausted, retry
+from etcd_rolling import MAX_RAFT_LAG, caught_up
+from etcdctl import EtcdCtl
+
+import time
+
+# Seconds to wait for a defragmented member to serve again and for the
+# cluster to be healthy and caught up before moving on to the next member.
+SETTLE_TIMEOUT = 60
+
+# unitdata keys of the charm-side compaction scheduler: [time, revision]
+# samples taken every update-status, oldest first, and a record of each
+# compaction it ran, to tune retention by.
+REVISIONS_KEY = "etcd.compaction.revisions"
+HISTORY_KEY = "etcd.compaction.history"
+HISTORY_SIZE = 50
+# Seconds of revision samples to keep, on top of the compaction window, for
+# the history growth rate.
+SAMPLE_PERIOD = 24 * 3600
+
+
+def defrag_plan(probe, threshold):
+    """Return the EndpointStatus of every member of a ClusterProbe whose
+    fragmentation is at least threshold, followers first and the raft
+    leader last."""
+    fragmented = [s for s in probe.status if s.fragmentation >= threshold]
+    return sorted(fragmented, key=lambda s: (s.is_leader, s.endpoint))
+
+
+def reachable(probe):
+    """Whether every member of a ClusterProbe answers and is caught up,
+    healthy or not. Members report unhealthy while an alarm is raised."""
+    return not probe.unreachable and probe.raft_lag <= MAX_RAFT_LAG
+
+
+def settle(etcdctl, check=caught_up, timeout=SETTLE_TIMEOUT):
+    """Block until a fresh probe of the cluster passes check, by default
+    until every member is serving, healthy and caught up. Raises
+    CommandFailed otherwise."""
+
+    def probe():
+        EtcdCtl.invalidate_cache()
+        return etcdctl.probe_cluster()
+
+    try:
+        retry(
+            probe,
+            deadline=timeout,
+            retry_on=EtcdCtl.CommandFailed,
+            until=check,
+            describe="Waiting for the cluster to catch up after a defrag",
+        )
+    except RetryExhausted as e:
+        raise EtcdCtl.CommandFailed(str(e)) from e
+
+
+def rolling_defrag(etcdctl, threshold, check=caught_up, force=False):
+    """Defragment the members fragmented beyond threshold one at a time,
+    waiting until the cluster passes check after each. The raft leader goes
+    last and hands leadership to a follower first; if it cannot, it is
+    skipped, unless force is set. Leadership can move while the others are
+    defragmented, so each member's status is read again before its turn.
+
+    Returns a list of (member name, db size before, db size after). Raises
+    CommandFailed if the cluster does not pass check to begin with, and,
+    leaving the remaining members alone, if a defrag fails or the cluster
+    does not settle after one.
+    """
+    probe = etcdctl.probe_cluster()
+    if not check(probe):
+        raise EtcdCtl.CommandFailed(
+            "Cluster is not healthy and caught up (raft lag {}, {} unreachable)".format(
+                probe.raft_lag, len(probe.unreachable)
+            )
+        )
+    names = {m.id: m.name or m.unit_id for m in probe.members}
+    results = []
+    for planned in defrag_plan(probe, threshold):
+        name = names.get(planned.member_id, planned.endpoint)
+        EtcdCtl.invalidate_cache()
+        status = etcdctl.endpoint_status(planned.endpoint)[0]
+        if status.is_leader:
+            try:
+                moved = etcdctl.transfer_leadership(status.endpoint)
+            except EtcdCtl.CommandFailed:
+                moved = None
+            if not moved and not force:
+                log("Not defragmenting {}: it is still the leader".format(name))
+                continue
+        log(
+            "Defragmenting {} ({:.0%} of {} bytes free)".format(
+                name, status.fragmentation, status.db_size
+            )
+        )
+        etcdctl.defrag(status.endpoint)
+        settle(etcdctl, check)
+        after = etcdctl.endpoint_status(status.endpoint)[0]
+        results.append((name, status.db_size, after.db_size))
+    return results
+
+
+def compaction_target(samples, revision, now, retain=0, window=0):
+    """Return the revision to compact to, given [time, revision] samples
+    (oldest first) and the current revision: the current revision minus
+    retain, or the revision the cluster was at window seconds ago. When
+    both are set the older revision wins. Returns None when there is
+    nothing to compact yet, including while the samples do not reach back
+    a whole window."""
+    targets = []
+    if retain:
+        targets.append(revision - retain)
+    if window:
+        old = [rev for sampled, rev in samples if sampled <= now - window]
+        if not old:
+            return None
+        targets.append(old[-1])
+    if not targets or min(targets) < 1:
+        return None
+    return min(targets)
+
+
+def growth_rate(samples):
+    """Return the revisions per hour across the samples, or None."""
+    if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+        return None
+    (start, first), (end, last) = samples[0], samples[-1]
+    return (last - first) * 3600.0 / (end - start)
+
+
+def scheduled_compaction(etcdctl, retain=0, window=0, now=None):
+    """Sample the current revision and compact the key history to the
+    compaction_target, if it moved on since the last compaction. Returns
+    the record of the compaction, or None if there was none."""
+    kv = unitdata.kv()
+    now = time.time() if now is None else now
+    status = etcdctl.endpoint_status()[0]
+    samples = kv.get(REVISIONS_KEY, [])
+    samples = [s for s in samples if s[0] >= now - window - SAMPLE_PERIOD]
+    samples.append([now, status.revision])
+    kv.set(REVISIONS_KEY, samples)
+
+    target = compaction_target(samples, status.revision, now, retain, window)
+    history = kv.get(HISTORY_KEY, [])
+    last = history[-1]["revision"] if history else 0
+    if target is None or target <= last:
+        return None
+
+    start = time.monotonic()
+    try:
+        etcdctl.compact(target)
+    except EtcdCtl.CommandFailed as e:
+        # etcd's own auto compaction, or a previous leader, got further
+        if not already_compacted(e):
+            raise
+        log("Revision {} is already compacted".format(target))
+    record = {
+        "time": now,
+        "revision": target,
+        "compacted": target - last if last else None,
+        "took": round(time.monotonic() - start, 3),
+        "db_size": status.db_size,
+        "db_size_in_use": status.db_size_in_use,
+        "growth_per_hour": growth_rate(samples),
+    }
+    kv.set(HISTORY_KEY, (history + [record])[-HISTORY_SIZE:])
+    log("Compacted to revision {} in {}s".format(target, record["took"]))
+    return record
+
+
+def already_compacted(error):
+    """Whether a failed compaction failed because etcd had already compacted
+    past the revision."""
+    return "compacted" in (error.stderr or "") + (error.output or "")
+
+
+def remediate_nospace(etcdctl, quota=0):
+    """Make a cluster with a NOSPACE alarm writable again: compact the key
+    history to the latest revision, defragment every member one at a time
+    and disarm the alarm. The cluster is read-only already, so a leader
+    that cannot hand over is defragmented in place.
+
+    The alarm is left raised if a member is still larger than the backend
+    quota (etcd's default when 0), as the next write would raise it again.
+    Returns the rolling_defrag results, or None if there was no alarm.
+    Raises CommandFailed if a step fails.
+    """
+    if not any(a.name == "NOSPACE" for a in etcdctl.alarm_list()):
+        return None
+    log("NOSPACE alarm raised, compacting and defragmenting", "WARNING")
+    revision = etcdctl.endpoint_status()[0].revision
+    try:
+        etcdctl.compact(revision, physical=True)
+    except EtcdCtl.CommandFailed as e:
+        # A previous attempt got as far as compacting before it failed
+        if not already_compacted(e):
+            raise
+    results = rolling_defrag(etcdctl, 0, check=reachable, force=True)
+    if not results:
+        raise EtcdCtl.CommandFailed("No member could be defragmented")
+    largest = max(after for _, _, after in results)
+    quota = quota or DEFAULT_QUOTA_BYTES
+    if largest >= quota:
+        raise EtcdCtl.CommandFailed(
+            "Database is still {} after defrag, over the {} quota".format(
+                human_size(largest), human_size(quota)
+            )
+        )
+    etcdctl.alarm_disarm()
+    log("NOSPACE alarm disarmed")
+    return results
@@ -0,0 +1,157 @@
+import re
+
+from etcd_lib import DEFAULT_QUOTA_BYTES
+
+# The few etcd metrics the NRPE performance checks need, out of the
+# hundreds /metrics exposes.
+WAL_FSYNC = "etcd_disk_wal_fsync_duration_seconds"
+BACKEND_COMMIT = "etcd_disk_backend_commit_duration_seconds"
+LEADER_CHANGES = "etcd_server_leader_changes_seen_total"
+PROPOSALS_FAILED = "etcd_server_proposals_failed_total"
+DB_SIZE = "etcd_mvcc_db_total_size_in_bytes"
+# etcd before 3.4 only exposes the size under its debugging name
+DB_SIZE_LEGACY = "etcd_debugging_mvcc_db_total_size_in_bytes"
+QUOTA = "etcd_server_quota_backend_bytes"
+
+HISTOGRAMS = (WAL_FSYNC, BACKEND_COMMIT)
+COUNTERS = (LEADER_CHANGES, PROPOSALS_FAILED)
+GAUGES = (DB_SIZE, DB_SIZE_LEGACY, QUOTA)
+
+# Every value summarize reports, and what it measures
+CHECKS = {
+    "wal_fsync_p99": "p99 WAL fsync duration",
+    "backend_commit_p99": "p99 backend commit duration",
+    "leader_changes": "leader changes per hour",
+    "proposals_failed": "failed proposals per hour",
+    "db_size": "database size as a fraction of the quota",
+}
+
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_thresholds(value):
+    """Parse a "warning,critical" threshold pair. Returns None for an empty
+    value and raises ValueError for an invalid one."""
+    if not value or not value.strip():
+        return None
+    try:
+        warning, critical = (float(v) for v in value.split(","))
+    except ValueError:
+        raise ValueError("Expected warning,critical thresholds, got {!r}".format(value))
+    if warning > critical:
+        raise ValueError("Warning threshold {} is above critical".format(warning))
+    return warning, critical
+
+
+def parse(text, names):
+    """Parse the Prometheus text exposition format, keeping only the
+    samples called one of names. Returns {name: [(labels, value)]}.
+
+    Lines are filtered on their prefix before anything else is done with
+    them, so the cost of a scrape is dominated by the few samples kept
+    rather than by the size of the page.
+    """
+    names = set(names)
+    prefixes = tuple(names)
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith(prefixes):
+            continue
+        brace = line.find("{")
+        if brace == -1:
+            name, _, rest = line.partition(" ")
+            labels = {}
+        else:
+            name = line[:brace]
+            head, _, rest = line.rpartition("}")
+            labels = dict(_LABEL.findall(head, brace))
+        if name not in names:
+            continue
+        # A timestamp may follow the value
+        try:
+            value = float(rest.split()[0])
+        except (IndexError, ValueError):
+            continue
+        samples.setdefault(name, []).append((labels, value))
+    return samples
+
+
+def scrape(text):
+    """Reduce a /metrics page to what summarize needs: the cumulative
+    buckets of each histogram as [(le, count)], and the value of each
+    counter and gauge. Samples of the same name with different labels are
+    summed."""
+    names = [h + "_bucket" for h in HISTOGRAMS] + list(COUNTERS) + list(GAUGES)
+    samples = parse(text, names)
+    result = {}
+    for histogram in HISTOGRAMS:
+        buckets = {}
+        for labels, value in samples.get(histogram + "_bucket", []):
+            try:
+                le = float(labels["le"])
+            except (KeyError, ValueError):
+                continue
+            buckets[le] = buckets.get(le, 0) + value
+        result[histogram] = sorted(buckets.items())
+    for name in COUNTERS + GAUGES:
+        if name in samples:
+            result[name] = sum(value for _, value in samples[name])
+    return result
+
+
+def histogram_quantile(q, buckets):
+    """Estimate the q quantile of cumulative [(le, count)] buckets the way
+    Prometheus does, interpolating linearly within the bucket holding it.
+    Returns None when there are no observations."""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0.0
+    for le, count in buckets:
+        if count >= rank:
+            if le == float("inf"):
+                # Beyond the highest bound: it is the best estimate we have
+                return lower
+            if count == below:
+                return le
+            return lower + (le - lower) * (rank - below) / (count - below)
+        lower, below = le, count
+    return lower
+
+
+def _increase(old, new):
+    """The increase of a counter, allowing for a reset by a restart."""
+    return new - old if new >= old else new
+
+
+def bucket_increase(old, new):
+    """The observations made between two scrapes of a histogram."""
+    before = dict(old)
+    if any(count < before.get(le, 0) for le, count in new):
+        # etcd restarted and its histogram started again from zero
+        return new
+    return [(le, count - before.get(le, 0)) for le, count in new]
+
+
+def summarize(old, new, elapsed, quantile=0.99):
+    """Summarise the member's performance between two scrapes elapsed
+    seconds apart. Returns a value for every check in CHECKS, or None for
+    one without data."""
+    summary = dict.fromkeys(CHECKS)
+    for key, histogram in (
+        ("wal_fsync_p99", WAL_FSYNC),
+        ("backend_commit_p99", BACKEND_COMMIT),
+    ):
+        buckets = bucket_increase(old.get(histogram, []), new.get(histogram, []))
+        summary[key] = histogram_quantile(quantile, buckets)
+    for key, counter in (
+        ("leader_changes", LEADER_CHANGES),
+        ("proposals_failed", PROPOSALS_FAILED),
+    ):
+        if elapsed > 0 and counter in old and counter in new:
+            increase = _increase(old[counter], new[counter])
+            summary[key] = increase * 3600 / elapsed
+    size = new.get(DB_SIZE, new.get(DB_SIZE_LEGACY))
+    if size is not None:
+        summary["db_size"] = size / (new.get(QUOTA) or DEFAULT_QUOTA_BYTES)
+    return summary
@@ -0,0 +1,266 @@
+from charmhelpers.core.hookenv import atexit
+from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import hook_name
+from charmhelpers.core.hookenv import log
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import time
+
+# Opt-in timing of every reactive handler and etcd call a hook makes. The
+# timings are buffered in memory and appended to PROFILE_LOG, one JSON record
+# per line, when the hook exits:
+#
+#     {"run": 1700000000.0, "hook": "update-status", "kind": "handler",
+#      "name": "etcd.check_cluster_health", "duration": 1.234}
+#
+# Each hook also gets a record of kind "hook" with its total duration. The
+# log is a ring: once it outgrows PROFILE_MAX_BYTES only its newest half is
+# kept, so it costs one append per hook and never fills the disk.
+PROFILE_LOG = "/var/snap/etcd/common/charm-profile.jsonl"
+PROFILE_MAX_BYTES = 1024 * 1024
+TEXTFILE = "etcd_charm.prom"
+QUANTILES = {"p50": "0.5", "p95": "0.95"}
+
+_STARTED = time.time()
+_RECORDS = []
+_ENABLED = None
+_FLUSH_REGISTERED = False
+
+
+def enabled():
+    """Whether the profiling config option is set, read once per hook."""
+    global _ENABLED
+    if _ENABLED is None:
+        _ENABLED = bool(config("profiling"))
+    return _ENABLED
+
+
+@contextmanager
+def timed(kind, name):
+    """Time the block, recording it when profiling is enabled."""
+    global _FLUSH_REGISTERED
+    if not enabled():
+        yield
+        return
+    if not _FLUSH_REGISTERED:
+        # _RECORDS stays empty until the innermost of nested blocks is done
+        atexit(flush)
+        _FLUSH_REGISTERED = True
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        _RECORDS.append((kind, name, time.monotonic() - start))
+
+
+def profiled(kind, name=None):
+    """Decorator timing every call of a function. name may be a function
+    deriving the name of the record from the arguments of the call."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if callable(name):
+                label = name(*args, **kwargs)
+            else:
+                label = name or function.__name__
+            with timed(kind, label):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def handler_name(handler_id):
+    """Name a reactive handler by its module and function, from the
+    file:line:function id charms.reactive gives it."""
+    path, _, function = handler_id.rsplit(":", 2)
+    module = os.path.splitext(os.path.basename(path))[0]
+    return "{}.{}".format(module, function)
+
+
+def instrument_handlers():
+    """Time every reactive handler the dispatcher invokes, from any layer.
+    charms.reactive has no hook for this, so Handler.invoke is wrapped."""
+    from charms.reactive.bus import Handler
+
+    invoke = Handler.invoke
+    if getattr(invoke, "profiled", False):
+        return
+
+    @wraps(invoke)
+    def profiled_invoke(handler):
+        with timed("handler", handler_name(handler.id())):
+            return invoke(handler)
+
+    profiled_invoke.profiled = True
+    Handler.invoke = profiled_invoke
+
+
+def append_records(path, records, max_bytes=PROFILE_MAX_BYTES):
+    """Append records to the ring at path, halving it when it is full."""
+    with open(path, "a") as fp:
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+        size = fp.tell()
+    if size > max_bytes:
+        with open(path) as fp:
+            lines = fp.readlines()
+        half = len(lines) // 2
+        with open(path + ".tmp", "w") as fp:
+            fp.writelines(lines[half:])
+        os.replace(path + ".tmp", path)
+
+
+def load_records(path=PROFILE_LOG):
+    """Return the records in the ring at path, skipping damaged lines."""
+    records = []
+    try:
+        with open(path) as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def flush():
+    """Write the records of this hook to the ring and, when configured, the
+    node-exporter textfile."""
+    hook = hook_name()
+    records = [
+        {"run": _STARTED, "hook": hook, "kind": k, "name": n, "duration": round(d, 4)}
+        for k, n, d in _RECORDS
+    ]
+    records.append(
+        {
+            "run": _STARTED,
+            "hook": hook,
+            "kind": "hook",
+            "name": hook,
+            "duration": round(time.time() - _STARTED, 4),
+        }
+    )
+    _RECORDS.clear()
+    try:
+        append_records(PROFILE_LOG, records)
+        textfile_dir = config("profiling_textfile_dir")
+        if textfile_dir:
+            write_textfile(
+                os.path.join(textfile_dir, TEXTFILE), summarize(load_records())
+            )
+    except OSError as e:
+        log("Could not save profiling data: {}".format(e), "WARNING")
+
+
+def percentile(values, q):
+    """The q percentile of values by the nearest-rank method."""
+    values = sorted(values)
+    rank = max(int(-(-q * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+def summarize(records):
+    """Summarise records per hook: how often it ran and how long it took,
+    and for every handler and etcd call made in it, how often it was made
+    per run and how long it took. Returns {hook: summary}, the slowest
+    steps first."""
+    runs = {}
+    steps = {}
+    for record in records:
+        hook = record["hook"]
+        if record["kind"] == "hook":
+            runs.setdefault(hook, []).append(record["duration"])
+        else:
+            key = (record["kind"], record["name"])
+            steps.setdefault(hook, {}).setdefault(key, []).append(record["duration"])
+    summary = {}
+    for hook, durations in runs.items():
+        hook_steps = []
+        for (kind, name), times in steps.get(hook, {}).items():
+            hook_steps.append(
+                {
+                    "kind": kind,
+                    "name": name,
+                    "calls_per_run": len(times) / len(durations),
+                    "p50": percentile(times, 50),
+                    "p95": percentile(times, 95),
+                    "total": sum(times),
+                }
+            )
+        hook_steps.sort(key=lambda step: step["total"], reverse=True)
+        summary[hook] = {
+            "runs": len(durations),
+            "p50": percentile(durations, 50),
+            "p95": percentile(durations, 95),
+            "steps": hook_steps,
+        }
+    return summary
+
+
+def format_report(summary):
+    """Render a summary as text, one line per hook and per step."""
+    lines = []
+    for hook, data in sorted(summary.items()):
+        lines.append(
+            "{}: {} runs, p50 {:.2f}s, p95 {:.2f}s".format(
+                hook, data["runs"], data["p50"], data["p95"]
+            )
+        )
+        for step in data["steps"]:
+            lines.append(
+                "  {} {}: {:.1f} per run, p50 {:.3f}s, p95 {:.3f}s".format(
+                    step["kind"],
+                    step["name"],
+                    step["calls_per_run"],
+                    step["p50"],
+                    step["p95"],
+                )
+            )
+    return "\n".join(lines)
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def write_textfile(path, summary):
+    """Write a summary for the node-exporter textfile collector."""
+    lines = [
+        "# HELP etcd_charm_hook_duration_seconds Duration of charm hooks.",
+        "# TYPE etcd_charm_hook_duration_seconds gauge",
+    ]
+    for hook, data in sorted(summary.items()):
+        for key, quantile in QUANTILES.items():
+            lines.append(
+                'etcd_charm_hook_duration_seconds{{hook="{}",quantile="{}"}} {}'.format(
+                    _label(hook), quantile, data[key]
+                )
+            )
+    lines += [
+        "# HELP etcd_charm_step_duration_seconds Duration of handlers and etcd "
+        "calls in charm hooks.",
+        "# TYPE etcd_charm_step_duration_seconds gauge",
+    ]
+    for hook, data in sorted(summary.items()):
+        for step in data["steps"]:
+            for key, quantile in QUANTILES.items():
+                lines.append(
+                    "etcd_charm_step_duration_seconds"
+                    '{{hook="{}",kind="{}",name="{}",quantile="{}"}} {}'.format(
+                        _label(hook),
+                        step["kind"],
+                        _label(step["name"]),
+                        quantile,
+                        step[key],
+                    )
+                )
+    with open(path + ".tmp", "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,238 @@
+import re
+
+_DURATION_UNITS = {
+    "ns": 1e-9,
+    "us": 1e-6,
+    "µs": 1e-6,
+    "ms": 1e-3,
+    "s": 1.0,
+    "m": 60.0,
+    "h": 3600.0,
+}
+_DURATION_RE = re.compile(r"([0-9.]+)(ns|us|µs|ms|s|m|h)")
+# A line of `endpoint health` text output, the only format before etcd 3.4:
+#   https://10.0.0.1:2379 is healthy: successfully committed proposal: took = 2ms
+#   https://10.0.0.2:2379 is unhealthy: failed to commit proposal: <error>
+_HEALTH_RE = re.compile(r"^(\S+) is (healthy|unhealthy): (.*)$")
+
+
+def parse_duration(value):
+    """Convert a Go duration string such as "1.5ms" or "1m2.5s" to seconds.
+    Returns None if the value cannot be parsed."""
+    if not value:
+        return None
+    parts = _DURATION_RE.findall(str(value))
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _uint(value):
+    """etcdctl emits uint64 fields as JSON numbers, the gateway as strings."""
+    return int(value or 0)
+
+
+class Member:
+    """A cluster member as reported by `member list`."""
+
+    __slots__ = ("id", "name", "peer_urls", "client_urls", "is_learner")
+
+    def __init__(self, id, name="", peer_urls=(), client_urls=(), is_learner=False):
+        self.id = id
+        self.name = name
+        self.peer_urls = list(peer_urls)
+        self.client_urls = list(client_urls)
+        self.is_learner = is_learner
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            _uint(data.get("ID")),
+            data.get("name", ""),
+            data.get("peerURLs") or [],
+            data.get("clientURLs") or [],
+            bool(data.get("isLearner", False)),
+        )
+
+    @property
+    def unit_id(self):
+        """The member ID in the hex form etcdctl accepts and prints."""
+        return "{:x}".format(self.id)
+
+    @property
+    def started(self):
+        """Members that were added but have not joined yet have no name."""
+        return bool(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, Member) and all(
+            getattr(self, slot) == getattr(other, slot) for slot in self.__slots__
+        )
+
+    def __repr__(self):
+        return "Member({}, {!r}, peer_urls={})".format(
+            self.unit_id, self.name, self.peer_urls
+        )
+
+
+class EndpointStatus:
+    """The status of one endpoint as reported by `endpoint status`."""
+
+    __slots__ = (
+        "endpoint",
+        "member_id",
+        "leader_id",
+        "raft_index",
+        "raft_applied_index",
+        "raft_term",
+        "revision",
+        "db_size",
+        "db_size_in_use",
+        "version",
+        "is_learner",
+    )
+
+    def __init__(self, endpoint, status):
+        header = status.get("header") or {}
+        self.endpoint = endpoint
+        self.member_id = _uint(header.get("member_id"))
+        self.leader_id = _uint(status.get("leader"))
+        self.raft_index = _uint(status.get("raftIndex"))
+        self.raft_applied_index = _uint(status.get("raftAppliedIndex"))
+        self.raft_term = _uint(status.get("raftTerm"))
+        self.revision = _uint(header.get("revision"))
+        self.db_size = _uint(status.get("dbSize"))
+        self.db_size_in_use = _uint(status.get("dbSizeInUse"))
+        self.version = status.get("version", "")
+        self.is_learner = bool(status.get("isLearner", False))
+
+    @classmethod
+    def from_json(cls, data):
+        """Parse one entry of `endpoint status -w json`."""
+        return cls(data.get("Endpoint", ""), data.get("Status") or {})
+
+    @property
+    def is_leader(self):
+        return self.member_id != 0 and self.member_id == self.leader_id
+
+    @property
+    def fragmentation(self):
+        """The fraction of the backend database that is free space."""
+        if not self.db_size or not self.db_size_in_use:
+            return 0.0
+        return max(0.0, 1.0 - float(self.db_size_in_use) / self.db_size)
+
+    def __repr__(self):
+        return "EndpointStatus({}, member={:x}, leader={:x}, raft_index={})".format(
+            self.endpoint, self.member_id, self.leader_id, self.raft_index
+        )
+
+
+class Alarm:
+    """An alarm raised on a member, as reported by `alarm list`."""
+
+    __slots__ = ("member_id", "name")
+
+    # etcdctl prints the alarm type as its protobuf enum number, the gateway
+    # as its name.
+    TYPES = {0: "NONE", 1: "NOSPACE", 2: "CORRUPT"}
+
+    def __init__(self, member_id, name):
+        self.member_id = member_id
+        self.name = name
+
+    @classmethod
+    def from_json(cls, data):
+        alarm = data.get("alarm", 0)
+        return cls(_uint(data.get("memberID")), cls.TYPES.get(alarm, alarm))
+
+    def __repr__(self):
+        return "Alarm({:x}, {})".format(self.member_id, self.name)
+
+
+class EndpointHealth:
+    """The health of one endpoint as reported by `endpoint health`."""
+
+    __slots__ = ("endpoint", "healthy", "took", "error")
+
+    def __init__(self, endpoint, healthy, took=None, error=""):
+        self.endpoint = endpoint
+        self.healthy = healthy
+        self.took = took
+        self.error = error
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data.get("endpoint", ""),
+            bool(data.get("health", False)),
+            parse_duration(data.get("took")),
+            data.get("error", ""),
+        )
+
+    @classmethod
+    def from_text(cls, line):
+        """Parse a line of `endpoint health` text output, or return None if
+        it is not one."""
+        match = _HEALTH_RE.match(line.strip())
+        if not match:
+            return None
+        endpoint, health, detail = match.groups()
+        if health == "healthy":
+            _, _, took = detail.partition("took = ")
+            return cls(endpoint, True, parse_duration(took))
+        return cls(endpoint, False, error=detail)
+
+    def __str__(self):
+        if self.healthy:
+            return "{} is healthy: took {}".format(self.endpoint, self.took)
+        return "{} is unhealthy: {}".format(self.endpoint, self.error)
+
+    def __repr__(self):
+        return "EndpointHealth({}, healthy={})".format(self.endpoint, self.healthy)
+
+
+class ClusterProbe:
+    """The combined health and status of every member of the cluster, as
+    gathered by EtcdCtl.probe_cluster."""
+
+    __slots__ = ("members", "health", "status", "unreachable")
+
+    def __init__(self, members):
+        self.members = members
+        self.health = []
+        self.status = []
+        self.unreachable = []
+
+    @property
+    def healthy(self):
+        return (
+            bool(self.health)
+            and not self.unreachable
+            and all(endpoint.healthy for endpoint in self.health)
+        )
+
+    @property
+    def leader(self):
+        """The member that is the current raft leader, if known."""
+        leader_ids = {s.leader_id for s in self.status if s.leader_id}
+        for member in self.members:
+            if member.id in leader_ids:
+                return member
+        return None
+
+    @property
+    def raft_lag(self):
+        """How far, in raft entries, the slowest member trails the fastest."""
+        indexes = [s.raft_index for s in self.status]
+        return max(indexes) - min(indexes) if indexes else 0
+
+    @property
+    def max_db_size(self):
+        return max((s.db_size for s in self.status), default=0)
+
+    @property
+    def slowest(self):
+        """The EndpointHealth record with the highest latency."""
+        timed = [h for h in self.health if h.took is not None]
+        return max(timed, key=lambda h: h.took, default=None)
@@ -0,0 +1,127 @@
+from charms.leadership import leader_get, leader_set
+
+from etcd_rolling import acknowledge, acknowledgement
+from uuid import uuid4
+import json
+import time
+
+# Leader data key holding the parallel restore in progress:
+#
+#     {"id": "<uuid>", "phase": "stop", "requested": 1700000000.0,
+#      "initial_cluster": "etcd0=https://...:2380,...", "token": "<uuid>",
+#      "sha256": "<sha256 of the snapshot resource>"}
+#
+# A restore goes through its phases in order, every unit acting on each:
+#
+#  - stop: every member checks its snapshot resource matches, stops etcd and
+#    sets ACK_KEY=<id> on its side of the cluster peer relation. The leader
+#    stops too, so no member accepts writes the restore would discard.
+#  - restore: once every member acknowledged, the leader restores its own
+#    data and publishes this phase, upon which every other member restores
+#    with the same initial cluster and token. Each then starts etcd.
+#  - abort: a member did not stop within STOP_TIMEOUT, or the leader failed
+#    to restore. Every member starts etcd again on its existing data.
+#
+# Members acknowledge the restore and abort phases too, with ACK_KEY set to
+# <id>:<phase> once they started etcd again. The leader clears LEADER_KEY
+# when all of them did, or STOP_TIMEOUT after publishing the phase.
+LEADER_KEY = "parallel_restore"
+ACK_KEY = "parallel-restore"
+
+# Seconds the leader waits for every member to act on a phase: to stop before
+# it aborts, and to start again before it clears the restore
+STOP_TIMEOUT = 600
+
+
+class ParallelRestore:
+    """A leader-driven restore of the same snapshot on every member."""
+
+    STOP = "stop"
+    RESTORE = "restore"
+    ABORT = "abort"
+
+    def __init__(
+        self,
+        id,
+        initial_cluster,
+        token,
+        sha256,
+        phase="stop",
+        requested=0,
+        advanced=0,
+    ):
+        self.id = id
+        self.initial_cluster = initial_cluster
+        self.token = token
+        self.sha256 = sha256
+        self.phase = phase
+        self.requested = requested
+        self.advanced = advanced
+
+    @classmethod
+    def load(cls):
+        """Return the restore in progress, or None."""
+        data = leader_get(LEADER_KEY)
+        if not data:
+            return None
+        return cls(**json.loads(data))
+
+    @classmethod
+    def start(cls, initial_cluster, sha256):
+        """Publish a new restore of the snapshot with the given checksum,
+        asking every member to stop, and replacing any restore in progress."""
+        restore = cls(uuid4().hex, initial_cluster, uuid4().hex, sha256)
+        restore.requested = time.time()
+        restore.save()
+        return restore
+
+    def save(self):
+        leader_set({LEADER_KEY: json.dumps(vars(self))})
+
+    def advance(self, phase):
+        """Move every member on to the next phase."""
+        self.phase = phase
+        self.advanced = time.time()
+        self.save()
+
+    @staticmethod
+    def clear():
+        """Forget the restore once every member is done with it."""
+        leader_set({LEADER_KEY: None})
+
+    @property
+    def peer_urls(self):
+        """The peer URL of every member of the restored cluster, by name."""
+        return dict(e.split("=", 1) for e in self.initial_cluster.split(","))
+
+    @property
+    def _ack(self):
+        # What members acknowledge the current phase with
+        if self.phase == self.STOP:
+            return self.id
+        return "{}:{}".format(self.id, self.phase)
+
+    def acknowledged(self, unit):
+        """Whether the unit has acted on the current phase of this restore."""
+        return acknowledgement(unit, ACK_KEY) == self._ack
+
+    def acknowledge(self):
+        """Tell the leader this unit has acted on the current phase: stopped
+        etcd, or started it again after the restore or abort."""
+        acknowledge(self._ack, ACK_KEY)
+
+    def pending(self, units):
+        """The units, out of the given ones, that are members of the restored
+        cluster and have not acted on the current phase yet."""
+        members = self.peer_urls
+        return [
+            unit
+            for unit in units
+            if unit.replace("/", "") in members and not self.acknowledged(unit)
+        ]
+
+    def expired(self, now=None):
+        """Whether the members had longer than STOP_TIMEOUT to act on the
+        current phase."""
+        since = self.advanced or self.requested
+        return (now or time.time()) - since > STOP_TIMEOUT
@@ -0,0 +1,159 @@
+from charmhelpers.core.hookenv import log
+
+import os
+import random
+import time
+
+# Wall-clock seconds since this module was imported, which is early in the
+# hook, after which no more etcd calls are made. Everything the hook does
+# counts, not only the time spent in etcd calls: a hook that got this far
+# stops dialing etcd instead of blocking until juju kills it. Actions are
+# not limited by it: they run operations the operator asked for, like a
+# snapshot or a defrag, with timeouts of their own.
+HOOK_BUDGET = 300
+
+# Consecutive failures after which an endpoint is no longer dialed for the
+# rest of the hook.
+BREAKER_THRESHOLD = 3
+
+_HOOK_START = time.monotonic()
+
+
+class FailFast(Exception):
+    """Errors that retrying cannot fix within this hook."""
+
+
+class BudgetExhausted(FailFast):
+    pass
+
+
+class CircuitOpen(FailFast):
+    pass
+
+
+class RetryExhausted(Exception):
+    pass
+
+
+def remaining_budget():
+    """Seconds left of HOOK_BUDGET since the hook started."""
+    if os.environ.get("JUJU_ACTION_NAME"):
+        return float("inf")
+    return HOOK_BUDGET - (time.monotonic() - _HOOK_START)
+
+
+def reset_budget():
+    """Start a fresh time budget. Long-running processes that call etcd in
+    rounds, rather than once per hook, call this at the start of each."""
+    global _HOOK_START
+    _HOOK_START = time.monotonic()
+
+
+def bounded_timeout(timeout):
+    """Clamp a per-call timeout to the remaining hook budget, raising
+    BudgetExhausted once the budget is spent."""
+    remaining = remaining_budget()
+    if remaining <= 0:
+        raise BudgetExhausted("hook time budget of {}s exhausted".format(HOOK_BUDGET))
+    return min(timeout, remaining)
+
+
+class CircuitBreaker:
+    """Track consecutive failures per endpoint. Once an endpoint has failed
+    threshold times in a row the circuit opens and further calls to it fail
+    immediately; a success closes it again."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD):
+        self.threshold = threshold
+        self.failures = {}
+
+    def check(self, endpoint):
+        """Raise CircuitOpen if the endpoint should not be dialed."""
+        if self.failures.get(endpoint, 0) >= self.threshold:
+            raise CircuitOpen(
+                "{} failed {} times, not retrying in this hook".format(
+                    endpoint, self.failures[endpoint]
+                )
+            )
+
+    def record_failure(self, endpoint):
+        self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+
+    def record_success(self, endpoint):
+        self.failures.pop(endpoint, None)
+
+    def reset(self):
+        self.failures.clear()
+
+
+# Shared by every client in the hook process.
+BREAKER = CircuitBreaker()
+
+
+def backoff_delays(base=0.5, cap=10, factor=2):
+    """Yield exponentially growing delays with full jitter: the n-th delay is
+    drawn uniformly from [0, min(cap, base * factor ** n)], which spreads
+    units that started retrying at the same time."""
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(cap, base * factor**attempt))
+        attempt += 1
+
+
+def retry(
+    func,
+    deadline=60,
+    attempts=None,
+    base=0.5,
+    cap=10,
+    retry_on=Exception,
+    until=None,
+    describe=None,
+):
+    """Call func until it succeeds, sleeping with exponential backoff and
+    jitter between attempts, and return its result.
+
+    @params deadline - total seconds to keep retrying, also limited by the
+    hook time budget
+    @params attempts - optional maximum number of calls
+    @params retry_on - exception class (or tuple) that triggers a retry; any
+    other exception, and FailFast errors, propagate immediately
+    @params until - optional predicate on the result; a result it rejects is
+    retried like a failure
+    @params describe - what is being attempted, for the log
+
+    Raises RetryExhausted, chained to the last error, when out of attempts
+    or time.
+    """
+    describe = describe or getattr(func, "__name__", "operation")
+    deadline = time.monotonic() + min(deadline, max(remaining_budget(), 0))
+    delays = backoff_delays(base, cap)
+    attempt = 0
+    while True:
+        attempt += 1
+        error = None
+        try:
+            result = func()
+        except FailFast:
+            raise
+        except retry_on as e:
+            error = e
+        else:
+            if until is None or until(result):
+                return result
+
+        delay = next(delays)
+        out_of_attempts = attempts is not None and attempt >= attempts
+        if out_of_attempts or time.monotonic() + delay > deadline:
+            msg = "{} failed after {} attempt{}".format(
+                describe, attempt, "s" if attempt != 1 else ""
+            )
+            log(msg, "ERROR")
+            raise RetryExhausted(msg) from error
+        log(
+            "{} failed (attempt {}), retrying in {:.1f}s".format(
+                describe, attempt, delay
+            ),
+            "WARNING",
+        )
+        time.sleep(delay)
@@ -0,0 +1,116 @@
+from charms.leadership import leader_get, leader_set
+from charmhelpers.core.hookenv import (
+    local_unit,
+    related_units,
+    relation_get,
+    relation_ids,
+    relation_set,
+)
+
+from uuid import uuid4
+import json
+
+# Leader data key holding the current plan:
+#
+#     {"id": "<uuid>", "queue": ["etcd/1", "etcd/2", "etcd/0"]}
+#
+# The unit at the head of the queue is the only one allowed to restart. When
+# it is back up it sets ACK_KEY=<id> on its side of the cluster peer relation.
+# The leader then waits until the cluster is healthy and caught up before it
+# pops the unit, which hands the turn to the next one. The leader goes last.
+LEADER_KEY = "rolling_restart"
+ACK_KEY = "rolling-restart"
+PEER_RELATION = "cluster"
+
+# How many raft entries the slowest member may trail the fastest one before
+# the next member is allowed to restart.
+MAX_RAFT_LAG = 100
+
+
+def peer_units():
+    """Return the names of the other units on the cluster peer relation."""
+    return sorted(
+        {unit for rid in relation_ids(PEER_RELATION) for unit in related_units(rid)}
+    )
+
+
+def acknowledgement(unit, key=ACK_KEY):
+    """Return the id of the last plan the unit acknowledged, if any."""
+    for rid in relation_ids(PEER_RELATION):
+        ack = relation_get(key, unit=unit, rid=rid)
+        if ack:
+            return ack
+    return None
+
+
+def acknowledge(plan_id, key=ACK_KEY):
+    """Tell the leader this unit has restarted for the given plan."""
+    for rid in relation_ids(PEER_RELATION):
+        relation_set(rid, {key: plan_id})
+
+
+def caught_up(probe):
+    """Whether a ClusterProbe shows a cluster that can afford to lose
+    another member to a restart."""
+    return probe.healthy and probe.raft_lag <= MAX_RAFT_LAG
+
+
+class RollingRestart:
+    """A leader-driven plan to restart every member, one at a time."""
+
+    def __init__(self, id, queue):
+        self.id = id
+        self.queue = list(queue)
+
+    @classmethod
+    def load(cls):
+        """Return the plan in progress, or None."""
+        data = leader_get(LEADER_KEY)
+        if not data:
+            return None
+        return cls(**json.loads(data))
+
+    @classmethod
+    def start(cls, units):
+        """Publish a new plan restarting the given units and then the
+        leader, replacing any plan in progress."""
+        leader = local_unit()
+        plan = cls(uuid4().hex, sorted(set(units) - {leader}) + [leader])
+        plan.save()
+        return plan
+
+    def save(self):
+        if self.queue:
+            leader_set({LEADER_KEY: json.dumps({"id": self.id, "queue": self.queue})})
+        else:
+            leader_set({LEADER_KEY: None})
+
+    @property
+    def current(self):
+        """The unit whose turn it is to restart."""
+        return self.queue[0] if self.queue else None
+
+    def done(self, unit):
+        """Whether the unit has restarted for this plan."""
+        return acknowledgement(unit) == self.id
+
+    def advance(self):
+        """Hand the turn to the next unit, finishing the plan after the
+        last one."""
+        self.queue.pop(0)
+        self.save()
+
+    def reconcile(self, units):
+        """Adjust the plan after membership or leadership changes: drop
+        units that left the peer relation and keep the current leader,
+        which may have taken over mid-plan, at the end of the queue.
+        Returns True if the queue changed."""
+        leader = local_unit()
+        queue = [u for u in self.queue if u in units and u != leader]
+        if leader in self.queue:
+            queue.append(leader)
+        if queue == self.queue:
+            return False
+        self.queue = queue
+        self.save()
+        return True
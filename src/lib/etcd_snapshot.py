@@ -0,0 +1,247 @@
+from contextlib import contextmanager
+from subprocess import PIPE, Popen, check_call
+from threading import Thread
+import gzip
+import hashlib
+import os
+import shutil
+import tarfile
+import zlib
+
+# Archive file extension for each supported compression codec.
+CODECS = {
+    "gzip": ".tar.gz",
+    "zstd": ".tar.zst",
+    "none": ".tar",
+}
+DEFAULT_CODEC = "gzip"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# snapshot save appends the sha256 of the database to it. etcd recognises the
+# hash by the file size: the database itself is a whole number of 512 byte
+# blocks.
+HASH_SIZE = hashlib.sha256().digest_size
+
+ETCDCTL = "/snap/bin/etcdctl"
+
+# Large enough to keep syscall overhead low on multi-GB databases.
+CHUNK_SIZE = 1024 * 1024
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class DigestWriter:
+    """Write-only file wrapper that hashes and counts everything written
+    through it, so an archive's checksum and size are known as soon as it
+    has been written, without reading it back."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+
+@contextmanager
+def compressor(codec, fp):
+    """Yield a writable stream that compresses into fp with the codec."""
+    if codec == "gzip":
+        with gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=6) as stream:
+            yield stream
+    elif codec == "zstd":
+        # zstd uses every core with -T0; its output is pumped into fp from a
+        # thread so the digest still sees every byte in a single pass.
+        proc = Popen(["zstd", "-q", "-T0", "-c", "-"], stdin=PIPE, stdout=PIPE)
+        pump = Thread(target=shutil.copyfileobj, args=(proc.stdout, fp, CHUNK_SIZE))
+        pump.start()
+        try:
+            yield proc.stdin
+        finally:
+            proc.stdin.close()
+            pump.join()
+            if proc.wait() != 0:
+                raise SnapshotError("zstd exited with {}".format(proc.returncode))
+    elif codec == "none":
+        yield fp
+    else:
+        raise SnapshotError(
+            "Unknown compression {}, expected one of {}".format(
+                codec, ", ".join(sorted(CODECS))
+            )
+        )
+
+
+def archive_name(prefix, codec):
+    """Return the archive file name for the codec."""
+    if codec not in CODECS:
+        raise SnapshotError("Unknown compression {}".format(codec))
+    return prefix + CODECS[codec]
+
+
+def write_archive(path, members, codec=DEFAULT_CODEC):
+    """Stream the given files or directories into a tar archive at path,
+    compressed with codec, reading each source once.
+
+    @params members - dict mapping archive names to paths on disk
+    Returns (size in bytes, sha256 hex digest) of the written archive.
+    """
+    with open(path, "wb") as fp:
+        out = DigestWriter(fp)
+        with compressor(codec, out) as stream:
+            with tarfile.open(fileobj=stream, mode="w|", bufsize=CHUNK_SIZE) as tar:
+                for arcname, source in members.items():
+                    tar.add(source, arcname=arcname)
+    return out.size, out.sha256
+
+
+@contextmanager
+def decompressor(path):
+    """Yield a readable stream of the tar data in an archive written by
+    write_archive, detecting its codec from the leading magic bytes."""
+    with open(path, "rb") as fp:
+        magic = fp.read(len(ZSTD_MAGIC))
+    with open(path, "rb") as fp:
+        if magic.startswith(GZIP_MAGIC):
+            with gzip.GzipFile(fileobj=fp, mode="rb") as stream:
+                yield stream
+        elif magic == ZSTD_MAGIC:
+            proc = Popen(["zstd", "-q", "-d", "-c"], stdin=fp, stdout=PIPE)
+            try:
+                yield proc.stdout
+            finally:
+                proc.stdout.close()
+                if proc.poll() is None:
+                    # Stopped reading early, e.g. once the db was found
+                    proc.terminate()
+                    proc.wait()
+                elif proc.returncode != 0:
+                    raise SnapshotError("zstd exited with {}".format(proc.returncode))
+        else:
+            yield fp
+
+
+def _copy_db(src, dest):
+    """Copy a snapshot db from src to dest, checking the hash snapshot save
+    appended to it on the way. Returns True if the hash was present and
+    valid, False if there was none."""
+    digest = hashlib.sha256()
+    tail = b""
+    size = 0
+    with open(dest, "wb") as out:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            out.write(chunk)
+            size += len(chunk)
+            # Hash everything but the trailing bytes that may be the hash
+            data = tail + chunk
+            digest.update(data[:-HASH_SIZE])
+            tail = data[-HASH_SIZE:]
+    if size % 512 != HASH_SIZE:
+        return False
+    if digest.digest() != tail:
+        raise SnapshotError("snapshot db failed its sha256 integrity check")
+    return True
+
+
+def extract_db(archive, dest):
+    """Stream the db of a v3 snapshot archive to dest in a single pass,
+    verifying its integrity hash while reading.
+
+    Returns True if the db carried a valid hash, False if it had none (a copy
+    of a member's db file rather than a snapshot), or None if the archive has
+    no db at all, as is the case for v2 backups. Raises SnapshotError if the
+    hash does not match or the archive cannot be read.
+    """
+    try:
+        with decompressor(archive) as stream:
+            with tarfile.open(fileobj=stream, mode="r|", bufsize=CHUNK_SIZE) as tar:
+                for member in tar:
+                    if member.isfile() and os.path.normpath(member.name) == "db":
+                        return _copy_db(tar.extractfile(member), dest)
+    except (tarfile.TarError, gzip.BadGzipFile, zlib.error, EOFError) as e:
+        raise SnapshotError("{} is not a snapshot archive: {}".format(archive, e))
+    return None
+
+
+def swap_dir(new, current):
+    """Replace the directory current with new. Both must be on the same
+    filesystem so each step is an atomic rename, and current is never left
+    partially written."""
+    old = current + ".pre-restore"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(current):
+        os.rename(current, old)
+    os.rename(new, current)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def restore_archive(archive, data_dir, name, initial_cluster, token, peer_url):
+    """Restore the v3 snapshot in archive as the member dir of data_dir for
+    the member called name. The db is streamed out of the archive once and
+    verified on the way.
+
+    Every member of a cluster restored from the same snapshot must use the
+    same initial_cluster and token. Returns the result of extract_db: None
+    means the archive holds no v3 db and nothing was restored.
+    """
+    return restore_db(
+        lambda db: extract_db(archive, db),
+        data_dir,
+        name,
+        initial_cluster,
+        token,
+        peer_url,
+    )
+
+
+def restore_db(extract, data_dir, name, initial_cluster, token, peer_url):
+    """Restore a v3 snapshot db as the member dir of data_dir. extract(path)
+    writes the db to path and returns True if it was verified, False if it
+    could not be, or None if there is no db to restore.
+
+    The db is restored into a staging dir inside data_dir and swapped in
+    with renames, so the final step never crosses filesystems. Returns the
+    result of extract.
+    """
+    staging = os.path.join(data_dir, "restore-{}".format(os.getpid()))
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        db = os.path.join(staging, "db")
+        verified = extract(db)
+        if verified is None:
+            return None
+        # The hash was checked while extracting, or there is none
+        cmd = [
+            ETCDCTL,
+            "snapshot",
+            "restore",
+            db,
+            "--skip-hash-check",
+            "--data-dir={}".format(os.path.join(staging, "data")),
+            "--initial-cluster={}".format(initial_cluster),
+            "--initial-cluster-token={}".format(token),
+            "--initial-advertise-peer-urls={}".format(peer_url),
+            "--name={}".format(name),
+        ]
+        check_call(cmd, env=dict(os.environ, ETCDCTL_API="3"))
+        swap_dir(
+            os.path.join(staging, "data", "member"), os.path.join(data_dir, "member")
+        )
+        return verified
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
@@ -1,10 +1,146 @@
 from charms import layer
+from charmhelpers.core.hookenv import atexit
+from charmhelpers.core.hookenv import config
 from charmhelpers.core.hookenv import log
-from subprocess import CalledProcessError
+from charmhelpers.core import unitdata
+from concurrent.futures import ThreadPoolExecutor, wait
+from copy import deepcopy
+from functools import lru_cache, wraps
+from subprocess import CalledProcessError, TimeoutExpired
 from subprocess import check_output, run
-from typing import Optional
+from packaging.version import Version
+from typing import List, Optional
+import json
+import math
 import os
+import re
+import threading
+import yaml
+from etcd_gateway import (
+    DEFAULT_ENDPOINT,
+    READY_TIMEOUT,
+    EtcdGateway,
+    GatewayError,
+)
 from etcd_lib import build_uri
+from etcd_profile import profiled, timed
+from etcd_retry import (
+    BREAKER,
+    BudgetExhausted,
+    CircuitOpen,
+    FailFast,
+    RetryExhausted,
+    bounded_timeout,
+    retry,
+)
+from etcd_records import (
+    Alarm,
+    ClusterProbe,
+    EndpointHealth,
+    EndpointStatus,
+    Member,
+)
+
+
+ETCD_SNAP_DIR = "/snap/etcd/current"
+# Seconds allowed for probing every member of the cluster
+PROBE_TIMEOUT = 10
+# Seconds etcdctl may spend connecting to an endpoint, and on a whole command
+DIAL_TIMEOUT = 2
+COMMAND_TIMEOUT = 10
+# Seconds to wait for a raft leadership transfer to be confirmed
+TRANSFER_TIMEOUT = 10
+# etcdctl has no way to disable --command-timeout, so commands run without a
+# timeout get one longer than any of them could take
+UNBOUNDED_COMMAND_TIMEOUT = "8760h"
+# Seconds a member may spend defragmenting; it serves no requests meanwhile
+DEFRAG_TIMEOUT = 300
+# etcdctl errors meaning the endpoint could not be reached at all
+UNREACHABLE_ERRORS = (
+    "context deadline exceeded",
+    "connection refused",
+    "no route to host",
+    "i/o timeout",
+    "connection reset",
+    "Unavailable",
+)
+
+# Results of read-only calls, shared by every EtcdCtl instance for the
+# lifetime of the hook process and dropped when the membership changes.
+_CACHE = {}
+_CACHE_STATS = {"hits": 0, "misses": 0}
+# probe_cluster reads through the cache from several threads at once
+_CACHE_LOCK = threading.Lock()
+
+
+def _report_cache_stats():
+    log(
+        "EtcdCtl cache: {hits} hits, {misses} misses".format(**_CACHE_STATS),
+        "DEBUG",
+    )
+
+
+def _failed(result):
+    """Whether a result reports a member it could not get a healthy answer
+    from, which a retry within the same hook should see afresh."""
+    return isinstance(result, list) and any(
+        isinstance(r, EndpointHealth) and not r.healthy for r in result
+    )
+
+
+def memoized(method):
+    """Cache the result of a read-only EtcdCtl method for the rest of the
+    hook, keyed by method name, backend and arguments (which carry the
+    endpoint). Errors and unhealthy results are not cached."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # The timeout of a call does not change its result
+        options = tuple(sorted(i for i in kwargs.items() if i[0] != "timeout"))
+        backend = "etcdctl" if self.native is None else "native"
+        key = (method.__name__, backend, args, options)
+        with _CACHE_LOCK:
+            if key in _CACHE:
+                _CACHE_STATS["hits"] += 1
+                return deepcopy(_CACHE[key])
+            if not any(_CACHE_STATS.values()):
+                atexit(_report_cache_stats)
+            _CACHE_STATS["misses"] += 1
+        result = method(self, *args, **kwargs)
+        if not _failed(result):
+            with _CACHE_LOCK:
+                _CACHE[key] = deepcopy(result)
+        return result
+
+    return wrapper
+
+
+def invalidates(method):
+    """Drop all cached results once a mutating EtcdCtl method has run,
+    whether or not it succeeded."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            EtcdCtl.invalidate_cache()
+
+    return wrapper
+
+
+def _command_name(ctl, arguments, *args, **kwargs):
+    """Name an EtcdCtl.run call by its etcdctl subcommand, e.g. "member list",
+    for profiling."""
+    if isinstance(arguments, str):
+        arguments = arguments.split()
+    words = []
+    for arg in arguments:
+        # Stop at flags, member ids, names and paths
+        if len(words) == 2 or not arg.replace("-", "").isalpha():
+            break
+        words.append(arg)
+    return " ".join(words)
 
 
 def etcdctl_command():
@@ -19,42 +155,118 @@ class EtcdCtl:
     registration, cluster health, and other operations"""
 
     class CommandFailed(Exception):
-        pass
+        def __init__(self, output="", stderr=""):
+            super().__init__()
+            self.output = output
+            # etcdctl prints its errors here, the native client in output
+            self.stderr = stderr
+
+    class CircuitOpen(CommandFailed, FailFast):
+        """The endpoint is not dialed, either because it kept failing or
+        because the hook has run out of time for etcd calls."""
+
+    def __init__(self, backend=None):
+        """@params backend - "etcdctl" to fork the etcdctl binary, or "native"
+        to talk to the v3 JSON gateway over a pooled mutual-TLS connection.
+        Defaults to the client_backend charm config option."""
+        if backend is None:
+            backend = config("client_backend")
+        self.native = None
+        if backend == "native":
+            self.native = self._gateway()
+
+    @staticmethod
+    def _gateway():
+        opts = layer.options("tls-client")
+        return EtcdGateway(
+            opts["ca_certificate_path"],
+            opts["server_certificate_path"],
+            opts["server_key_path"],
+        )
 
+    @staticmethod
+    def invalidate_cache():
+        """Forget every cached read, e.g. after restarting the local member."""
+        with _CACHE_LOCK:
+            _CACHE.clear()
+
+    @staticmethod
+    def cache_stats():
+        """Return the cache hit and miss counters for this hook."""
+        with _CACHE_LOCK:
+            return dict(_CACHE_STATS)
+
+    def wait_until_ready(self, endpoint=DEFAULT_ENDPOINT, timeout=READY_TIMEOUT):
+        """Block until the member serving endpoint accepts connections and
+        reports healthy, returning the seconds waited. Works with either
+        backend, as /health predates the v3 gateway."""
+        gateway = self.native or self._gateway()
+        try:
+            waited = gateway.wait_until_ready(endpoint, timeout)
+        except GatewayError as e:
+            log(str(e), "ERROR")
+            raise EtcdCtl.CommandFailed(str(e)) from e
+        log("{} ready after {:.1f}s".format(endpoint, waited))
+        return waited
+
+    def _native_call(self, method, *args):
+        """Invoke a method of the native backend, surfacing its errors as
+        CommandFailed like the etcdctl backend does."""
+        try:
+            with timed("native", method):
+                return getattr(self.native, method)(*args)
+        except GatewayError as e:
+            log("Native etcd client {} failed: {}".format(method, e), "ERROR")
+            raise EtcdCtl.CommandFailed(str(e)) from e
+
+    @invalidates
     def register(self, cluster_data):
-        """Perform self registration against the etcd leader and returns the
-        raw output response.
+        """Perform self registration against the etcd leader and return the
+        initial cluster string the new member must start with.
 
         @params cluster_data - a dict of data to fill out the request to
         push our registration to the leader
         requires keys: leader_address, port, unit_name, cluster_address,
         management_port
         """
+        if self.native:
+            try:
+                return self._native_call("register", cluster_data)
+            except EtcdCtl.CommandFailed:
+                log("Notice:  Unit failed self registration", "WARNING")
+                raise
+
         # Build a connection string for the cluster data.
         connection = get_connection_string(
             [cluster_data["cluster_address"]], cluster_data["management_port"]
         )
 
-        command = "member add {} {}".format(cluster_data["unit_name"], connection)
+        command = [
+            "member",
+            "add",
+            cluster_data["unit_name"],
+            "--peer-urls={}".format(connection),
+            "--write-out=json",
+        ]
 
         try:
-            result = self.run(command, endpoints=cluster_data["leader_address"], api=2)
+            result = self.run(command, endpoints=cluster_data["leader_address"])
         except EtcdCtl.CommandFailed:
             log("Notice:  Unit failed self registration", "WARNING")
             raise
 
-        # ['Added member named etcd12 with ID b9ab5b5a2e4baec5 to cluster',
-        # '', 'ETCD_NAME="etcd12"',
-        #  'ETCD_INITIAL_CLUSTER="etcd11=https://10.113.96.26:2380,etcd12=https://10.113.96.206:2380"',  # noqa
-        # 'ETCD_INITIAL_CLUSTER_STATE="existing"', '']
-
-        reg = {}
-
-        for line in result.split("\n"):
-            if "ETCD_INITIAL_CLUSTER=" in line:
-                reg["cluster"] = line.split('="')[-1].rstrip('"')
-        return reg
-
+        resp = json.loads(result)
+        new_id = resp.get("member", {}).get("ID")
+        cluster = []
+        for member in resp.get("members", []):
+            name = member.get("name", "")
+            if member.get("ID") == new_id:
+                name = cluster_data["unit_name"]
+            for url in member.get("peerURLs", []):
+                cluster.append("{}={}".format(name, url))
+        return {"cluster": ",".join(cluster)}
+
+    @invalidates
     def unregister(self, unit_id, leader_address=None):
         """Perform self deregistration during unit teardown
 
@@ -64,43 +276,23 @@ class EtcdCtl:
         @params leader_address - The endpoint to communicate with the leader in
         the event of self deregistration.
         """
-        return self.run(["member", "remove", unit_id], endpoints=leader_address, api=2)
-
-    def member_list(self, leader_address=None):
-        """Returns the output from `etcdctl member list` as a python dict
-        organized by unit_name, containing all the data-points in the resulting
-        response."""
-        command = "member list"
-
-        members = {}
-        out = self.run(command, endpoints=leader_address, api=2)
-        raw_member_list = out.strip("\n").split("\n")
-        # Expect output like this:
-        # 4f24ee16c889f6c1: name=etcd20 peerURLs=https://10.113.96.197:2380 clientURLs=https://10.113.96.197:2379  # noqa
-        # edc04bb81479d7e8: name=etcd21 peerURLs=https://10.113.96.243:2380 clientURLs=https://10.113.96.243:2379  # noqa
-        # edc0dsa81479d7e8[unstarted]: peerURLs=https://10.113.96.124:2380  # noqa
-
-        for unit in raw_member_list:
-            if "[unstarted]" in unit:
-                unit_guid = unit.split("[")[0]
-                members["unstarted"] = {"unit_id": unit_guid}
-                if "peerURLs=" in unit:
-                    peer_urls = unit.split(" ")[1].split("=")[-1]
-                    members["unstarted"]["peer_urls"] = peer_urls
-                continue
-            unit_guid = unit.split(":")[0]
-            unit_name = unit.split(" ")[1].split("=")[-1]
-            peer_urls = unit.split(" ")[2].split("=")[-1]
-            client_urls = unit.split(" ")[3].split("=")[-1]
-
-            members[unit_name] = {
-                "unit_id": unit_guid,
-                "name": unit_name,
-                "peer_urls": peer_urls,
-                "client_urls": client_urls,
-            }
-        return members
+        if self.native:
+            return self._native_call("unregister", unit_id, leader_address)
+        return self.run(["member", "remove", unit_id], endpoints=leader_address)
+
+    @memoized
+    def member_list(self, leader_address=None) -> List[Member]:
+        """Returns the cluster members as a list of Member records, including
+        members that were added but have not started yet."""
+        if self.native:
+            return self._native_call("member_list", leader_address)
+        out = self.run("member list --write-out=json", endpoints=leader_address)
+        try:
+            return [Member.from_json(m) for m in json.loads(out).get("members", [])]
+        except ValueError as e:
+            raise EtcdCtl.CommandFailed(out) from e
 
+    @invalidates
     def member_update(self, unit_id, uri):
         """Update the etcd cluster member by unit_id with a new uri. This
         allows us to change protocol, address or port.
@@ -109,34 +301,246 @@ class EtcdCtl:
         contact the peer."""
         out = ""
         try:
-            command = "member update {} {}".format(unit_id, uri)
-            log(command)
+            if self.native:
+                self._native_call("member_update", unit_id, uri)
+                return out
+            command = ["member", "update", unit_id, "--peer-urls={}".format(uri)]
+            log(" ".join(command))
             # Run the member update command for the existing unit_id.
             out = self.run(command)
         except EtcdCtl.CommandFailed:
             log("Failed to update member {}".format(unit_id), "WARNING")
         return out
 
-    def cluster_health(self, output_only=False):
-        """Returns the output of etcdctl cluster-health as a python dict
-        organized by topical information with detailed unit output"""
-        health = {}
+    @invalidates
+    def move_leader(self, unit_id, endpoints=None):
+        """Transfer raft leadership to the member with the hex unit_id. The
+        request must be sent to the current leader."""
+        if self.native:
+            return self._native_call("move_leader", unit_id, endpoints)
+        return self.run(["move-leader", unit_id], endpoints=endpoints)
+
+    def transfer_leadership(self, endpoint=DEFAULT_ENDPOINT, timeout=TRANSFER_TIMEOUT):
+        """If the member serving endpoint is the raft leader, hand leadership
+        to the most caught up healthy follower and wait until the member
+        reports the new leader. Call this before a planned stop of the
+        member. Returns the new leader's Member record, or None if no
+        transfer was needed or possible. Raises CommandFailed if the
+        transfer could not be confirmed."""
+        local = self.endpoint_status(endpoint)[0]
+        if not local.is_leader:
+            return None
+        probe = self.probe_cluster()
+        healthy = {h.endpoint for h in probe.health if h.healthy}
+        followers = [
+            s
+            for s in probe.status
+            if s.member_id != local.member_id
+            and not s.is_learner
+            and s.endpoint in healthy
+        ]
+        if not followers:
+            log("No healthy follower to hand raft leadership to", "WARNING")
+            return None
+        target = max(followers, key=lambda s: (s.raft_applied_index, s.raft_index))
+        member = next(m for m in probe.members if m.id == target.member_id)
+        log("Moving raft leadership to {}".format(member.name or member.unit_id))
+        self.move_leader(member.unit_id, endpoint)
+
+        def leader_id():
+            EtcdCtl.invalidate_cache()
+            return self.endpoint_status(endpoint)[0].leader_id
+
         try:
-            out = self.run("cluster-health", endpoints=None, api=2)
-            if output_only:
-                return out
-            health_output = out.strip("\n").split("\n")
-            health["status"] = health_output[-1]
-            health["units"] = health_output[0:-2]
-        except EtcdCtl.CommandFailed:
-            log("Notice:  Unit failed cluster-health check", "WARNING")
-            health["status"] = "cluster is unhealthy see log file for details."
-            health["units"] = []
-        return health
+            retry(
+                leader_id,
+                deadline=timeout,
+                base=0.1,
+                cap=1,
+                retry_on=EtcdCtl.CommandFailed,
+                until=lambda leader: leader == member.id,
+                describe="Confirming raft leadership transfer",
+            )
+        except RetryExhausted as e:
+            raise EtcdCtl.CommandFailed(str(e)) from e
+        return member
+
+    def snapshot_save(self, path, endpoints=None, timeout=None):
+        """Save a consistent point-in-time snapshot of the backend database
+        of a single member to path. Always uses etcdctl, which streams the
+        snapshot over the maintenance API and verifies it before renaming
+        it into place.
+
+        Streaming a large database takes as long as it takes, so there is
+        no timeout unless one is given, beyond what is left of the hook
+        budget when called from a hook."""
+        return self.run(
+            ["snapshot", "save", path], endpoints=endpoints, timeout=timeout
+        )
 
-    def run(self, arguments, endpoints: Optional[str] = None, api=3):
+    def compact(self, revision, physical=False, endpoints=None):
+        """Discard the key history before revision. With physical, wait
+        until the compacted revisions are removed from the backend."""
+        if self.native:
+            return self._native_call("compact", revision, physical, endpoints)
+        command = ["compact", str(revision), "--physical={}".format(physical).lower()]
+        return self.run(command, endpoints=endpoints)
+
+    def alarm_list(self, endpoints=None) -> List[Alarm]:
+        """Returns the alarms raised in the cluster as Alarm records."""
+        if self.native:
+            return self._native_call("alarm_list", endpoints)
+        out = self.run(["alarm", "list", "--write-out=json"], endpoints=endpoints)
+        try:
+            return [Alarm.from_json(a) for a in json.loads(out).get("alarms") or []]
+        except ValueError as e:
+            raise EtcdCtl.CommandFailed(out) from e
+
+    def alarm_disarm(self, endpoints=None):
+        """Deactivate every alarm raised in the cluster."""
+        if self.native:
+            return self._native_call("alarm_disarm", endpoints)
+        return self.run(["alarm", "disarm"], endpoints=endpoints)
+
+    @invalidates
+    def defrag(self, endpoints=None, timeout=DEFRAG_TIMEOUT):
+        """Defragment the backend database of the members serving endpoints,
+        one after the other. Each member blocks reads and writes until it is
+        done. Always uses etcdctl, as a defrag easily outlasts the native
+        client's request timeout."""
+        return self.run(["defrag"], endpoints=endpoints, timeout=timeout)
+
+    def cluster_health(self) -> List[EndpointHealth]:
+        """Returns the health of every member of the cluster as a list of
+        EndpointHealth records. A member that cannot be queried at all is
+        reported as a single unhealthy record for the local endpoint."""
+        return self.endpoint_health(cluster=True)
+
+    def _member_endpoints(self, endpoints=None):
+        """The client URL of every started member, for etcdctl before 3.4
+        which has no --cluster flag."""
+        members = self.member_list(endpoints)
+        return ",".join(
+            m.client_urls[0] for m in members if m.started and m.client_urls
+        )
+
+    @memoized
+    def endpoint_health(
+        self, endpoints=None, cluster=False, timeout=COMMAND_TIMEOUT
+    ) -> List[EndpointHealth]:
+        """Returns the health of the given endpoints (or of every member when
+        cluster is True) as EndpointHealth records."""
+        if self.native:
+            try:
+                return self._native_call("endpoint_health", endpoints, cluster)
+            except EtcdCtl.CommandFailed:
+                log("Notice:  Unit failed endpoint health check", "WARNING")
+                return [EtcdCtl._unreachable(endpoints)]
+        legacy = not modern_etcdctl()
+        command = ["endpoint", "health"]
+        if legacy:
+            if cluster:
+                endpoints = self._member_endpoints(endpoints)
+        else:
+            command.append("--write-out=json")
+            if cluster:
+                command.append("--cluster")
+        try:
+            out = self.run(command, endpoints=endpoints, timeout=timeout)
+        except EtcdCtl.CommandFailed as e:
+            # etcdctl exits non-zero when any endpoint is unhealthy, but still
+            # reports every endpoint it checked.
+            out = e.output
+        try:
+            if legacy:
+                health = [EndpointHealth.from_text(line) for line in out.splitlines()]
+                health = [h for h in health if h]
+                if not health:
+                    raise ValueError("no endpoint health in output")
+                return health
+            return [EndpointHealth.from_json(h) for h in json.loads(out)]
+        except ValueError:
+            log("Notice:  Unit failed endpoint health check", "WARNING")
+            return [EtcdCtl._unreachable(endpoints)]
+
+    @memoized
+    def endpoint_status(
+        self, endpoints=None, cluster=False, timeout=COMMAND_TIMEOUT
+    ) -> List[EndpointStatus]:
+        """Returns the raft and backend status of the given endpoints (or of
+        every member when cluster is True) as EndpointStatus records."""
+        if self.native:
+            return self._native_call("endpoint_status", endpoints, cluster)
+        command = ["endpoint", "status", "--write-out=json"]
+        if cluster and not modern_etcdctl():
+            endpoints = self._member_endpoints(endpoints)
+        elif cluster:
+            command.append("--cluster")
+        out = self.run(command, endpoints=endpoints, timeout=timeout)
+        try:
+            return [EndpointStatus.from_json(s) for s in json.loads(out)]
+        except ValueError as e:
+            raise EtcdCtl.CommandFailed(out) from e
+
+    def probe_cluster(self, timeout=PROBE_TIMEOUT) -> ClusterProbe:
+        """Query endpoint health and status of every started member
+        concurrently, giving up on members that do not answer within
+        timeout seconds. Raises CommandFailed if the member list itself
+        cannot be retrieved."""
+        members = self.member_list()
+        endpoints = [m.client_urls[0] for m in members if m.started and m.client_urls]
+        probe = ClusterProbe(members)
+        if not endpoints:
+            return probe
+
+        # Each member gets two calls, which share the timeout. The native
+        # client is bounded by its own socket timeout.
+        call_timeout = timeout / 2
+
+        def _probe(endpoint):
+            health = self.endpoint_health(endpoint, timeout=call_timeout)
+            return health, self.endpoint_status(endpoint, timeout=call_timeout)
+
+        # Every call is bounded, so leaving the pool joins its threads soon
+        # after the deadline; a member that missed it counts as unreachable.
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as pool:
+            futures = {pool.submit(_probe, e): e for e in endpoints}
+            done, pending = wait(futures, timeout=timeout)
+        for future in done:
+            try:
+                health, status = future.result()
+            except EtcdCtl.CommandFailed:
+                probe.unreachable.append(futures[future])
+                continue
+            probe.health.extend(health)
+            probe.status.extend(status)
+        for future in pending:
+            log("Timed out probing {}".format(futures[future]), "WARNING")
+            probe.unreachable.append(futures[future])
+        return probe
+
+    @staticmethod
+    def _unreachable(endpoint=None):
+        return EndpointHealth(
+            endpoint or DEFAULT_ENDPOINT,
+            False,
+            error="cluster is unhealthy see log file for details.",
+        )
+
+    @profiled("etcdctl", _command_name)
+    def run(
+        self,
+        arguments,
+        endpoints: Optional[str] = None,
+        api=3,
+        timeout=COMMAND_TIMEOUT,
+    ):
         """Wrapper to subprocess calling output. This is a convenience
-        method to clean up the calls to subprocess and append TLS data"""
+        method to clean up the calls to subprocess and append TLS data.
+
+        Each call is limited to timeout seconds, or not at all if it is None,
+        further clamped to what is left of the hook-wide budget. Endpoints that keep failing to answer
+        trip a circuit breaker so later calls fail fast with CircuitOpen."""
         env = {}
         command = [etcdctl_command()]
         opts = layer.options("tls-client")
@@ -159,7 +563,7 @@ class EtcdCtl:
             raise NotImplementedError("etcd api version {} not supported".format(api))
 
         if not endpoints:
-            endpoints = "https://127.0.0.1:2379"
+            endpoints = DEFAULT_ENDPOINT
 
         if isinstance(arguments, str):
             command.extend(arguments.split())
@@ -170,38 +574,142 @@ class EtcdCtl:
                 "arguments not correct type; must be string, list or tuple"
             )
 
+        try:
+            BREAKER.check(endpoints)
+            timeout = bounded_timeout(math.inf if timeout is None else timeout)
+        except (CircuitOpen, BudgetExhausted) as e:
+            log("Not running {}: {}".format(command, e), "WARNING")
+            raise EtcdCtl.CircuitOpen() from e
+
+        # etcdctl takes whole seconds, and treats 0s as no timeout at all
+        dial_timeout = "{:.0f}s".format(max(1, min(DIAL_TIMEOUT, timeout)))
+        if math.isinf(timeout):
+            command_timeout = UNBOUNDED_COMMAND_TIMEOUT
+        else:
+            command_timeout = "{:.0f}s".format(max(1, timeout))
         if api == 3:
             command.extend(["--endpoints", endpoints])
+            command.append("--dial-timeout={}".format(dial_timeout))
+            command.append("--command-timeout={}".format(command_timeout))
         elif api == 2:
             command.insert(1, "--endpoint")
             command.insert(2, endpoints)
+            command.insert(3, "--timeout={}".format(dial_timeout))
+            command.insert(4, "--total-timeout={}".format(command_timeout))
+
+        # With --cluster etcdctl also dials every other member, so its errors
+        # may be about a remote member rather than the endpoints dialed here.
+        # Only failures that are about the dialed endpoints count towards
+        # their circuit breaker.
+        own_failure = "--cluster" not in command
 
         try:
-            proc = run(command, env=env, check=True, capture_output=True, text=True)
+            proc = run(
+                command,
+                env=env,
+                check=True,
+                capture_output=True,
+                text=True,
+                # let etcdctl report its own timeout before we kill it
+                timeout=None if math.isinf(timeout) else max(1, timeout) + 1,
+            )
+        except TimeoutExpired as e:
+            if own_failure:
+                BREAKER.record_failure(endpoints)
+            log("Timed out after {:.0f}s: {}".format(timeout, command), "ERROR")
+            raise EtcdCtl.CommandFailed() from e
         except CalledProcessError as e:
+            unreachable = any(error in (e.stderr or "") for error in UNREACHABLE_ERRORS)
+            if own_failure and unreachable:
+                BREAKER.record_failure(endpoints)
             log(command, "ERROR")
             log(env, "ERROR")
             log(e.stdout, "ERROR")
             log(e.stderr, "ERROR")
+            raise EtcdCtl.CommandFailed(e.stdout, e.stderr) from e
+        except OSError as e:
+            log("Unable to run {}: {}".format(command, e), "ERROR")
             raise EtcdCtl.CommandFailed() from e
 
+        BREAKER.record_success(endpoints)
+
         if proc.stderr.strip():
             log(command, "WARNING")
             log(env, "WARNING")
             log(proc.stderr, "WARNING")
         return proc.stdout
 
+    @memoized
     def version(self):
         """Return the version of etcdctl"""
-        out = check_output(
-            [etcdctl_command(), "version"], env={"ETCDCTL_API": "3"}
-        ).decode("utf-8")
-
-        if out == "No help topic for 'version'\n":
-            # Probably on etcd2
-            out = check_output([etcdctl_command(), "--version"]).decode("utf-8")
-
-        return out.split("\n")[0].split()[2]
+        return etcd_version()
+
+
+def snap_revision():
+    """Return the revision of the installed etcd snap, or None when the snap
+    is not installed."""
+    try:
+        return os.readlink(ETCD_SNAP_DIR)
+    except OSError:
+        return None
+
+
+def snap_version():
+    """Return the etcd version declared in the installed snap's metadata, or
+    None if it does not look like an etcd release version."""
+    try:
+        with open(os.path.join(ETCD_SNAP_DIR, "meta", "snap.yaml")) as fp:
+            meta = yaml.safe_load(fp)
+    except (OSError, yaml.YAMLError):
+        return None
+    match = re.match(r"^v?(\d+\.\d+\.\d+)", str(meta.get("version", "")))
+    return match.group(1) if match else None
+
+
+def probe_version():
+    """Return the version reported by the etcdctl binary itself."""
+    out = check_output([etcdctl_command(), "version"], env={"ETCDCTL_API": "3"}).decode(
+        "utf-8"
+    )
+
+    if "No help topic for 'version'" in out:
+        # Probably on etcd2
+        out = check_output([etcdctl_command(), "--version"]).decode("utf-8")
+
+    # "etcdctl version: 3.0.17" or "etcdctl version 2.3.8"
+    for line in out.splitlines():
+        if "etcdctl version" in line:
+            return line.split()[-1]
+    raise ValueError("Unable to find etcd version: {}".format(out))
+
+
+def etcd_version():
+    """Return the installed etcd version. The snap ships etcd and etcdctl in
+    lockstep, so the version is read from the snap metadata and remembered
+    per snap revision; etcdctl is only forked when the metadata is unusable."""
+    revision = snap_revision()
+    if revision is None:
+        return probe_version()
+
+    db = unitdata.kv()
+    cached = db.get("etcd.version") or {}
+    if cached.get("revision") == revision:
+        return cached["version"]
+
+    version = snap_version() or probe_version()
+    db.set("etcd.version", {"revision": revision, "version": version})
+    return version
+
+
+@lru_cache(maxsize=None)
+def modern_etcdctl():
+    """Whether etcdctl is 3.4 or later. Before that `endpoint health` only
+    prints text and the endpoint commands have no --cluster flag."""
+    try:
+        return Version(etcd_version()) >= Version("3.4")
+    except (ValueError, OSError, CalledProcessError):
+        # Not installed yet, the charm installs 3.4 or later by default
+        return True
 
 
 def get_connection_string(members, port, protocol="https"):
@@ -39,12 +39,33 @@ from charmhelpers.contrib.charmsupport import nrpe
 from charms.layer import status
 
 from etcdctl import EtcdCtl
+from etcdctl import etcd_version as installed_etcd_version
 from etcdctl import get_connection_string
+from etcdctl import etcdctl_command
 from etcd_databag import EtcdDatabag
+from etcd_collector import SERVICE as COLLECTOR_SERVICE
+from etcd_collector import SETTINGS as COLLECTOR_SETTINGS
+from etcd_backup import SETTINGS as SNAPSHOT_SETTINGS
+from etcd_backup import SNAPSHOT_UNIT_KEY
+from etcd_backup import TIMER as SNAPSHOT_TIMER
+from etcd_backup import cron_to_oncalendar, designate
+from etcd_profile import instrument_handlers
+from etcd_metrics import CHECKS as PERF_CHECKS
+from etcd_metrics import parse_thresholds
+from etcd_maintenance import remediate_nospace, rolling_defrag, scheduled_compaction
+from etcd_records import parse_duration
+from etcd_retry import retry, RetryExhausted
+from etcd_restore import ParallelRestore
+from etcd_rolling import RollingRestart, acknowledge, caught_up, peer_units
+from etcd_snapshot import CODECS, SnapshotError, restore_archive
 from etcd_lib import (
     build_uri,
+    changed_config_keys,
+    content_hash,
+    file_hash,
     get_ingress_address,
     get_ingress_addresses,
+    human_size,
     render_grafana_dashboard,
 )
 
@@ -58,11 +79,10 @@ import json
 import os
 import charms.leadership  # noqa
 import socket
-import time
+import sys
 import traceback
 import yaml
 import shutil
-import random
 
 
 # Layer Note:   the @when_not etcd.installed state checks are relating to
@@ -77,8 +97,32 @@ import random
 # default regex in charmhelpers doesn't allow periods, but nagios itself does.
 nrpe.Check.shortname_re = r"[\.A-Za-z0-9-_]+$"
 
+# Time every handler when the profiling config option is set.
+instrument_handlers()
+
 GRAFANA_DASHBOARD_NAME = "etcd"
 
+# Seconds to keep retrying cluster membership changes
+REJOIN_DEADLINE = 120
+UNREGISTER_DEADLINE = 30
+
+# Seconds the rolling restart waits for the cluster to catch up with a
+# restarted member before leaving it to the next hook
+CATCH_UP_DEADLINE = 60
+
+# Upper bound of the random delay systemd adds to each scheduled snapshot
+SNAPSHOT_STAGGER = 300
+# Hooks after which another unit may have to take the scheduled snapshots:
+# leadership, membership or the schedule changed, or the raft leader moved,
+# which update-status catches up with
+DESIGNATE_SNAPSHOT_HOOKS = (
+    "leader-elected",
+    "config-changed",
+    "cluster-relation-joined",
+    "cluster-relation-departed",
+    "update-status",
+)
+
 register_trigger(when_not="endpoint.grafana.joined", clear_flag="grafana.configured")
 register_trigger(
     when_not="endpoint.prometheus.joined", clear_flag="prometheus.configured"
@@ -116,26 +160,44 @@ def snap_upgrade_notice():
 @when_not("upgrade.series.in-progress")
 def check_cluster_health():
     """report on the cluster health every 5 minutes"""
+    if etcd_version().startswith("2."):
+        # The charm talks to etcd over the v3 API only
+        status.blocked("etcd 2.x is not supported, upgrade to etcd 3.")
+        return
     etcdctl = EtcdCtl()
-    health = etcdctl.cluster_health()
 
-    # Determine if the unit is healthy or unhealthy
-    if "unhealthy" in health["status"]:
-        unit_health = "UnHealthy"
-    else:
-        unit_health = "Healthy"
-
-    # Determine units peer count, and surface 0 by default
+    # Probe every member at once; surface 0 peers if we cannot list them
     try:
-        peers = len(etcdctl.member_list())
-    except Exception:
-        unit_health = "Errored"
-        peers = 0
+        probe = etcdctl.probe_cluster()
+    except EtcdCtl.CommandFailed:
+        status.blocked("Errored with 0 known peers")
+        return
 
+    # Determine if the unit is healthy or unhealthy
+    unit_health = "Healthy" if probe.healthy else "UnHealthy"
+
+    peers = len(probe.members)
     bp = "{0} with {1} known peer{2}"
     status_message = bp.format(unit_health, peers, "s" if peers != 1 else "")
 
-    if unit_health in ["UnHealthy", "Errored"]:
+    details = []
+    if probe.leader:
+        details.append("leader {}".format(probe.leader.name or probe.leader.unit_id))
+    if probe.status:
+        details.append("raft lag {}".format(probe.raft_lag))
+        details.append("db {}".format(human_size(probe.max_db_size)))
+    if probe.slowest:
+        details.append("slowest {:.0f}ms".format(probe.slowest.took * 1000))
+    if probe.unreachable:
+        details.append("{} unreachable".format(len(probe.unreachable)))
+    if details:
+        status_message += " ({})".format(", ".join(details))
+
+    bag = EtcdDatabag()
+    problem = bag.management_port_problem or bag.quota_problem
+    if problem:
+        status.blocked(problem)
+    elif unit_health == "UnHealthy":
         status.blocked(status_message)
     else:
         status.active(status_message)
@@ -197,6 +259,7 @@ def remove_states():
 @hook("pre-series-upgrade")
 def pre_series_upgrade():
     bag = EtcdDatabag()
+    hand_off_leadership()
     host.service_pause(bag.etcd_daemon)
     status.blocked("Series upgrade in progress")
 
@@ -215,13 +278,18 @@ def post_series_upgrade():
     "config.changed.snapshot_count",
     "config.changed.election_timeout",
     "config.changed.heartbeat_interval",
+    "config.changed.auto_compaction_mode",
+    "config.changed.auto_compaction_retention",
+    "config.changed.quota_backend_bytes",
+    "config.changed.metrics_port",
+    "config.changed.metrics_scheme",
 )
 @when_not("etcd.installed")
 @when_not("upgrade.series.in-progress")
 def leader_config_changed():
     """The leader executes the runtime configuration update for the cluster,
-    as it is the controlling unit. Will render config, close and open ports and
-    restart the etcd service."""
+    as it is the controlling unit. Will render config and roll the restart of
+    the etcd service, which moves the ports, out over the cluster."""
     configuration = hookenv.config()
     previous_port = configuration.previous("port")
     log("Previous port: {0}".format(previous_port))
@@ -230,25 +298,20 @@ def leader_config_changed():
 
     if previous_port and previous_mgmt_port:
         bag = EtcdDatabag()
-        etcdctl = EtcdCtl()
-        members = etcdctl.member_list()
-        # Iterate over all the members in the list.
-        for unit_name in members:
-            # Grab the previous peer url and replace the management port.
-            peer_urls = members[unit_name]["peer_urls"]
-            log("Previous peer url: {0}".format(peer_urls))
-            old_port = ":{0}".format(previous_mgmt_port)
-            new_port = ":{0}".format(configuration.get("management_port"))
-            url = peer_urls.replace(old_port, new_port)
-            # Update the member's peer_urls with the new ports.
-            log(etcdctl.member_update(members[unit_name]["unit_id"], url))
+        if bag.management_port_problem:
+            # The peer URLs stay as they are, see check_cluster_health
+            status.blocked(bag.management_port_problem)
         # Render just the leaders configuration with the new values.
-        render_config()
+        changed = render_config(bag)
         address = get_ingress_address("cluster")
         leader_set(
             {"leader_address": get_connection_string([address], bag.management_port)}
         )
-        host.service_restart(bag.etcd_daemon)
+        if changed:
+            # Restart the members one at a time, the leader last, so the
+            # cluster keeps quorum while the change rolls out.
+            RollingRestart.start(peer_units())
+            advance_rolling_restart()
 
 
 @when("snap.installed.etcd")
@@ -259,12 +322,134 @@ def leader_config_changed():
     "config.changed.snapshot_count",
     "config.changed.election_timeout",
     "config.changed.heartbeat_interval",
+    "config.changed.auto_compaction_mode",
+    "config.changed.auto_compaction_retention",
+    "config.changed.quota_backend_bytes",
+    "config.changed.metrics_port",
+    "config.changed.metrics_scheme",
 )
 @when_not("etcd.installed")
 def follower_config_changed():
-    """Follower units need to render the configuration file, close and open
-    ports, and restart the etcd service."""
-    set_state("etcd.rerender-config")
+    """Follower units need to render the configuration file, but only restart
+    the etcd service, and move its ports, when the leader's rolling restart
+    gives them their turn."""
+    if render_config():
+        set_flag("etcd.restart-pending")
+
+
+@when("leadership.set.rolling_restart")
+@when("etcd.registered")
+@when_not("leadership.is_leader")
+@when_not("upgrade.series.in-progress")
+def rolling_restart_turn():
+    """Restart the local member when it is at the head of the leader's
+    rolling restart plan, then tell the leader it is back."""
+    plan = RollingRestart.load()
+    unit = hookenv.local_unit()
+    if not plan or plan.current != unit or plan.done(unit):
+        return
+    bag = EtcdDatabag()
+    if render_config(bag) or is_flag_set("etcd.restart-pending"):
+        log("Restarting for rolling restart {}".format(plan.id))
+        if not restart_and_wait(bag):
+            return
+    clear_flag("etcd.restart-pending")
+    acknowledge(plan.id)
+
+
+@when("leadership.set.rolling_restart")
+@when("leadership.is_leader")
+@when("etcd.registered")
+@when_not("upgrade.series.in-progress")
+def advance_rolling_restart():
+    """Hand the restart turn to the next unit once the previous one has
+    restarted and the cluster is healthy and caught up again. The leader
+    restarts itself last."""
+    plan = RollingRestart.load()
+    if not plan:
+        return
+    unit = hookenv.local_unit()
+    plan.reconcile(peer_units() + [unit])
+    while plan.current:
+        if plan.current != unit and not plan.done(plan.current):
+            log("Rolling restart waiting for {}".format(plan.current))
+            return
+        if not wait_for_catch_up():
+            log("Rolling restart waiting for the cluster to catch up")
+            return
+        if plan.current == unit:
+            bag = EtcdDatabag()
+            render_config(bag)
+            if not restart_and_wait(bag):
+                return
+            clear_flag("etcd.restart-pending")
+        plan.advance()
+    log("Rolling restart {} complete".format(plan.id))
+
+
+def wait_for_catch_up():
+    """Poll the cluster until it is healthy and caught up, for at most
+    CATCH_UP_DEADLINE seconds. Returns False if it did not get there."""
+
+    def probe():
+        EtcdCtl.invalidate_cache()
+        return EtcdCtl().probe_cluster()
+
+    try:
+        retry(
+            probe,
+            deadline=CATCH_UP_DEADLINE,
+            retry_on=EtcdCtl.CommandFailed,
+            until=caught_up,
+            describe="Waiting for the cluster to catch up",
+        )
+    except RetryExhausted:
+        return False
+    return True
+
+
+def hand_off_leadership():
+    """Before a planned stop or restart of the local member, move raft
+    leadership to a follower so the cluster does not sit out an election
+    timeout. A failed transfer never holds up the restart."""
+    try:
+        EtcdCtl().transfer_leadership()
+    except EtcdCtl.CommandFailed:
+        log("Could not transfer raft leadership before restart", "WARNING")
+
+
+def restart_etcd(bag):
+    """Restart the local member after handing off raft leadership, then
+    open the ports it now listens on."""
+    hand_off_leadership()
+    host.service_restart(bag.etcd_daemon)
+    open_configured_ports(bag)
+
+
+def open_configured_ports(bag):
+    """Open the client and metrics ports and close any port opened for a
+    previous configuration. Only called once etcd listens on the new ones."""
+    wanted = {port for port in (bag.port, bag.metrics_port) if port}
+    for opened in hookenv.opened_ports():
+        port, _, protocol = opened.partition("/")
+        if protocol == "tcp" and port.isdigit() and int(port) not in wanted:
+            log("Closing port {} etcd no longer listens on".format(port))
+            close_port(int(port))
+    for port in sorted(wanted):
+        open_port(port)
+
+
+def restart_and_wait(bag):
+    """Restart the local member and wait until it serves requests again.
+    Returns False if it did not come back in time."""
+    restart_etcd(bag)
+    EtcdCtl.invalidate_cache()
+    try:
+        EtcdCtl().wait_until_ready(bag.advertise_urls[0])
+    except EtcdCtl.CommandFailed:
+        status.waiting("Waiting for etcd to become ready after restart.")
+        return False
+    return True
 
 
 @when("snap.installed.etcd")
@@ -287,9 +472,8 @@ def rerender_config():
     """Config must be updated and service restarted"""
     bag = EtcdDatabag()
     log("Rendering config file for {0}".format(bag.unit_name))
-    render_config()
-    if host.service_running(bag.etcd_daemon):
-        host.service_restart(bag.etcd_daemon)
+    if render_config(bag) and host.service_running(bag.etcd_daemon):
+        restart_etcd(bag)
     set_app_version()
 
 
@@ -368,15 +552,13 @@ def send_cluster_details(proxy):
 
     # format a list of cluster participants
     etcdctl = EtcdCtl()
-    peers = etcdctl.member_list()
     cluster = []
-    for peer in peers:
-        thispeer = peers[peer]
+    for peer in etcdctl.member_list():
         # Potential member doing registration. Default to skip
-        if "peer_urls" not in thispeer.keys() or not thispeer["peer_urls"]:
+        if not peer.started:
             continue
-        peer_string = "{}={}".format(thispeer["name"], thispeer["peer_urls"])
-        cluster.append(peer_string)
+        for peer_url in peer.peer_urls:
+            cluster.append("{}={}".format(peer.name, peer_url))
 
     proxy.set_cluster_string(",".join(cluster))
 
@@ -393,6 +575,9 @@ def snap_install():
     channel = get_target_etcd_channel()
     snap.install("core")
     if channel:
+        if is_state("snap.installed.etcd"):
+            # Refreshing the snap restarts etcd
+            hand_off_leadership()
         snap.install("etcd", channel=channel, classic=False)
         remove_state("etcd.ssl.exported")
 
@@ -474,14 +659,13 @@ def register_node_with_leader(cluster):
         # Check if we are already registered. Unregister ourselves if we are so
         # we can register from scratch.
         peer_url = build_uri("https", bag.cluster_address, bag.management_port)
-        members = etcdctl.member_list(leader_address)
-        for _, member in members.items():
-            if member["peer_urls"] == peer_url:
+        for member in etcdctl.member_list(leader_address):
+            if peer_url in member.peer_urls:
                 log("Found member that matches our peer URL. Unregistering...")
-                etcdctl.unregister(member["unit_id"], leader_address)
+                etcdctl.unregister(member.unit_id, leader_address)
 
         # Now register.
-        resp = etcdctl.register(bag.__dict__)
+        resp = etcdctl.register(bag.context())
         bag.set_cluster(resp["cluster"])
     except EtcdCtl.CommandFailed:
         log("etcdctl.register failed, will retry")
@@ -491,7 +675,7 @@ def register_node_with_leader(cluster):
 
     render_config(bag)
     host.service_restart(bag.etcd_daemon)
-    open_port(bag.port)
+    open_configured_ports(bag)
     set_state("etcd.registered")
 
 
@@ -513,17 +697,23 @@ def initialize_new_leader():
     render_config(bag)
     host.service_restart(bag.etcd_daemon)
 
-    # sorry, some hosts need this. The charm races with systemd and wins.
-    time.sleep(2)
+    # The charm races with systemd, so wait for the member to come up
+    # before checking health.
+    EtcdCtl.invalidate_cache()
+    etcdctl = EtcdCtl()
+    try:
+        etcdctl.wait_until_ready(bag.advertise_urls[0])
+    except EtcdCtl.CommandFailed:
+        status.blocked("etcd did not become ready.")
+        return
 
     # Check health status before we say we are good
-    etcdctl = EtcdCtl()
-    status = etcdctl.cluster_health()
-    if "unhealthy" in status:
+    health = etcdctl.cluster_health()
+    if not all(endpoint.healthy for endpoint in health):
         status.blocked("Cluster not healthy.")
         return
     # We have a healthy leader, broadcast initial data-points for followers
-    open_port(bag.port)
+    open_configured_ports(bag)
     leader_connection_string = get_connection_string([address], bag.port)
     leader_set({"leader_address": leader_connection_string, "cluster": bag.cluster})
 
@@ -610,7 +800,7 @@ def tls_update():
     # ensure config is updated with new certs and service restarted
     bag = EtcdDatabag()
     render_config(bag)
-    host.service_restart(bag.etcd_daemon)
+    restart_etcd(bag)
 
     # ensure that certs are re-echoed to the db relations
     remove_state("etcd.ssl.placed")
@@ -672,14 +862,18 @@ def force_rejoin():
     etcd_data = os.path.join(conf.storage_path(), "member")
     if os.path.exists(etcd_data):
         shutil.rmtree(etcd_data)
-    for _ in range(11):
-        # We need randomized back-off timer because only one unit can be
-        # joining at the same time
-        time.sleep(random.randint(1, 10))
+
+    def rejoin():
         register_node_with_leader(None)
-        if is_flag_set("etcd.registered"):
-            log("Successfully rejoined the cluster")
-            break
+        return is_flag_set("etcd.registered")
+
+    # Only one unit can be joining at the same time, so the jittered
+    # back-off spreads out the units that were all asked to rejoin at once.
+    try:
+        retry(rejoin, deadline=REJOIN_DEADLINE, base=1, until=bool, describe="rejoin")
+        log("Successfully rejoined the cluster")
+    except RetryExhausted:
+        log("Failed to rejoin the cluster", "ERROR")
 
 
 @when("leadership.changed.force_rejoin")
@@ -689,6 +883,122 @@ def force_rejoin_requested():
     check_cluster_health()
 
 
+@when("leadership.changed.parallel_restore")
+@when_not("leadership.is_leader")
+def parallel_restore_requested():
+    """Take part in the leader's parallel restore: stop etcd when asked to,
+    then restore the snapshot resource with the cluster layout and token the
+    leader published once every member has stopped. Every phase acted on is
+    acknowledged, so the leader knows when it can clear the restore."""
+    restore = ParallelRestore.load()
+    if not restore:
+        return
+    bag = EtcdDatabag()
+    if restore.phase == ParallelRestore.ABORT:
+        log("Parallel restore {} aborted, starting etcd".format(restore.id))
+        host.service_start(bag.etcd_daemon)
+        restore.acknowledge()
+        return
+    member = bag.unit_name in restore.peer_urls
+    if restore.phase == ParallelRestore.STOP:
+        if not member:
+            return
+        archive = hookenv.resource_get("snapshot")
+        if not archive or file_hash(archive) != restore.sha256:
+            status.blocked("Snapshot resource does not match the leader's restore.")
+            return
+        status.maintenance("Stopped for snapshot restore.")
+        host.service_stop(bag.etcd_daemon)
+        restore.acknowledge()
+        return
+    if not member:
+        log("Not a member of the restored cluster, rejoining it instead")
+        force_rejoin()
+        return
+    if restore_snapshot(bag, restore):
+        start_restored(bag, restore)
+    else:
+        host.service_start(bag.etcd_daemon)
+    restore.acknowledge()
+
+
+@when("leadership.set.parallel_restore")
+@when("leadership.is_leader")
+def advance_parallel_restore():
+    """Restore the leader and then every other member once all of them
+    have stopped, or abort the restore if one does not stop in time. Clears
+    the restore once every member started etcd again."""
+    restore = ParallelRestore.load()
+    if not restore:
+        return
+    bag = EtcdDatabag()
+    pending = restore.pending(peer_units())
+    if restore.phase != ParallelRestore.STOP:
+        if pending and not restore.expired():
+            return
+        if pending:
+            log("{} did not report back from the restore".format(", ".join(pending)))
+        log("Parallel restore {} finished".format(restore.id))
+        restore.clear()
+        return
+    if pending and not restore.expired():
+        status.maintenance(
+            "Waiting for {} to stop for the restore.".format(", ".join(pending))
+        )
+        return
+    if pending:
+        log("{} did not stop for the restore".format(", ".join(pending)), "ERROR")
+        restore.advance(ParallelRestore.ABORT)
+        host.service_start(bag.etcd_daemon)
+        status.blocked("Restore aborted, {} did not stop.".format(", ".join(pending)))
+        return
+    host.service_stop(bag.etcd_daemon)
+    if not restore_snapshot(bag, restore):
+        restore.advance(ParallelRestore.ABORT)
+        host.service_start(bag.etcd_daemon)
+        return
+    restore.advance(ParallelRestore.RESTORE)
+    start_restored(bag, restore)
+
+
+def restore_snapshot(bag, restore):
+    """Restore the snapshot resource as the local member of the cluster the
+    parallel restore forms. etcd must be stopped. Returns False on failure,
+    leaving the existing data in place."""
+    archive = hookenv.resource_get("snapshot")
+    if not archive or file_hash(archive) != restore.sha256:
+        status.blocked("Snapshot resource does not match the leader's restore.")
+        return False
+    status.maintenance("Restoring snapshot.")
+    try:
+        verified = restore_archive(
+            archive,
+            bag.etcd_data_dir,
+            bag.unit_name,
+            restore.initial_cluster,
+            restore.token,
+            restore.peer_urls[bag.unit_name],
+        )
+    except (SnapshotError, CalledProcessError):
+        log("Snapshot restore failed:\n{}".format(traceback.format_exc()), "ERROR")
+        verified = None
+    if verified is None:
+        # The live member dir is only replaced once the restore succeeded
+        status.blocked("Snapshot restore failed.")
+        return False
+    return True
+
+
+def start_restored(bag, restore):
+    """Start the local member as part of the restored cluster."""
+    bag.set_cluster(restore.initial_cluster)
+    bag.set_cluster_state("existing")
+    render_config(bag)
+    host.service_start(bag.etcd_daemon)
+    set_state("etcd.registered")
+    log("Restored snapshot for restore {}".format(restore.id))
+
+
 @when("cluster-relation-broken")
 def cluster_relation_broken(cluster=None):
     perform_self_unregistration()
@@ -704,26 +1014,23 @@ def perform_self_unregistration(skip_exception=None):
     etcdctl = EtcdCtl()
     leader_address = leader_get("leader_address")
     unit_name = os.getenv("JUJU_UNIT_NAME").replace("/", "")
-    members = etcdctl.member_list()
-    # Self Unregistration
-    loop = 0
-    MAX_WAIT = 10
-    while loop < MAX_WAIT:
-        try:
-            etcdctl.unregister(members[unit_name]["unit_id"], leader_address)
-            break
-        except EtcdCtl.CommandFailed as ex:
-            # Randomized back-off timer to let cluster settle
-            loop = loop + 1
-            log("Trying to unregister self from the cluster failed, retrying...")
-            if loop == MAX_WAIT:
-                log(
-                    "All tries for unregistration failed! Switching status to blocked..."
-                )
-                status.blocked("Unregistration failed for the departing unit/s.")
-                if not skip_exception:
-                    raise Exception("All tries for unregistration failed") from ex
-            time.sleep(1)
+    members = [m for m in etcdctl.member_list() if m.name == unit_name]
+    if not members:
+        log("Unit {} is not a member of the cluster".format(unit_name))
+        return
+    # Self Unregistration, backing off to let the cluster settle
+    try:
+        retry(
+            lambda: etcdctl.unregister(members[0].unit_id, leader_address),
+            deadline=UNREGISTER_DEADLINE,
+            retry_on=EtcdCtl.CommandFailed,
+            describe="Unregistering self from the cluster",
+        )
+    except (RetryExhausted, EtcdCtl.CommandFailed) as ex:
+        log("All tries for unregistration failed! Switching status to blocked...")
+        status.blocked("Unregistration failed for the departing unit/s.")
+        if not skip_exception:
+            raise Exception("All tries for unregistration failed") from ex
 
 
 @hook("data-storage-attached")
@@ -755,6 +1062,7 @@ def format_and_mount_storage():
     check_call(cmd)
 
     # halt etcd to perform the data-store migration
+    hand_off_leadership()
     host.service_stop(bag.etcd_daemon)
 
     os.makedirs(tail, exist_ok=True)
@@ -828,7 +1136,18 @@ def initial_nrpe_config(nagios=None):
     update_nrpe_config(nagios)
 
 
-@when_any("config.changed.nagios_context", "config.changed.nagios_servicegroups")
+@when_any(
+    "config.changed.nagios_context",
+    "config.changed.nagios_servicegroups",
+    "config.changed.port",
+    "config.changed.metrics_port",
+    "config.changed.metrics_scheme",
+    "config.changed.nagios_wal_fsync_p99",
+    "config.changed.nagios_backend_commit_p99",
+    "config.changed.nagios_leader_changes",
+    "config.changed.nagios_proposals_failed",
+    "config.changed.nagios_db_size",
+)
 def force_update_nrpe_config():
     remove_state("etcd.nrpe.configured")
 
@@ -848,23 +1167,9 @@ def update_nrpe_config(unused=None):
     # add our first check, to alert on service failure
     nrpe.add_init_service_checks(nrpe_setup, services, current_unit)
 
-    # add the cron job to populate the cache for our second check
-    # (we cache the output of 'etcdctl alarm list' to minimise overhead)
-    with open("templates/check_etcd-alarms.cron") as fp:
-        write_file(
-            path="/etc/cron.d/check_etcd-alarms",
-            content=fp.read().encode(),
-            owner="root",
-            perms=0o644,
-        )
-
-    # create an empty output file for the above
-    write_file(
-        path="/var/lib/nagios/etcd-alarm-list.txt",
-        content="",
-        owner="root",
-        perms=0o644,
-    )
+    # run the collector that caches the alarm list for our second check
+    # (one resident process with a reused connection, not a cron job)
+    install_collector()
 
     # install the NRPE script for the above
     with open("templates/check_etcd-alarms.py") as fp:
@@ -882,6 +1187,32 @@ def update_nrpe_config(unused=None):
         "/usr/lib/nagios/plugins/check_etcd-alarms.py",
     )
 
+    # and the performance checks, fed from /metrics by the same collector
+    with open("templates/check_etcd-perf.py") as fp:
+        write_file(
+            path="/usr/lib/nagios/plugins/check_etcd-perf.py",
+            content=fp.read().encode(),
+            owner="root",
+            perms=0o755,
+        )
+    for metric, description in PERF_CHECKS.items():
+        shortname = "etcd-" + metric.replace("_", "-")
+        try:
+            thresholds = parse_thresholds(config("nagios_" + metric))
+        except ValueError as e:
+            log("Invalid nagios_{}: {}".format(metric, e), hookenv.WARNING)
+            thresholds = None
+        if thresholds is None:
+            nrpe_setup.remove_check(shortname=shortname)
+            continue
+        nrpe_setup.add_check(
+            shortname,
+            "Verify etcd {}".format(description),
+            "/usr/lib/nagios/plugins/check_etcd-perf.py {} -w {} -c {}".format(
+                metric, *thresholds
+            ),
+        )
+
     nrpe_setup.write()
     set_state("etcd.nrpe.configured")
 
@@ -901,6 +1232,59 @@ def remove_nrpe_config(nagios=None):
 
     for service in services:
         nrpe_setup.remove_check(shortname=service)
+    for metric in PERF_CHECKS:
+        nrpe_setup.remove_check(shortname="etcd-" + metric.replace("_", "-"))
+    remove_collector()
+
+
+def install_collector():
+    """Install and start the etcd-collector service feeding the NRPE
+    checks, replacing the cron job older revisions of the charm used."""
+    opts = layer.options("tls-client")
+    settings = {
+        "endpoint": "https://127.0.0.1:{}".format(config("port")),
+        "cacert": opts["ca_certificate_path"],
+        "cert": opts["client_certificate_path"],
+        "key": opts["client_key_path"],
+    }
+    bag = EtcdDatabag()
+    if bag.metrics_port:
+        settings["metrics_endpoint"] = build_uri(
+            bag.metrics_scheme, "127.0.0.1", bag.metrics_port
+        )
+    write_file(
+        COLLECTOR_SETTINGS, json.dumps(settings).encode(), owner="root", perms=0o600
+    )
+    service = COLLECTOR_SERVICE + ".service"
+    context = {
+        "python": sys.executable,
+        "lib_dir": os.path.join(hookenv.charm_dir(), "lib"),
+        "settings": COLLECTOR_SETTINGS,
+    }
+    render(service, os.path.join("/etc/systemd/system", service), context)
+    check_call(["systemctl", "daemon-reload"])
+    check_call(["systemctl", "enable", service])
+    # Pick up new settings or a new charm revision
+    host.service_restart(service)
+    for legacy in (
+        "/etc/cron.d/check_etcd-alarms",
+        "/var/lib/nagios/etcd-alarm-list.txt",
+    ):
+        if os.path.exists(legacy):
+            os.remove(legacy)
+
+
+def remove_collector():
+    """Stop and remove the etcd-collector service, if installed."""
+    service = COLLECTOR_SERVICE + ".service"
+    path = os.path.join("/etc/systemd/system", service)
+    if not os.path.exists(path):
+        return
+    check_call(["systemctl", "disable", "--now", service])
+    for stale in (path, COLLECTOR_SETTINGS):
+        if os.path.exists(stale):
+            os.remove(stale)
+    check_call(["systemctl", "daemon-reload"])
 
 
 @when("endpoint.prometheus.joined", "leadership.is_leader", "certificates.ca.available")
@@ -916,22 +1300,28 @@ def register_prometheus_jobs():
 
     peer_ips = cluster.get_db_ingress_addresses() if cluster else []
     peer_ips.append(get_ingress_address("db"))
-    targets = ["{}:{}".format(ip, config("port")) for ip in peer_ips]
-    cert = read_tls_cert("client.crt")
-    key = read_tls_cert("client.key")
-    ca = read_tls_cert("ca.crt")
+    # Scrape the dedicated metrics listener when there is one, so scrapes
+    # never compete with client traffic
+    bag = EtcdDatabag()
+    scheme, port = "https", config("port")
+    if bag.metrics_port:
+        scheme, port = bag.metrics_scheme, bag.metrics_port
+    targets = ["{}:{}".format(ip, port) for ip in peer_ips]
+    tls = {}
+    if scheme == "https":
+        tls["client_cert"] = read_tls_cert("client.crt")
+        tls["client_key"] = read_tls_cert("client.key")
+        tls["ca_cert"] = read_tls_cert("ca.crt")
     log("Configuring Prometheus scrape targets: {}".format(targets), DEBUG)
     prometheus.register_job(
         job_name="etcd",
         job_data={
-            "scheme": "https",
+            "scheme": scheme,
             "static_configs": [
                 {"targets": targets},
             ],
         },
-        ca_cert=ca,
-        client_cert=cert,
-        client_key=key,
+        **tls,
     )
     set_flag("prometheus.configured")
 
@@ -969,6 +1359,170 @@ def register_grafana_dashboard():
     set_flag("grafana.configured")
 
 
+@when("leadership.is_leader", "etcd.registered")
+@when_not("upgrade.series.in-progress")
+def compact_key_history():
+    """Compact the key history as compaction_retain_revisions and
+    compaction_window ask, from update-status."""
+    retain = config("compaction_retain_revisions")
+    window = config("compaction_window")
+    if not (retain or window) or hookenv.hook_name() != "update-status":
+        return
+    seconds = parse_duration(window) if window else 0
+    if seconds is None:
+        log("Invalid compaction_window {}".format(window), hookenv.ERROR)
+        return
+    try:
+        scheduled_compaction(EtcdCtl(), retain, seconds)
+    except EtcdCtl.CommandFailed as e:
+        log("Scheduled compaction failed: {}".format(e.output), hookenv.WARNING)
+
+
+@when("leadership.is_leader", "etcd.registered")
+@when_not("upgrade.series.in-progress")
+def remediate_nospace_alarm():
+    """Make the cluster writable again after a NOSPACE alarm, if
+    nospace_remediation is enabled, from update-status."""
+    if not config("nospace_remediation") or hookenv.hook_name() != "update-status":
+        return
+    try:
+        results = remediate_nospace(EtcdCtl(), EtcdDatabag().quota_backend_bytes)
+    except EtcdCtl.CommandFailed as e:
+        log("NOSPACE remediation failed: {}".format(e.output), hookenv.ERROR)
+        return
+    for name, before, after in results or []:
+        log(
+            "Defragmented {}: {} -> {}".format(
+                name, human_size(before), human_size(after)
+            )
+        )
+
+
+@when("leadership.is_leader", "etcd.registered")
+@when_not("leadership.set.rolling_restart")
+@when_not("upgrade.series.in-progress")
+def defrag_fragmented_members():
+    """Reclaim free space on members fragmented beyond defrag_threshold,
+    one member at a time, from update-status."""
+    threshold = config("defrag_threshold")
+    if not threshold or hookenv.hook_name() != "update-status":
+        return
+    try:
+        results = rolling_defrag(EtcdCtl(), threshold)
+    except EtcdCtl.CommandFailed as e:
+        log("Rolling defrag stopped: {}".format(e.output), hookenv.WARNING)
+        return
+    for name, before, after in results:
+        log(
+            "Defragmented {}: {} -> {}".format(
+                name, human_size(before), human_size(after)
+            )
+        )
+
+
+@when("leadership.is_leader", "etcd.registered")
+@when_not("upgrade.series.in-progress")
+def designate_snapshot_unit():
+    """Pick the unit that runs the scheduled snapshot timer, preferring a
+    raft follower so the leader is never slowed down by a snapshot. Only
+    after hooks that can change the choice, as it probes the cluster."""
+    if not config("snapshot_schedule"):
+        return
+    if hookenv.hook_name() not in DESIGNATE_SNAPSHOT_HOOKS:
+        return
+    units = peer_units() + [hookenv.local_unit()]
+    try:
+        leader = EtcdCtl().probe_cluster().leader
+    except EtcdCtl.CommandFailed:
+        leader = None
+    raft_leader = None
+    if leader:
+        for unit in units:
+            if unit.replace("/", "") == leader.name:
+                raft_leader = unit
+    current = leader_get(SNAPSHOT_UNIT_KEY)
+    unit = designate(units, current, raft_leader)
+    if unit != current:
+        log("Scheduled snapshots will be taken on {}".format(unit))
+        leader_set({SNAPSHOT_UNIT_KEY: unit})
+
+
+@when("snap.installed.etcd", "etcd.ssl.placed")
+@when_not("upgrade.series.in-progress")
+def configure_scheduled_snapshots():
+    """Install the snapshot timer on the designated unit and remove it
+    everywhere else."""
+    schedule = config("snapshot_schedule")
+    codec = config("snapshot_compression")
+    enabled = bool(schedule) and (leader_get(SNAPSHOT_UNIT_KEY) == hookenv.local_unit())
+    timer = {}
+    if enabled:
+        try:
+            timer["on_calendar"] = cron_to_oncalendar(schedule)
+        except ValueError as e:
+            log("Not scheduling snapshots: {}".format(e), hookenv.ERROR)
+            enabled = False
+        if codec not in CODECS:
+            log("Not scheduling snapshots: unknown compression " + codec, hookenv.ERROR)
+            enabled = False
+        if config("snapshot_format") not in ("archive", "chunks"):
+            log("Not scheduling snapshots: unknown snapshot_format", hookenv.ERROR)
+            enabled = False
+    if not enabled:
+        if data_changed("etcd.snapshot-schedule", None):
+            remove_snapshot_timer()
+        return
+
+    opts = layer.options("tls-client")
+    settings = {
+        "target": config("snapshot_target_dir"),
+        "compression": codec,
+        "format": config("snapshot_format"),
+        "retention_count": config("snapshot_retention_count"),
+        "retention_days": config("snapshot_retention_days"),
+        "etcdctl": etcdctl_command(),
+        "endpoint": "https://127.0.0.1:{}".format(config("port")),
+        "cacert": opts["ca_certificate_path"],
+        "cert": opts["client_certificate_path"],
+        "key": opts["client_key_path"],
+        "unit": hookenv.local_unit(),
+    }
+    timer.update(
+        randomized_delay=SNAPSHOT_STAGGER,
+        python=sys.executable,
+        lib_dir=os.path.join(hookenv.charm_dir(), "lib"),
+        settings=SNAPSHOT_SETTINGS,
+    )
+    if data_changed("etcd.snapshot-schedule", [settings, timer]):
+        install_snapshot_timer(settings, timer)
+
+
+def install_snapshot_timer(settings, context):
+    """Write the scheduled snapshot settings and systemd units, and start
+    the timer."""
+    write_file(
+        SNAPSHOT_SETTINGS, json.dumps(settings).encode(), owner="root", perms=0o600
+    )
+    for unit in (SNAPSHOT_TIMER + ".service", SNAPSHOT_TIMER + ".timer"):
+        render(unit, os.path.join("/etc/systemd/system", unit), context)
+    check_call(["systemctl", "daemon-reload"])
+    check_call(["systemctl", "enable", "--now", SNAPSHOT_TIMER + ".timer"])
+    log("Scheduled snapshots at {}".format(context["on_calendar"]))
+
+
+def remove_snapshot_timer():
+    """Stop and remove the scheduled snapshot timer, if installed."""
+    timer = "/etc/systemd/system/{}.timer".format(SNAPSHOT_TIMER)
+    if not os.path.exists(timer):
+        return
+    check_call(["systemctl", "disable", "--now", SNAPSHOT_TIMER + ".timer"])
+    for path in (timer, timer[: -len(".timer")] + ".service", SNAPSHOT_SETTINGS):
+        if os.path.exists(path):
+            os.remove(path)
+    check_call(["systemctl", "daemon-reload"])
+    log("Removed the scheduled snapshot timer")
+
+
 @when("snap.installed.etcd", "data.volume.attached")
 @when_not("snap.connected.removable_media")
 def snap_connect_external_storage():
@@ -997,75 +1551,59 @@ def unmount_path(location):
     check_call(cmd)
 
 
-def close_open_ports():
-    """Close the previous port and open the port from configuration."""
-    configuration = hookenv.config()
-    previous_port = configuration.previous("port")
-    port = configuration.get("port")
-    if previous_port is not None and previous_port != port:
-        log("The port changed; closing {0} opening {1}".format(previous_port, port))
-        close_port(previous_port)
-        open_port(port)
-
-
 def install(src, tgt):
     """This method wraps the bash "install" command"""
     return check_call(split("install {} {}".format(src, tgt)))
 
 
 def render_config(bag=None):
-    """Render the etcd configuration template for the given version"""
+    """Render the etcd configuration template for the given version. Returns
+    True if the configuration on disk changed, so callers only restart etcd
+    when it will pick up something new."""
     if not bag:
         bag = EtcdDatabag()
 
-    move_etcd_data_to_standard_location()
+    move_etcd_data_to_standard_location(bag)
 
     v2_conf_path = "{}/etcd.conf".format(bag.etcd_conf_dir)
     v3_conf_path = "{}/etcd.conf.yml".format(bag.etcd_conf_dir)
 
     # probe for 2.x compatibility
     if etcd_version().startswith("2."):
-        render("etcd2.conf", v2_conf_path, bag.__dict__, owner="root", group="root")
+        changed = render_if_changed("etcd2.conf", v2_conf_path, bag.context())
     # default to 3.x template behavior
     else:
-        render("etcd3.conf", v3_conf_path, bag.__dict__, owner="root", group="root")
+        changed = render_if_changed("etcd3.conf", v3_conf_path, bag.context())
         if os.path.exists(v2_conf_path):
             # v3 will fail if the v2 config is left in place
             os.remove(v2_conf_path)
-    # Close the previous client port and open the new one.
-    close_open_ports()
+            changed = True
     remove_state("etcd.rerender-config")
+    return changed
+
+
+def render_if_changed(source, target, context):
+    """Render a template, writing it to target only if its content hash
+    differs from the file already there. Returns True if it was written."""
+    content = render(source, None, context)
+    if content_hash(content) == file_hash(target):
+        log("{} is unchanged, not rewriting it".format(target), DEBUG)
+        return False
+    if os.path.exists(target):
+        with open(target) as fp:
+            keys = changed_config_keys(fp.read(), content)
+        log("{} changed: {}".format(target, ", ".join(keys) or "formatting only"))
+    else:
+        log("Creating {}".format(target))
+    write_file(target, content.encode("utf-8"), owner="root", group="root")
+    return True
 
 
 def etcd_version():
-    """This method surfaces the version from etcdctl"""
-    raw_output = None
+    """This method surfaces the version of the installed etcd"""
     try:
-        # try v3
-        raw_output = (
-            check_output(
-                ["/snap/bin/etcd.etcdctl", "version"], env={"ETCDCTL_API": "3"}
-            )
-            .decode("utf-8")
-            .strip()
-        )
-        if "No help topic for 'version'" in raw_output:
-            # handle v2
-            raw_output = (
-                check_output(["/snap/bin/etcd.etcdctl", "--version"])
-                .decode("utf-8")
-                .strip()
-            )
-        for line in raw_output.splitlines():
-            if "etcdctl version" in line:
-                # "etcdctl version: 3.0.17" or "etcdctl version 2.3.8"
-                version = line.split()[-1]
-                return version
-        hookenv.log(
-            "Unable to find etcd version: {}".format(raw_output), level=hookenv.ERROR
-        )
-        return "n/a"
-    except (ValueError, CalledProcessError):
+        return installed_etcd_version()
+    except (ValueError, OSError, CalledProcessError):
         hookenv.log(
             "Failed to get etcd version:\n" "{}".format(traceback.format_exc()),
             level=hookenv.ERROR,
@@ -1073,12 +1611,13 @@ def etcd_version():
         return "n/a"
 
 
-def move_etcd_data_to_standard_location():
+def move_etcd_data_to_standard_location(bag=None):
     """Moves etcd data to the standard location if it's not already located
     there. This is necessary when generating new etcd config after etcd has
     been upgraded from version 2.3 to 3.x.
     """
-    bag = EtcdDatabag()
+    if not bag:
+        bag = EtcdDatabag()
     conf_path = bag.etcd_conf_dir + "/etcd.conf.yml"
     if not os.path.exists(conf_path):
         return
@@ -2,29 +2,44 @@
 
 # Copyright (C) 2020 Canonical Ltd.
 
-import nagios_plugin3
-
+import json
+import time
 
-def load_alarm_list():
-    """Load the cached status from disk, return it as a string"""
-    alarm_list_path = "/var/lib/nagios/etcd-alarm-list.txt"
-
-    with open(alarm_list_path, "r") as alarm_list_log:
-        alarm_list = alarm_list_log.read()
+import nagios_plugin3
 
-    return alarm_list.strip()
+CACHE_PATH = "/var/lib/nagios/etcd-alarms.json"
+# The cache is stale once the collector missed this many rounds
+STALE_INTERVALS = 3
+
+
+def load_cache():
+    """Load the cache written by the etcd-collector service, raising
+    UnknownError if it is missing or stale."""
+    try:
+        with open(CACHE_PATH) as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError) as e:
+        raise nagios_plugin3.UnknownError("Cannot read {}: {}".format(CACHE_PATH, e))
+    age = time.time() - cache["timestamp"]
+    if age > STALE_INTERVALS * cache["interval"]:
+        raise nagios_plugin3.UnknownError(
+            "Alarm data is {:.0f}s old, is etcd-collector running?".format(age)
+        )
+    if cache["error"]:
+        raise nagios_plugin3.UnknownError(
+            "Cannot list alarms: {}".format(cache["error"])
+        )
+    return cache["data"]
 
 
 def check_alarms():
-    """Raise an error if the cached status contains any non-blank lines"""
-    alarms = []
-    alarm_list = load_alarm_list()
-    for line in alarm_list.splitlines():
-        line = line.strip()
-        if line:
-            alarms.append(line)
+    """Raise an error if any alarm is raised in the cluster"""
+    alarms = [
+        "{} on member {}".format(alarm["alarm"], alarm["member_id"])
+        for alarm in load_cache()
+    ]
     if alarms:
-        raise nagios_plugin3.CriticalError(" ".join(alarms))
+        raise nagios_plugin3.CriticalError(", ".join(alarms))
 
 
 def main():
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2020 Canonical Ltd.
+
+import argparse
+import json
+import time
+
+import nagios_plugin3
+
+CACHE_PATH = "/var/lib/nagios/etcd-metrics.json"
+# The cache is stale once the collector missed this many rounds
+STALE_INTERVALS = 3
+
+DESCRIPTIONS = {
+    "wal_fsync_p99": ("p99 WAL fsync", "{:.3f}s"),
+    "backend_commit_p99": ("p99 backend commit", "{:.3f}s"),
+    "leader_changes": ("leader changes", "{:.1f}/h"),
+    "proposals_failed": ("failed proposals", "{:.1f}/h"),
+    "db_size": ("db size", "{:.0%} of quota"),
+}
+
+
+def load_cache():
+    """Load the metrics summary written by the etcd-collector service,
+    raising UnknownError if it is missing or stale."""
+    try:
+        with open(CACHE_PATH) as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError) as e:
+        raise nagios_plugin3.UnknownError("Cannot read {}: {}".format(CACHE_PATH, e))
+    age = time.time() - cache["timestamp"]
+    if age > STALE_INTERVALS * cache["interval"]:
+        raise nagios_plugin3.UnknownError(
+            "Metrics are {:.0f}s old, is etcd-collector running?".format(age)
+        )
+    if cache["error"]:
+        raise nagios_plugin3.UnknownError(
+            "Cannot read metrics: {}".format(cache["error"])
+        )
+    return cache["data"]
+
+
+def check_metric(metric, warning, critical):
+    """Raise an error if the metric is above a threshold"""
+    data = load_cache()
+    label, fmt = DESCRIPTIONS[metric]
+    value = data.get(metric)
+    if value is None:
+        print("OK - no {} data in the last {}s".format(label, data.get("window")))
+        return
+    message = "{} is {} over {}s".format(label, fmt.format(value), data["window"])
+    perfdata = "{}={};{};{}".format(metric, value, warning, critical)
+    if value > critical:
+        raise nagios_plugin3.CriticalError("{} | {}".format(message, perfdata))
+    if value > warning:
+        raise nagios_plugin3.WarnError("{} | {}".format(message, perfdata))
+    print("OK - {} | {}".format(message, perfdata))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check etcd performance")
+    parser.add_argument("metric", choices=sorted(DESCRIPTIONS))
+    parser.add_argument("-w", "--warning", type=float, required=True)
+    parser.add_argument("-c", "--critical", type=float, required=True)
+    args = parser.parse_args()
+    nagios_plugin3.try_check(check_metric, args.metric, args.warning, args.critical)
+
+
+if __name__ == "__main__":
+    main()
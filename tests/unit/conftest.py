@@ -1,4 +1,27 @@
+import pytest
 import charms.unit_test
 
 charms.unit_test.patch_reactive()
 charms.unit_test.patch_module("charms.leadership")
+
+
+@pytest.fixture(autouse=True)
+def etcdctl_cache():
+    from etcdctl import EtcdCtl
+    from etcd_retry import BREAKER
+    from etcd_lib import cached_network_get
+    from etcdctl import modern_etcdctl
+    import etcd_profile
+
+    # Profiling is off unless a test turns it on
+    etcd_profile._ENABLED = False
+    etcd_profile._RECORDS.clear()
+    etcd_profile._FLUSH_REGISTERED = False
+    EtcdCtl.invalidate_cache()
+    BREAKER.reset()
+    cached_network_get.cache_clear()
+    modern_etcdctl.cache_clear()
+    yield
+    EtcdCtl.invalidate_cache()
+    BREAKER.reset()
+    cached_network_get.cache_clear()
@@ -0,0 +1,147 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+import etcd_backup
+from etcd_backup import (
+    cron_to_oncalendar,
+    designate,
+    expired,
+    load_index,
+    prune,
+    run,
+)
+
+
+@pytest.mark.parametrize(
+    "cron,spec",
+    [
+        ("@daily", "daily"),
+        ("30 2 * * *", "*-*-* 02:30:00"),
+        ("*/20 */6 * * *", "*-*-* 00,06,12,18:00,20,40:00"),
+        ("0 3 1 1-3 *", "*-01,02,03-01 03:00:00"),
+        ("0 4 * * 0,6,7", "Sun,Sat *-*-* 04:00:00"),
+        ("15 5/8 * * 1-5", "Mon,Tue,Wed,Thu,Fri *-*-* 05,13,21:15:00"),
+    ],
+)
+def test_cron_to_oncalendar(cron, spec):
+    assert cron_to_oncalendar(cron) == spec
+
+
+@pytest.mark.parametrize("cron", ["* * *", "60 * * * *", "0 0 0 * *", "a * * * *"])
+def test_cron_to_oncalendar_invalid(cron):
+    with pytest.raises(ValueError):
+        cron_to_oncalendar(cron)
+
+
+def test_designate_prefers_a_follower():
+    units = ["etcd/0", "etcd/1", "etcd/2"]
+    assert designate(units, raft_leader="etcd/0") == "etcd/1"
+    assert designate(units, "etcd/2", "etcd/0") == "etcd/2"
+    # The current unit became the raft leader
+    assert designate(units, "etcd/1", "etcd/1") == "etcd/0"
+    # The current unit left
+    assert designate(units[:2], "etcd/2", "etcd/0") == "etcd/1"
+    assert designate(["etcd/0"], raft_leader="etcd/0") == "etcd/0"
+
+
+def _entries(ages):
+    now = 100 * 86400
+    return now, [{"path": str(age), "started": now - age * 86400} for age in ages]
+
+
+def test_expired_by_count():
+    now, entries = _entries([3, 0, 1, 2])
+    assert [e["path"] for e in expired(entries, count=2, now=now)] == ["2", "3"]
+
+
+def test_expired_by_age_keeps_newest():
+    now, entries = _entries([10, 8, 1])
+    assert [e["path"] for e in expired(entries, days=7, now=now)] == ["8", "10"]
+    now, entries = _entries([10, 8])
+    assert [e["path"] for e in expired(entries, days=7, now=now)] == ["10"]
+
+
+def test_prune(tmp_path):
+    entries = []
+    for i in range(3):
+        path = tmp_path / "snap{}".format(i)
+        path.write_text("x")
+        entries.append({"path": str(path), "started": i})
+    # Removed by hand, forgotten without error
+    entries.append({"path": str(tmp_path / "gone"), "started": 3})
+    kept = prune(str(tmp_path), entries, count=3)
+    assert [e["started"] for e in kept] == [1, 2]
+    assert not (tmp_path / "snap0").exists()
+
+
+def test_run(tmp_path):
+    target = tmp_path / "snapshots"
+    settings = {
+        "target": str(target),
+        "compression": "none",
+        "retention_count": 2,
+        "etcdctl": "/snap/bin/etcd.etcdctl",
+        "endpoint": "https://127.0.0.1:2379",
+        "cacert": "ca.crt",
+        "cert": "client.crt",
+        "key": "client.key",
+        "unit": "etcd/1",
+    }
+
+    def snapshot_save(cmd, env, stdout):
+        assert env["ETCDCTL_CERT"] == "client.crt"
+        assert cmd[-3:-1] == ["snapshot", "save"]
+        with open(cmd[-1], "wb") as fp:
+            fp.write(b"bbolt")
+
+    with mock.patch.object(etcd_backup, "check_call", side_effect=snapshot_save):
+        # Start, end and the retention check of each run
+        clock = [1000, 1001, 1001, 2000, 2002, 2002, 3000, 3003, 3003]
+        with mock.patch("time.time", side_effect=clock):
+            for _ in range(3):
+                entry = run(settings)
+
+    assert entry["duration"] == 3
+    assert entry["unit"] == "etcd/1"
+    index = load_index(str(target))
+    assert index == json.loads((target / "index.json").read_text())
+    assert [e["started"] for e in index] == [2000, 3000]
+    assert sorted(p.name for p in target.glob("etcd-snapshot-*")) == sorted(
+        e["path"].rsplit("/", 1)[1] for e in index
+    )
+    assert not list(target.glob(".snapshot-*"))
+
+
+def test_run_chunked(tmp_path):
+    target = tmp_path / "snapshots"
+    settings = {
+        "target": str(target),
+        "format": "chunks",
+        "retention_count": 1,
+        "etcdctl": "/snap/bin/etcd.etcdctl",
+        "endpoint": "https://127.0.0.1:2379",
+        "cacert": "ca.crt",
+        "cert": "client.crt",
+        "key": "client.key",
+    }
+    dbs = iter([b"a" * 100000, b"b" * 100000])
+
+    def snapshot_save(cmd, env, stdout):
+        with open(cmd[-1], "wb") as fp:
+            fp.write(next(dbs))
+
+    with mock.patch.object(etcd_backup, "check_call", side_effect=snapshot_save):
+        # The chunk store also stamps each manifest
+        clock = [1000, 1000, 1001, 1001, 2000, 2000, 2001, 2001]
+        with mock.patch("time.time", side_effect=clock):
+            run(settings)
+            entry = run(settings)
+
+    assert entry["path"].endswith(".json")
+    assert load_index(str(target)) == [entry]
+    # The first backup's chunks went with its manifest
+    chunks = [f for _, _, files in os.walk(str(target / "chunks")) for f in files]
+    assert len(chunks) == 2
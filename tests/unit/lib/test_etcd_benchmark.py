@@ -0,0 +1,94 @@
+import pytest
+
+from etcd_benchmark import (
+    PREFIX,
+    check_perf_command,
+    parse_benchmark,
+    parse_check_perf,
+    prefix_end,
+    range_command,
+    run_prefix,
+)
+
+CHECK_PERF = """\
+ 60 / 60 Booooooooooooooooooooooooooooooooooooooooooooooooooooooo! 100.00% 1m0s
+PASS: Throughput is 151 writes/s
+PASS: Slowest request took 0.087420s
+PASS: Stddev is 0.011084s
+PASS
+"""
+
+CHECK_PERF_FAIL = """\
+FAIL: Throughput too low: 98 writes/s
+FAIL: Slowest request took too long: 0.601000s
+PASS: Stddev is 0.034000s
+FAIL
+"""
+
+BENCHMARK = """\
+
+Summary:
+  Total:\t1.6133 secs.
+  Slowest:\t0.0450 secs.
+  Fastest:\t0.0003 secs.
+  Average:\t0.0157 secs.
+  Stddev:\t0.0080 secs.
+  Requests/sec:\t6198.5042
+
+Response time histogram:
+  0.0003 [1]\t|
+  0.0048 [879]\t|∎∎∎∎∎∎
+
+Latency distribution:
+  10% in 0.0059 secs.
+  50% in 0.0155 secs.
+  99% in 0.0358 secs.
+  99.9% in 0.0432 secs.
+"""
+
+
+def test_run_prefix():
+    prefix = run_prefix()
+    assert prefix.startswith(PREFIX) and prefix.endswith("/")
+    assert prefix != run_prefix()
+    assert prefix_end("/charm-benchmark/abc/") == "/charm-benchmark/abc0"
+
+
+def test_check_perf_command():
+    assert check_perf_command("m", "/charm-benchmark/abc/") == [
+        "check",
+        "perf",
+        "--load=m",
+        "--prefix=/charm-benchmark/abc/",
+    ]
+    with pytest.raises(ValueError):
+        check_perf_command("xxl", "/charm-benchmark/abc/")
+
+
+def test_parse_check_perf():
+    assert parse_check_perf(CHECK_PERF) == {
+        "result": "PASS",
+        "throughput": 151,
+        "slowest": 0.08742,
+        "stddev": 0.011084,
+    }
+    result = parse_check_perf(CHECK_PERF_FAIL)
+    assert result["result"] == "FAIL"
+    assert result["throughput"] == 98
+    assert result["slowest"] == 0.601
+
+
+def test_range_command():
+    tls = {"cacert": "ca.crt", "cert": "server.crt", "key": "server.key"}
+    command = range_command("benchmark", "https://127.0.0.1:2379", tls, "s", "/p/")
+    assert command[-5:] == ["range", "/p/", "/p0", "--total=10000", "--consistency=l"]
+    assert "--cacert=ca.crt" in command
+
+
+def test_parse_benchmark():
+    result = parse_benchmark(BENCHMARK)
+    assert result["requests-per-sec"] == 6198.5042
+    assert result["average"] == 0.0157
+    assert result["p50"] == 0.0155
+    assert result["p99"] == 0.0358
+    assert result["p999"] == 0.0432
@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+from etcd_chunkstore import CHUNK_SIZE, ChunkStore, open_manifest
+from etcd_snapshot import SnapshotError
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkStore(str(tmp_path / "store"))
+
+
+def _db(path, pages):
+    """Write a db made of one CHUNK_SIZE block per byte in pages."""
+    path.write_bytes(b"".join(bytes([p]) * CHUNK_SIZE for p in pages) + b"tail")
+    return str(path)
+
+
+def test_put_deduplicates(tmp_path, store):
+    first = store.put(_db(tmp_path / "db1", [1, 2, 3, 1]), "first")
+    assert len(first["chunks"]) == 5
+    assert first["chunks"][0] == first["chunks"][3]
+    assert first["stored"] > 0
+    assert first["reused"] == CHUNK_SIZE
+
+    # Only the changed chunk is written again
+    second = store.put(_db(tmp_path / "db2", [1, 9, 3, 1]), "second")
+    assert 0 < second["stored"] < first["stored"]
+    assert second["reused"] == 3 * CHUNK_SIZE + len(b"tail")
+    assert store.names() == ["first", "second"]
+    chunks = [f for _, _, files in os.walk(store.chunk_dir) for f in files]
+    assert len(chunks) == 5
+
+
+def test_assemble(tmp_path, store):
+    db = _db(tmp_path / "db", [4, 5, 4])
+    store.put(db, "backup")
+    restored = tmp_path / "restored"
+    manifest = store.assemble("backup", str(restored))
+    assert restored.read_bytes() == open(db, "rb").read()
+    assert manifest["size"] == restored.stat().st_size
+
+
+def test_assemble_detects_corruption(tmp_path, store):
+    manifest = store.put(_db(tmp_path / "db", [1, 2]), "backup")
+    with open(store.chunk_path(manifest["chunks"][1]), "wb") as fp:
+        fp.write(b"garbage")
+    with pytest.raises(SnapshotError):
+        store.assemble("backup", str(tmp_path / "restored"))
+
+    os.remove(store.chunk_path(manifest["chunks"][1]))
+    with pytest.raises(SnapshotError):
+        store.assemble("backup", str(tmp_path / "restored"))
+
+
+def test_gc(tmp_path, store):
+    store.put(_db(tmp_path / "db1", [1, 2]), "first")
+    store.put(_db(tmp_path / "db2", [1, 3]), "second")
+    store.remove("first")
+    freed, size = store.gc()
+    assert freed == 1
+    assert size > 0
+    store.assemble("second", str(tmp_path / "restored"))
+
+
+def test_open_manifest(tmp_path, store):
+    store.put(_db(tmp_path / "db", [1]), "backup")
+    path = store.manifest_path("backup")
+    opened, name = open_manifest(path)
+    assert opened.root == store.root
+    assert name == "backup"
+    assert json.load(open(path))["name"] == "backup"
+    with pytest.raises(SnapshotError):
+        open_manifest(str(tmp_path / "db"))
@@ -0,0 +1,86 @@
+import json
+from subprocess import CalledProcessError
+from unittest import mock
+
+import pytest
+
+import etcd_collector
+from etcd_collector import MetricsCollector, cache_path, collect
+from etcd_gateway import GatewayError
+from etcd_records import Alarm
+
+
+def _settings(tmp_path):
+    return {
+        "endpoint": "https://127.0.0.1:2379",
+        "cache_dir": str(tmp_path),
+        "interval": 30,
+    }
+
+
+def test_collect_alarms(tmp_path):
+    gateway = mock.Mock()
+    gateway.alarm_list.return_value = [Alarm(0x8E9E05C52164694D, "NOSPACE")]
+    gateway.metrics.return_value = ""
+    collect(gateway, _settings(tmp_path), now=1000.0)
+    gateway.alarm_list.assert_called_once_with("https://127.0.0.1:2379")
+    with open(cache_path("alarms", str(tmp_path))) as fp:
+        cache = json.load(fp)
+    assert cache == {
+        "timestamp": 1000.0,
+        "interval": 30,
+        "data": [{"member_id": "8e9e05c52164694d", "alarm": "NOSPACE"}],
+        "error": None,
+    }
+
+
+def test_collect_alarms_with_etcdctl(tmp_path):
+    """etcd before 3.4 has no /v3 gateway, etcdctl lists the alarms then"""
+    gateway = mock.Mock(ca_path="ca.crt", cert_path="client.crt", key_path="key")
+    gateway.alarm_list.side_effect = GatewayError("HTTP 404 Not Found")
+    gateway.metrics.return_value = ""
+    out = json.dumps({"alarms": [{"memberID": 10276657743932975437, "alarm": 1}]})
+    with mock.patch.object(
+        etcd_collector, "check_output", return_value=out.encode()
+    ) as check_output:
+        collect(gateway, _settings(tmp_path), now=1000.0)
+    command = check_output.call_args[0][0]
+    assert "--endpoints=https://127.0.0.1:2379" in command
+    assert "--cacert=ca.crt" in command
+    assert command[-3:] == ["alarm", "list", "--write-out=json"]
+    with open(cache_path("alarms", str(tmp_path))) as fp:
+        cache = json.load(fp)
+    assert cache["data"] == [{"member_id": "8e9e05c52164694d", "alarm": "NOSPACE"}]
+
+
+def test_collect_error(tmp_path):
+    gateway = mock.Mock()
+    gateway.alarm_list.side_effect = GatewayError("connection refused")
+    gateway.metrics.side_effect = GatewayError("connection refused")
+    error = CalledProcessError(1, "etcdctl", b"", b"Error: connection refused")
+    with mock.patch.object(etcd_collector, "check_output", side_effect=error):
+        collect(gateway, _settings(tmp_path), now=1000.0)
+    with open(cache_path("alarms", str(tmp_path))) as fp:
+        cache = json.load(fp)
+    assert cache["data"] is None
+    assert cache["error"] == "etcdctl alarm list: Error: connection refused"
+    with open(cache_path("metrics", str(tmp_path))) as fp:
+        assert json.load(fp)["error"] == "connection refused"
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_metrics_collector_window():
+    clock = mock.Mock(side_effect=[0, 60, 120, 1000])
+    collector = MetricsCollector(window=900, clock=clock)
+    gateway = mock.Mock()
+    gateway.metrics.side_effect = [
+        "etcd_server_leader_changes_seen_total {}\n".format(n) for n in (1, 1, 2, 3)
+    ]
+    assert collector(gateway, "https://127.0.0.1:2379")["leader_changes"] is None
+    collector(gateway, "https://127.0.0.1:2379")
+    collector(gateway, "https://127.0.0.1:2379")
+    # The scrape at 60s is the newest one at least a window old
+    summary = collector(gateway, "https://127.0.0.1:2379")
+    assert summary["window"] == 940
+    assert summary["leader_changes"] == pytest.approx(2 * 3600 / 940)
+    assert len(collector.scrapes) == 3
@@ -47,7 +47,7 @@ def test_render_etcd2(
     config.set("snapshot_count", "auto")
     bag = etcd_databag.EtcdDatabag()
     template_env = Environment(loader=FileSystemLoader("src/templates"))
-    config = template_env.get_template("etcd2.conf").render(bag.__dict__)
+    config = template_env.get_template("etcd2.conf").render(bag.context())
     lines = config.splitlines()
     assert 'ETCD_ADVERTISE_CLIENT_URLS="https://[4001:84::1]:5678"' in lines
     assert (
@@ -68,9 +68,10 @@ def test_render_etcd3(
     config.set("bind_with_insecure_http", True)
     config.set("channel", "3.2/stable")
     config.set("snapshot_count", "auto")
+    config.set("auto_compaction_mode", "periodic")
     bag = etcd_databag.EtcdDatabag()
     template_env = Environment(loader=FileSystemLoader("src/templates"))
-    config = template_env.get_template("etcd3.conf").render(bag.__dict__)
+    config = template_env.get_template("etcd3.conf").render(bag.context())
     lines = config.splitlines()
     assert "advertise-client-urls: https://[4001:84::1]:5678" in lines
     assert (
@@ -78,3 +79,142 @@ def test_render_etcd3(
     )
     assert "listen-peer-urls: https://1.1.1.1:1234" in lines
     assert "initial-advertise-peer-urls: https://2.2.2.2:1234" in lines
+    # etcd 3.2 refuses to start with options it does not know
+    assert not [line for line in lines if line.startswith("auto-compaction")]
+    assert not [line for line in lines if line.startswith("listen-metrics-urls")]
+
+
+@pytest.mark.parametrize("channel", ["3.4/stable", "auto"])
+def test_render_etcd3_auto_compaction(config, bind_address, ingress_address, channel):
+    config.set("channel", channel)
+    config.set("snapshot_count", "auto")
+    config.set("auto_compaction_mode", "revision")
+    config.set("auto_compaction_retention", "1000")
+    bag = etcd_databag.EtcdDatabag()
+    with mock.patch("etcd_databag.etcd_version", return_value="3.4.22"):
+        template_env = Environment(loader=FileSystemLoader("src/templates"))
+        config = template_env.get_template("etcd3.conf").render(bag.context())
+    lines = config.splitlines()
+    assert "auto-compaction-mode: revision" in lines
+    assert "auto-compaction-retention: '1000'" in lines
+
+
+def test_etcd_3_3_or_later_with_auto_channel(config):
+    config.set("channel", "auto")
+    with mock.patch("etcd_databag.etcd_version", return_value="3.2.32"):
+        assert not etcd_databag.EtcdDatabag().etcd_3_3_or_later
+    with mock.patch("etcd_databag.etcd_version", side_effect=OSError):
+        assert etcd_databag.EtcdDatabag().etcd_3_3_or_later
+
+
+def test_render_etcd3_metrics_listener(config, bind_address, ingress_address):
+    config.set("port", 5678)
+    config.set("metrics_port", 9379)
+    config.set("metrics_scheme", "http")
+    config.set("channel", "3.4/stable")
+    config.set("snapshot_count", "auto")
+    bag = etcd_databag.EtcdDatabag()
+    template_env = Environment(loader=FileSystemLoader("src/templates"))
+    config = template_env.get_template("etcd3.conf").render(bag.context())
+    lines = config.splitlines()
+    assert (
+        "listen-metrics-urls: http://[2001:dc8::1]:9379,http://127.0.0.1:9379" in lines
+    )
+
+
+def test_metrics_port_needs_etcd_3_3(config):
+    config.set("metrics_port", 9379)
+    config.set("channel", "3.2/stable")
+    assert etcd_databag.EtcdDatabag().metrics_port == 0
+    config.set("channel", "3.3/stable")
+    assert etcd_databag.EtcdDatabag().metrics_port == 9379
+
+
+def test_settings_are_lazy(config, bind_address, ingress_address):
+    config.set("port", 5678)
+    bag = etcd_databag.EtcdDatabag()
+    ingress_address.assert_not_called()
+    bind_address.assert_not_called()
+    assert bag.cluster_address == "2.2.2.2"
+    assert bag.cluster_address == "2.2.2.2"
+    ingress_address.assert_called_once_with("cluster")
+    bind_address.assert_not_called()
+
+
+def test_context_includes_overrides(config, bind_address, ingress_address):
+    config.set("channel", "3.4/stable")
+    config.set("snapshot_count", "auto")
+    bag = etcd_databag.EtcdDatabag()
+    bag.cluster_state = "new"
+    bag.leader_address = "https://10.0.0.1:2379"
+    context = bag.context()
+    assert context["cluster_state"] == "new"
+    assert context["leader_address"] == "https://10.0.0.1:2379"
+    assert context["cluster_bind_address"] == "1.1.1.1"
+    assert context["build_uri"] is etcd_databag.build_uri
+    assert not any(key.startswith("_") for key in context)
+
+
+@pytest.fixture
+def large_db(tmp_path):
+    """A member whose db has outgrown etcd's 2GiB default quota, running
+    with an 8GiB quota, on a volume with 1GiB free."""
+    db = tmp_path / "data" / "member" / "snap" / "db"
+    db.parent.mkdir(parents=True)
+    with open(db, "wb") as fp:
+        fp.truncate(3 * 1024**3)
+    conf = tmp_path / "conf"
+    conf.mkdir()
+    (conf / "etcd.conf.yml").write_text("quota-backend-bytes: 8589934592\n")
+    with mock.patch("shutil.disk_usage", return_value=mock.Mock(free=1024**3)):
+        yield str(tmp_path / "data"), str(conf)
+
+
+@pytest.mark.parametrize("quota", [16 * 1024**3, 0, 1024**3])
+def test_quota_keeps_the_applied_quota(config, large_db, quota):
+    """A quota that does not fit never falls back to the 2GiB default"""
+    config.set("quota_backend_bytes", quota)
+    bag = etcd_databag.EtcdDatabag()
+    bag.etcd_data_dir, bag.etcd_conf_dir = large_db
+    assert bag.quota_problem
+    assert bag.quota_backend_bytes == 8 * 1024**3
+
+
+def test_quota_checked_only_when_changed(config, large_db):
+    config.set("quota_backend_bytes", 8 * 1024**3)
+    bag = etcd_databag.EtcdDatabag()
+    bag.etcd_data_dir, bag.etcd_conf_dir = large_db
+    with mock.patch("etcd_databag.quota_problem") as problem:
+        assert bag.quota_backend_bytes == 8 * 1024**3
+    problem.assert_not_called()
+    assert bag.quota_problem is None
+
+    config.set("quota_backend_bytes", 4 * 1024**3)
+    bag = etcd_databag.EtcdDatabag()
+    bag.etcd_data_dir, bag.etcd_conf_dir = large_db
+    assert bag.quota_problem is None
+    assert bag.quota_backend_bytes == 4 * 1024**3
+
+
+def test_management_port_kept_on_a_running_cluster(config, tmp_path):
+    """Moving every peer URL at once cannot roll out, so the port in the
+    running config is kept and the reason surfaced"""
+    (tmp_path / "etcd.conf.yml").write_text("listen-peer-urls: https://10.0.0.1:2380\n")
+    config.set("management_port", 2390)
+    bag = etcd_databag.EtcdDatabag()
+    bag.etcd_conf_dir = str(tmp_path)
+    assert bag.management_port == 2380
+    assert "set it back to 2380" in bag.management_port_problem
+
+    config.set("management_port", 2380)
+    bag = etcd_databag.EtcdDatabag()
+    bag.etcd_conf_dir = str(tmp_path)
+    assert not bag.management_port_problem
+
+
+def test_management_port_before_first_render(config, tmp_path):
+    config.set("management_port", 2390)
+    bag = etcd_databag.EtcdDatabag()
+    bag.etcd_conf_dir = str(tmp_path)
+    assert not bag.management_port_problem
+    assert bag.management_port == 2390
@@ -0,0 +1,219 @@
+import json
+from unittest import mock
+
+import pytest
+
+import etcd_gateway
+from etcd_gateway import EtcdGateway, GatewayError
+from etcdctl import EtcdCtl
+
+MEMBERS = {
+    "members": [
+        {
+            "ID": "5699624357587875521",
+            "name": "etcd0",
+            "peerURLs": ["https://10.0.0.1:2380"],
+            "clientURLs": ["https://10.0.0.1:2379"],
+        },
+        {"ID": "17132012405264852968", "peerURLs": ["https://10.0.0.2:2380"]},
+    ]
+}
+
+
+class FakeResponse:
+    def __init__(self, body, status=200):
+        self.status = status
+        self.body = json.dumps(body).encode("utf-8")
+
+    def read(self):
+        return self.body
+
+
+@pytest.fixture
+def connection():
+    etcd_gateway.close_connections()
+    conn = mock.MagicMock()
+    with mock.patch.object(etcd_gateway, "HTTPSConnection", return_value=conn):
+        with mock.patch.object(etcd_gateway, "ssl_context"):
+            yield conn
+    etcd_gateway._CONNECTIONS.clear()
+
+
+@pytest.fixture
+def gateway():
+    return EtcdGateway("ca.crt", "server.crt", "server.key")
+
+
+def test_member_list(connection, gateway):
+    connection.getresponse.return_value = FakeResponse(MEMBERS)
+    members = gateway.member_list()
+    assert members[0].unit_id == "4f192227c33076c1"
+    assert members[0].name == "etcd0"
+    assert members[0].peer_urls == ["https://10.0.0.1:2380"]
+    assert members[0].client_urls == ["https://10.0.0.1:2379"]
+    assert members[1].unit_id == "edc122836765a7e8"
+    assert not members[1].started
+    connection.request.assert_called_once_with(
+        "POST",
+        "/v3/cluster/member/list",
+        body=b"{}",
+        headers={"Content-Type": "application/json"},
+    )
+
+
+def test_connection_is_reused(connection, gateway):
+    connection.getresponse.side_effect = lambda: FakeResponse(MEMBERS)
+    gateway.member_list()
+    EtcdGateway("ca.crt", "server.crt", "server.key").member_list()
+    assert etcd_gateway.HTTPSConnection.call_count == 1
+    assert connection.request.call_count == 2
+
+
+def test_stale_connection_redials(connection, gateway):
+    connection.getresponse.side_effect = [ConnectionResetError(), FakeResponse({})]
+    gateway.request("https://127.0.0.1:2379", "/v3/cluster/member/list", {})
+    assert etcd_gateway.HTTPSConnection.call_count == 2
+
+
+def test_http_error(connection, gateway):
+    connection.getresponse.return_value = FakeResponse({"error": "no"}, status=500)
+    with pytest.raises(GatewayError):
+        gateway.version()
+
+
+def test_register(connection, gateway):
+    connection.getresponse.return_value = FakeResponse(
+        {
+            "member": {"ID": "2", "peerURLs": ["https://10.0.0.2:2380"]},
+            "members": [
+                {"ID": "1", "name": "etcd0", "peerURLs": ["https://10.0.0.1:2380"]},
+                {"ID": "2", "peerURLs": ["https://10.0.0.2:2380"]},
+            ],
+        }
+    )
+    reg = gateway.register(
+        {
+            "cluster_address": "10.0.0.2",
+            "unit_name": "etcd1",
+            "management_port": 2380,
+            "leader_address": "https://10.0.0.1:2379",
+        }
+    )
+    assert reg["cluster"] == "etcd0=https://10.0.0.1:2380,etcd1=https://10.0.0.2:2380"
+
+
+def test_unregister_sends_decimal_id(connection, gateway):
+    connection.getresponse.return_value = FakeResponse({})
+    gateway.unregister("4f192227c33076c1")
+    body = connection.request.call_args[1]["body"]
+    assert json.loads(body) == {"ID": "5699624357587875521"}
+
+
+def test_cluster_health(connection, gateway):
+    connection.getresponse.side_effect = [
+        FakeResponse(MEMBERS),
+        FakeResponse({"health": "true"}),
+    ]
+    health = gateway.cluster_health()
+    assert len(health) == 1
+    assert health[0].endpoint == "https://10.0.0.1:2379"
+    assert health[0].healthy
+    assert health[0].took is not None
+
+
+def test_endpoint_status(connection, gateway):
+    connection.getresponse.return_value = FakeResponse(
+        {
+            "header": {"member_id": "7", "revision": "42"},
+            "leader": "7",
+            "raftIndex": "100",
+            "dbSize": "4096",
+        }
+    )
+    (status,) = gateway.endpoint_status()
+    assert status.endpoint == "https://127.0.0.1:2379"
+    assert status.is_leader
+    assert status.revision == 42
+    assert status.raft_index == 100
+
+
+def test_etcdctl_native_backend(connection):
+    connection.getresponse.return_value = FakeResponse(MEMBERS)
+    etcdctl = EtcdCtl(backend="native")
+    with mock.patch("etcdctl.run") as run:
+        assert etcdctl.member_list()[0].unit_id == "4f192227c33076c1"
+    run.assert_not_called()
+
+
+def test_etcdctl_native_backend_failure(connection):
+    connection.getresponse.side_effect = OSError("connection refused")
+    etcdctl = EtcdCtl(backend="native")
+    with pytest.raises(EtcdCtl.CommandFailed):
+        etcdctl.member_list()
+
+
+@pytest.fixture
+def clock():
+    """A fake monotonic clock that time.sleep advances."""
+    now = [0.0]
+    with mock.patch("time.monotonic", side_effect=lambda: now[0]):
+        with mock.patch(
+            "time.sleep", side_effect=lambda s: now.__setitem__(0, now[0] + s)
+        ):
+            yield now
+
+
+def test_wait_until_ready(gateway, clock):
+    reasons = ["port 2379 is closed", "/health reports unhealthy", None]
+    with mock.patch.object(gateway, "probe_ready", side_effect=reasons) as probe:
+        waited = gateway.wait_until_ready("https://10.0.0.1:2379")
+    assert probe.call_count == 3
+    # Polling backs off: 0.1s then 0.2s
+    assert waited == pytest.approx(0.3)
+
+
+def test_wait_until_ready_times_out(gateway, clock):
+    with mock.patch.object(gateway, "probe_ready", return_value="port closed"):
+        with pytest.raises(etcd_gateway.NotReady, match="port closed"):
+            gateway.wait_until_ready("https://10.0.0.1:2379", timeout=10)
+    assert clock[0] <= 10
+
+
+def test_probe_ready(connection, gateway):
+    with mock.patch("socket.create_connection"):
+        connection.getresponse.return_value = FakeResponse({"health": "true"})
+        assert gateway.probe_ready("https://10.0.0.1:2379") is None
+        connection.getresponse.return_value = FakeResponse(
+            {"health": "false", "reason": "RAFT NO LEADER"}, status=503
+        )
+        assert "NO LEADER" in gateway.probe_ready("https://10.0.0.1:2379")
+    connection.close.assert_called()
+
+
+def test_probe_ready_port_closed(gateway):
+    with mock.patch("socket.create_connection", side_effect=ConnectionRefusedError()):
+        assert "closed" in gateway.probe_ready("https://10.0.0.1:2379")
+
+
+def test_move_leader_sends_decimal_id(connection, gateway):
+    connection.getresponse.return_value = FakeResponse({})
+    gateway.move_leader("4f192227c33076c1", "https://10.0.0.1:2379")
+    args, kwargs = connection.request.call_args
+    assert args == ("POST", "/v3/maintenance/transfer-leadership")
+    assert json.loads(kwargs["body"]) == {"targetID": "5699624357587875521"}
+
+
+def test_compact(connection, gateway):
+    connection.getresponse.return_value = FakeResponse({})
+    gateway.compact(1234, physical=True)
+    args, kwargs = connection.request.call_args
+    assert args == ("POST", "/v3/kv/compaction")
+    assert json.loads(kwargs["body"]) == {"revision": "1234", "physical": True}
+
+
+def test_metrics(connection, gateway):
+    response = FakeResponse({})
+    response.body = b"etcd_server_has_leader 1\n"
+    connection.getresponse.return_value = response
+    assert gateway.metrics() == "etcd_server_has_leader 1\n"
+    connection.request.assert_called_once_with("GET", "/metrics", body=None, headers={})
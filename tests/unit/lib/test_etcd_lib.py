@@ -7,9 +7,15 @@ import pytest
 
 from etcd_lib import (
     build_uri,
+    changed_config_keys,
+    content_hash,
+    file_hash,
     get_bind_address,
+    get_ingress_address,
     render_grafana_dashboard,
     get_snapshot_count,
+    human_size,
+    quota_problem,
 )
 
 
@@ -115,3 +121,55 @@ def test_get_bind_address_picks_v6(unit_private_ip):
     with mock.patch("etcd_lib.network_get", return_value=bind_data):
         assert get_bind_address("test") == ipv6
     unit_private_ip.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "num_bytes,result",
+    [(0, "0B"), (1023, "1023B"), (1536, "1.5KiB"), (2 * 1024**3, "2.0GiB")],
+)
+def test_human_size(num_bytes, result):
+    assert human_size(num_bytes) == result
+
+
+def test_network_get_is_cached():
+    data = {"ingress-addresses": ["10.0.0.1"]}
+    with mock.patch("etcd_lib.network_get", return_value=data) as network_get:
+        assert get_ingress_address("db") == "10.0.0.1"
+        assert get_ingress_address("db") == "10.0.0.1"
+    network_get.assert_called_once_with("db")
+
+
+def test_changed_config_keys():
+    old = "name: etcd0\ndata-dir: /var/snap\nheartbeat-interval: 100\n"
+    new = "name: etcd0\nheartbeat-interval: 200\nlog-level: info\n"
+    assert changed_config_keys(old, new) == [
+        "data-dir",
+        "heartbeat-interval",
+        "log-level",
+    ]
+
+
+def test_changed_config_keys_v2():
+    old = '# comment\nETCD_NAME="etcd0"\nETCD_DATA_DIR="/a"\n'
+    new = '# comment\nETCD_NAME="etcd0"\nETCD_DATA_DIR="/b"\n'
+    assert changed_config_keys(old, new) == ["ETCD_DATA_DIR"]
+
+
+def test_file_hash(tmp_path):
+    path = tmp_path / "etcd.conf.yml"
+    assert file_hash(str(path)) is None
+    path.write_text("name: etcd0\n")
+    assert file_hash(str(path)) == content_hash("name: etcd0\n")
+
+
+def test_quota_problem(tmp_path):
+    db = tmp_path / "member" / "snap" / "db"
+    db.parent.mkdir(parents=True)
+    db.write_bytes(b"x" * 1000)
+    usage = mock.Mock(free=4000)
+    with mock.patch("shutil.disk_usage", return_value=usage):
+        # The db can grow into its own space
+        assert quota_problem(5000, str(tmp_path)) is None
+        assert "exceeds the 4.9KiB available" in quota_problem(6000, str(tmp_path))
+        assert "below the 1000B database" in quota_problem(1000, str(tmp_path))
+    assert quota_problem(1, str(tmp_path / "missing")) is None
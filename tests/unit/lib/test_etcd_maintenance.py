@@ -0,0 +1,214 @@
+from unittest import mock
+
+import pytest
+from charms.unit_test import MockKV
+
+import etcd_maintenance
+from etcd_maintenance import (
+    HISTORY_KEY,
+    REVISIONS_KEY,
+    compaction_target,
+    defrag_plan,
+    growth_rate,
+    remediate_nospace,
+    rolling_defrag,
+    scheduled_compaction,
+)
+from etcd_records import Alarm, ClusterProbe, EndpointHealth, EndpointStatus, Member
+from etcdctl import EtcdCtl
+
+
+def _status(n, leader, db_size, in_use):
+    return EndpointStatus(
+        "https://10.0.0.{}:2379".format(n),
+        {
+            "header": {"member_id": n},
+            "leader": leader,
+            "raftIndex": 100,
+            "dbSize": db_size,
+            "dbSizeInUse": in_use,
+        },
+    )
+
+
+@pytest.fixture
+def probe():
+    # etcd1 leads; etcd1 and etcd3 are mostly free space, etcd2 is compact
+    probe = ClusterProbe([Member(n, "etcd{}".format(n)) for n in (1, 2, 3)])
+    probe.status = [
+        _status(1, 1, 1000, 100),
+        _status(2, 1, 1000, 900),
+        _status(3, 1, 1000, 200),
+    ]
+    probe.health = [EndpointHealth(s.endpoint, True) for s in probe.status]
+    return probe
+
+
+@pytest.fixture
+def etcdctl(probe):
+    etcdctl = mock.MagicMock()
+    etcdctl.probe_cluster.return_value = probe
+    etcdctl.endpoint_status.return_value = [_status(0, 0, 100, 100)]
+    return etcdctl
+
+
+@pytest.fixture(autouse=True)
+def settle():
+    with mock.patch.object(etcd_maintenance, "settle") as settle:
+        yield settle
+
+
+def test_defrag_plan_puts_leader_last(probe):
+    plan = defrag_plan(probe, 0.5)
+    assert [s.member_id for s in plan] == [3, 1]
+    assert [s.member_id for s in defrag_plan(probe, 0)] == [2, 3, 1]
+
+
+@pytest.fixture
+def members(etcdctl, probe):
+    """Serve endpoint status from the members' current state, as changed by
+    defrags and leadership transfers to etcd3."""
+    current = {s.endpoint: s for s in probe.status}
+
+    def defrag(endpoint):
+        s = current[endpoint]
+        current[endpoint] = _status(s.member_id, s.leader_id, 100, 100)
+
+    def elect(leader):
+        for endpoint, s in current.items():
+            current[endpoint] = _status(
+                s.member_id, leader, s.db_size, s.db_size_in_use
+            )
+
+    def transfer_leadership(endpoint):
+        elect(3)
+        return Member(3, "etcd3")
+
+    etcdctl.endpoint_status.side_effect = lambda endpoint: [current[endpoint]]
+    etcdctl.defrag.side_effect = defrag
+    etcdctl.transfer_leadership.side_effect = transfer_leadership
+    return elect
+
+
+def test_rolling_defrag(etcdctl, members, settle):
+    results = rolling_defrag(etcdctl, 0.5)
+    assert results == [("etcd3", 1000, 100), ("etcd1", 1000, 100)]
+    assert [c.args[0] for c in etcdctl.defrag.call_args_list] == [
+        "https://10.0.0.3:2379",
+        "https://10.0.0.1:2379",
+    ]
+    etcdctl.transfer_leadership.assert_called_once_with("https://10.0.0.1:2379")
+    assert settle.call_count == 2
+
+
+def test_rolling_defrag_follows_leadership(etcdctl, members, settle):
+    """Leadership moving from etcd1 to etcd2 while etcd3 is defragmented
+    leaves etcd1 a follower with no leadership to hand off"""
+    settle.side_effect = lambda etcdctl, check: members(2)
+    results = rolling_defrag(etcdctl, 0.5)
+    assert [name for name, _, _ in results] == ["etcd3", "etcd1"]
+    etcdctl.transfer_leadership.assert_not_called()
+
+
+def test_rolling_defrag_skips_leader_it_cannot_move(etcdctl, members):
+    etcdctl.transfer_leadership.side_effect = EtcdCtl.CommandFailed()
+    results = rolling_defrag(etcdctl, 0.5)
+    assert [name for name, _, _ in results] == ["etcd3"]
+    etcdctl.defrag.assert_called_once_with("https://10.0.0.3:2379")
+
+
+def test_rolling_defrag_needs_healthy_cluster(etcdctl, probe):
+    probe.health[0] = EndpointHealth(probe.health[0].endpoint, False)
+    with pytest.raises(EtcdCtl.CommandFailed) as e:
+        rolling_defrag(etcdctl, 0.5)
+    assert e.value.output.startswith("Cluster is not healthy and caught up")
+    etcdctl.defrag.assert_not_called()
+
+
+def test_rolling_defrag_stops_when_cluster_does_not_settle(etcdctl, settle):
+    settle.side_effect = EtcdCtl.CommandFailed("not caught up")
+    with pytest.raises(EtcdCtl.CommandFailed):
+        rolling_defrag(etcdctl, 0.5)
+    etcdctl.defrag.assert_called_once()
+
+
+def test_compaction_target():
+    samples = [[0, 100], [3600, 400], [7200, 900]]
+    assert compaction_target(samples, 900, 7200, retain=200) == 700
+    assert compaction_target(samples, 900, 7200, window=3600) == 400
+    # The older of the two revisions wins
+    assert compaction_target(samples, 900, 7200, retain=700, window=3600) == 200
+    # Samples do not reach back a whole window yet
+    assert compaction_target(samples, 900, 7200, window=10000) is None
+    assert compaction_target(samples, 900, 7200, retain=1000) is None
+    assert compaction_target(samples, 900, 7200) is None
+
+
+def test_growth_rate():
+    assert growth_rate([[0, 100], [1800, 400]]) == 600
+    assert growth_rate([[0, 100]]) is None
+
+
+def test_scheduled_compaction(etcdctl):
+    kv = MockKV()
+    etcdctl.endpoint_status.return_value = [
+        EndpointStatus("", {"header": {"revision": 1000}, "dbSize": 10})
+    ]
+    with mock.patch.object(etcd_maintenance.unitdata, "kv", return_value=kv):
+        record = scheduled_compaction(etcdctl, retain=100, now=0)
+        assert record["revision"] == 900
+        assert record["compacted"] is None
+        etcdctl.compact.assert_called_once_with(900)
+
+        # Nothing new to compact
+        assert scheduled_compaction(etcdctl, retain=100, now=300) is None
+
+        etcdctl.endpoint_status.return_value[0].revision = 1600
+        etcdctl.compact.side_effect = EtcdCtl.CommandFailed(
+            "", "Error: etcdserver: mvcc: required revision has been compacted"
+        )
+        record = scheduled_compaction(etcdctl, retain=100, now=3600)
+        assert record["compacted"] == 600
+        assert record["growth_per_hour"] == 600
+
+    assert [r["revision"] for r in kv.get(HISTORY_KEY)] == [900, 1500]
+    assert len(kv.get(REVISIONS_KEY)) == 3
+
+
+def test_remediate_nospace(etcdctl, probe):
+    etcdctl.alarm_list.return_value = [Alarm(1, "NOSPACE")]
+    etcdctl.transfer_leadership.return_value = None
+    # Members report unhealthy while the alarm is raised
+    probe.health = [EndpointHealth(h.endpoint, False) for h in probe.health]
+    results = remediate_nospace(etcdctl)
+    etcdctl.compact.assert_called_once_with(0, physical=True)
+    # Every member, the leader in place as it could not hand over
+    assert [name for name, _, _ in results] == ["etcd2", "etcd3", "etcd1"]
+    etcdctl.alarm_disarm.assert_called_once()
+
+
+def test_remediate_nospace_retry(etcdctl, probe):
+    """A retry goes on past the compaction an earlier attempt made"""
+    etcdctl.alarm_list.return_value = [Alarm(1, "NOSPACE")]
+    etcdctl.compact.side_effect = EtcdCtl.CommandFailed(
+        "", "Error: etcdserver: mvcc: required revision has been compacted"
+    )
+    assert remediate_nospace(etcdctl)
+    etcdctl.alarm_disarm.assert_called_once()
+
+    etcdctl.compact.side_effect = EtcdCtl.CommandFailed("", "context deadline exceeded")
+    with pytest.raises(EtcdCtl.CommandFailed):
+        remediate_nospace(etcdctl)
+
+
+def test_remediate_nospace_still_over_quota(etcdctl):
+    etcdctl.alarm_list.return_value = [Alarm(1, "NOSPACE")]
+    with pytest.raises(EtcdCtl.CommandFailed):
+        remediate_nospace(etcdctl, quota=100)
+    etcdctl.alarm_disarm.assert_not_called()
+
+
+def test_remediate_nospace_without_alarm(etcdctl):
+    etcdctl.alarm_list.return_value = [Alarm(1, "CORRUPT")]
+    assert remediate_nospace(etcdctl) is None
+    etcdctl.defrag.assert_not_called()
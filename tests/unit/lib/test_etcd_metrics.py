@@ -0,0 +1,83 @@
+import pytest
+
+from etcd_metrics import (
+    DB_SIZE,
+    WAL_FSYNC,
+    histogram_quantile,
+    parse,
+    parse_thresholds,
+    scrape,
+    summarize,
+)
+
+METRICS = """\
+# HELP etcd_disk_wal_fsync_duration_seconds The latency distributions of fsync.
+# TYPE etcd_disk_wal_fsync_duration_seconds histogram
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="0.001"}} {0}
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="0.002"}} {1}
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="0.004"}} {2}
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="+Inf"}} {2}
+etcd_disk_wal_fsync_duration_seconds_sum 0.5
+etcd_disk_wal_fsync_duration_seconds_count {2}
+etcd_mvcc_db_total_size_in_bytes 1.073741824e+09
+etcd_server_leader_changes_seen_total {3}
+etcd_server_proposals_failed_total 0
+etcd_server_quota_backend_bytes 4.294967296e+09
+grpc_server_handled_total{{grpc_code="OK",grpc_method="Range"}} 12345 1700000000
+"""
+
+
+def test_parse_filters_samples():
+    samples = parse(METRICS.format(10, 20, 30, 1), [WAL_FSYNC + "_bucket", DB_SIZE])
+    assert sorted(samples) == [WAL_FSYNC + "_bucket", DB_SIZE]
+    assert samples[WAL_FSYNC + "_bucket"][0] == ({"le": "0.001"}, 10.0)
+    assert samples[DB_SIZE] == [({}, 1073741824.0)]
+
+
+def test_scrape():
+    result = scrape(METRICS.format(10, 20, 30, 1))
+    assert result[WAL_FSYNC] == [
+        (0.001, 10.0),
+        (0.002, 20.0),
+        (0.004, 30.0),
+        (float("inf"), 30.0),
+    ]
+
+
+def test_histogram_quantile():
+    buckets = [(0.001, 50.0), (0.002, 100.0), (float("inf"), 100.0)]
+    assert histogram_quantile(0.5, buckets) == pytest.approx(0.001)
+    assert histogram_quantile(0.75, buckets) == pytest.approx(0.0015)
+    assert histogram_quantile(0.99, []) is None
+    assert histogram_quantile(0.99, [(0.001, 0.0), (float("inf"), 0.0)]) is None
+    # Observations beyond the highest bound report that bound
+    assert histogram_quantile(0.99, [(0.001, 1.0), (float("inf"), 10.0)]) == 0.001
+
+
+def test_summarize():
+    old = scrape(METRICS.format(1000, 1000, 1000, 2))
+    # 100 fsyncs since, 90 of them slower than 2ms
+    new = scrape(METRICS.format(1000, 1010, 1100, 3))
+    summary = summarize(old, new, 900)
+    assert 0.002 < summary["wal_fsync_p99"] < 0.004
+    assert summary["backend_commit_p99"] is None
+    assert summary["leader_changes"] == pytest.approx(4.0)
+    assert summary["proposals_failed"] == 0
+    assert summary["db_size"] == 0.25
+
+
+def test_summarize_after_restart():
+    old = scrape(METRICS.format(1000, 1000, 1000, 5))
+    new = scrape(METRICS.format(10, 10, 10, 1))
+    summary = summarize(old, new, 900)
+    assert summary["wal_fsync_p99"] <= 0.001
+    assert summary["leader_changes"] == pytest.approx(4.0)
+
+
+def test_parse_thresholds():
+    assert parse_thresholds("0.01,0.1") == (0.01, 0.1)
+    assert parse_thresholds("") is None
+    with pytest.raises(ValueError):
+        parse_thresholds("0.01")
+    with pytest.raises(ValueError):
+        parse_thresholds("1,0.5")
@@ -0,0 +1,129 @@
+import json
+from unittest import mock
+
+import pytest
+
+import etcd_profile
+from etcd_profile import (
+    append_records,
+    format_report,
+    handler_name,
+    load_records,
+    percentile,
+    summarize,
+    write_textfile,
+)
+from etcdctl import _command_name
+
+
+def _record(hook, kind, name, duration, run=1.0):
+    return {"run": run, "hook": hook, "kind": kind, "name": name, "duration": duration}
+
+
+def test_timed_records_when_enabled():
+    with mock.patch.object(etcd_profile, "atexit") as atexit:
+        with etcd_profile.timed("etcdctl", "member list"):
+            pass
+        atexit.assert_not_called()
+        etcd_profile._ENABLED = True
+        with etcd_profile.timed("etcdctl", "member list"):
+            pass
+        with etcd_profile.timed("etcdctl", "endpoint status"):
+            pass
+    atexit.assert_called_once_with(etcd_profile.flush)
+    assert [r[:2] for r in etcd_profile._RECORDS] == [
+        ("etcdctl", "member list"),
+        ("etcdctl", "endpoint status"),
+    ]
+
+
+def test_timed_nested_flushes_once():
+    etcd_profile._ENABLED = True
+    with mock.patch.object(etcd_profile, "atexit") as atexit:
+        with etcd_profile.timed("handler", "etcd.check_cluster_health"):
+            with etcd_profile.timed("etcdctl", "endpoint health"):
+                pass
+    atexit.assert_called_once_with(etcd_profile.flush)
+    assert len(etcd_profile._RECORDS) == 2
+
+
+def test_handler_name():
+    handler_id = "/var/lib/juju/agents/unit-etcd-0/charm/reactive/etcd.py:412:health"
+    assert handler_name(handler_id) == "etcd.health"
+
+
+@pytest.mark.parametrize(
+    "arguments,name",
+    [
+        ("member list --write-out=json", "member list"),
+        (["member", "remove", "8e9e05c52164694d"], "member remove"),
+        (["move-leader", "8e9e05c52164694d"], "move-leader"),
+        (["endpoint", "status", "--cluster"], "endpoint status"),
+        (["snapshot", "save", "/tmp/db"], "snapshot save"),
+    ],
+)
+def test_command_name(arguments, name):
+    assert _command_name(None, arguments, endpoints="https://127.0.0.1:2379") == name
+
+
+def test_append_records_is_a_ring(tmp_path):
+    path = str(tmp_path / "profile.jsonl")
+    for run in range(100):
+        append_records(path, [_record("update-status", "hook", "x", 1, run)], 2000)
+    records = load_records(path)
+    assert (tmp_path / "profile.jsonl").stat().st_size <= 2000
+    assert records[-1]["run"] == 99
+    assert [r["run"] for r in records] == sorted(r["run"] for r in records)
+
+
+def test_load_records_skips_damaged_lines(tmp_path):
+    path = tmp_path / "profile.jsonl"
+    path.write_text(json.dumps(_record("install", "hook", "install", 1)) + "\n{\n")
+    assert len(load_records(str(path))) == 1
+    assert load_records(str(tmp_path / "missing.jsonl")) == []
+
+
+def test_percentile():
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(list(range(1, 101)), 95) == 95
+    assert percentile([7], 95) == 7
+
+
+def test_summarize():
+    records = []
+    for run, took in enumerate([2.0, 20.0]):
+        records += [
+            _record("update-status", "handler", "etcd.health", took - 1, run),
+            _record("update-status", "etcdctl", "endpoint health", 0.5, run),
+            _record("update-status", "etcdctl", "endpoint health", 0.25, run),
+            _record("update-status", "hook", "update-status", took, run),
+        ]
+    summary = summarize(records)
+    assert summary["update-status"]["runs"] == 2
+    assert summary["update-status"]["p50"] == 2.0
+    assert summary["update-status"]["p95"] == 20.0
+    steps = summary["update-status"]["steps"]
+    assert [step["name"] for step in steps] == ["etcd.health", "endpoint health"]
+    assert steps[1]["calls_per_run"] == 2
+    report = format_report(summary)
+    assert report.splitlines()[0] == "update-status: 2 runs, p50 2.00s, p95 20.00s"
+
+
+def test_write_textfile(tmp_path):
+    summary = summarize(
+        [
+            _record("update-status", "handler", "etcd.health", 1.5),
+            _record("update-status", "hook", "update-status", 2),
+        ]
+    )
+    path = tmp_path / "etcd_charm.prom"
+    write_textfile(str(path), summary)
+    lines = path.read_text().splitlines()
+    assert (
+        'etcd_charm_hook_duration_seconds{hook="update-status",quantile="0.95"} 2'
+        in lines
+    )
+    assert (
+        "etcd_charm_step_duration_seconds"
+        '{hook="update-status",kind="handler",name="etcd.health",quantile="0.5"} 1.5'
+    ) in lines
@@ -0,0 +1,70 @@
+import pytest
+
+from etcd_records import (
+    Alarm,
+    EndpointHealth,
+    EndpointStatus,
+    Member,
+    parse_duration,
+)
+
+
+@pytest.mark.parametrize(
+    "value,seconds",
+    [
+        ("2.5ms", 0.0025),
+        ("850µs", 0.00085),
+        ("1m2.5s", 62.5),
+        ("3s", 3.0),
+        ("", None),
+        ("garbage", None),
+    ],
+)
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == pytest.approx(seconds)
+
+
+def test_member_from_gateway_strings():
+    member = Member.from_json(
+        {"ID": "17132012405264852968", "name": "etcd1", "isLearner": True}
+    )
+    assert member.unit_id == "edc122836765a7e8"
+    assert member.started
+    assert member.is_learner
+    assert member.peer_urls == []
+
+
+def test_records_are_compact():
+    for record in (Member(1), EndpointStatus("e", {}), EndpointHealth("e", True)):
+        assert not hasattr(record, "__dict__")
+
+
+def test_endpoint_status_fragmentation_without_sizes():
+    status = EndpointStatus("https://10.0.0.1:2379", {"leader": 0})
+    assert status.fragmentation == 0.0
+    assert not status.is_leader
+
+
+def test_alarm_from_etcdctl_and_gateway():
+    # etcdctl prints the enum number, the gateway its name
+    assert Alarm.from_json({"memberID": 10, "alarm": 1}).name == "NOSPACE"
+    alarm = Alarm.from_json({"memberID": "10", "alarm": "CORRUPT"})
+    assert (alarm.member_id, alarm.name) == (10, "CORRUPT")
+
+
+def test_endpoint_health_from_text():
+    """etcdctl before 3.4 only reports endpoint health as text"""
+    healthy = EndpointHealth.from_text(
+        "https://10.0.0.1:2379 is healthy: "
+        "successfully committed proposal: took = 1.95ms"
+    )
+    assert healthy.endpoint == "https://10.0.0.1:2379"
+    assert healthy.healthy
+    assert healthy.took == pytest.approx(0.00195)
+    unhealthy = EndpointHealth.from_text(
+        "https://10.0.0.2:2379 is unhealthy: "
+        "failed to connect: dial tcp 10.0.0.2:2379: connect: connection refused"
+    )
+    assert not unhealthy.healthy
+    assert unhealthy.error.startswith("failed to connect")
+    assert EndpointHealth.from_text("Error: unhealthy cluster") is None
@@ -0,0 +1,91 @@
+import json
+from unittest import mock
+
+import pytest
+
+import etcd_restore
+import etcd_rolling
+from etcd_restore import ParallelRestore, STOP_TIMEOUT
+
+
+@pytest.fixture
+def leader_data():
+    data = {}
+
+    def leader_set(settings):
+        data.update(settings)
+
+    with mock.patch.object(etcd_restore, "leader_get", side_effect=data.get):
+        with mock.patch.object(etcd_restore, "leader_set", side_effect=leader_set):
+            yield data
+
+
+@pytest.fixture
+def peers():
+    """Relation data of the cluster peer relation, keyed by unit."""
+    data = {"etcd/1": {}, "etcd/2": {}, "etcd/3": {}}
+    with mock.patch.object(etcd_rolling, "relation_ids", return_value=["cluster:1"]):
+        with mock.patch.object(
+            etcd_rolling,
+            "relation_get",
+            side_effect=lambda key, unit, rid: data[unit].get(key),
+        ):
+            yield data
+
+
+def test_start_publishes_stop(leader_data):
+    with mock.patch.object(etcd_restore.time, "time", return_value=1000.0):
+        restore = ParallelRestore.start("etcd0=https://10.0.0.1:2380", "f00")
+    saved = json.loads(leader_data["parallel_restore"])
+    assert saved["phase"] == ParallelRestore.STOP
+    assert saved["requested"] == 1000.0
+    assert saved["token"] == restore.token
+    loaded = ParallelRestore.load()
+    assert loaded.id == restore.id
+    assert loaded.peer_urls == {"etcd0": "https://10.0.0.1:2380"}
+
+    loaded.advance(ParallelRestore.RESTORE)
+    assert ParallelRestore.load().phase == ParallelRestore.RESTORE
+
+
+def test_pending(peers):
+    restore = ParallelRestore(
+        "abc",
+        "etcd0=https://10.0.0.1:2380,etcd1=https://10.0.0.2:2380,"
+        "etcd2=https://10.0.0.3:2380",
+        "token",
+        "f00",
+    )
+    units = ["etcd/1", "etcd/2", "etcd/3"]
+    # etcd/3 is not a member of the restored cluster and rejoins it later
+    assert restore.pending(units) == ["etcd/1", "etcd/2"]
+    peers["etcd/1"]["parallel-restore"] = "abc"
+    peers["etcd/2"]["parallel-restore"] = "an older restore"
+    assert restore.pending(units) == ["etcd/2"]
+
+
+def test_phases_are_acknowledged(leader_data, peers):
+    restore = ParallelRestore("abc", "etcd1=https://10.0.0.2:2380", "token", "f00")
+    peers["etcd/1"]["parallel-restore"] = "abc"
+    assert restore.pending(["etcd/1"]) == []
+    restore.advance(ParallelRestore.RESTORE)
+    assert restore.pending(["etcd/1"]) == ["etcd/1"]
+    with mock.patch.object(etcd_rolling, "relation_set") as relation_set:
+        restore.acknowledge()
+    relation_set.assert_called_once_with(
+        "cluster:1", {"parallel-restore": "abc:restore"}
+    )
+    peers["etcd/1"]["parallel-restore"] = "abc:restore"
+    assert restore.pending(["etcd/1"]) == []
+
+    ParallelRestore.clear()
+    assert ParallelRestore.load() is None
+
+
+def test_expired():
+    restore = ParallelRestore("abc", "", "token", "f00", requested=1000.0)
+    assert not restore.expired(now=1000.0 + STOP_TIMEOUT)
+    assert restore.expired(now=1001.0 + STOP_TIMEOUT)
+    # Each phase gets its own STOP_TIMEOUT
+    restore.advanced = 2000.0
+    assert not restore.expired(now=2000.0 + STOP_TIMEOUT)
@@ -0,0 +1,95 @@
+import time
+from unittest import mock
+
+import pytest
+
+import etcd_retry
+from etcd_retry import (
+    CircuitOpen,
+    RetryExhausted,
+    backoff_delays,
+    retry,
+)
+
+
+@pytest.fixture
+def sleep():
+    with mock.patch("time.sleep") as sleep:
+        yield sleep
+
+
+def test_backoff_delays_are_capped():
+    with mock.patch("random.uniform", side_effect=lambda low, high: high):
+        delays = backoff_delays(base=1, cap=5)
+        assert [next(delays) for _ in range(5)] == [1, 2, 4, 5, 5]
+
+
+def test_retry_returns_first_success(sleep):
+    func = mock.Mock(side_effect=[ValueError(), ValueError(), "ok"])
+    assert retry(func, retry_on=ValueError) == "ok"
+    assert func.call_count == 3
+    assert sleep.call_count == 2
+
+
+def test_retry_does_not_sleep_on_success(sleep):
+    assert retry(lambda: 42) == 42
+    sleep.assert_not_called()
+
+
+def test_retry_attempts_exhausted(sleep):
+    func = mock.Mock(side_effect=ValueError("boom"))
+    with pytest.raises(RetryExhausted) as exc:
+        retry(func, attempts=3)
+    assert func.call_count == 3
+    assert isinstance(exc.value.__cause__, ValueError)
+
+
+def test_retry_deadline(sleep):
+    clock = [0.0]
+    sleep.side_effect = lambda delay: clock.__setitem__(0, clock[0] + delay)
+    func = mock.Mock(side_effect=ValueError())
+    with mock.patch("time.monotonic", side_effect=lambda: clock[0]):
+        with mock.patch("random.uniform", return_value=2):
+            with pytest.raises(RetryExhausted):
+                retry(func, deadline=5)
+    # Two sleeps of 2s fit in the deadline, a third would overrun it.
+    assert func.call_count == 3
+    assert clock[0] == 4
+
+
+def test_retry_until_predicate(sleep):
+    func = mock.Mock(side_effect=[False, False, True])
+    assert retry(func, until=bool) is True
+    assert func.call_count == 3
+
+
+def test_retry_other_errors_propagate(sleep):
+    func = mock.Mock(side_effect=KeyError())
+    with pytest.raises(KeyError):
+        retry(func, retry_on=ValueError)
+    func.assert_called_once()
+
+
+def test_retry_fails_fast_on_open_circuit(sleep):
+    func = mock.Mock(side_effect=CircuitOpen())
+    with pytest.raises(CircuitOpen):
+        retry(func)
+    func.assert_called_once()
+    sleep.assert_not_called()
+
+
+def test_retry_limited_by_hook_budget(sleep):
+    func = mock.Mock(side_effect=ValueError())
+    with mock.patch.object(etcd_retry, "remaining_budget", return_value=0):
+        with pytest.raises(RetryExhausted):
+            retry(func, deadline=60)
+    func.assert_called_once()
+
+
+def test_actions_have_no_hook_budget(monkeypatch):
+    monkeypatch.delenv("JUJU_ACTION_NAME", raising=False)
+    monkeypatch.setattr(etcd_retry, "_HOOK_START", time.monotonic() - 1000)
+    with pytest.raises(etcd_retry.BudgetExhausted):
+        etcd_retry.bounded_timeout(300)
+    monkeypatch.setenv("JUJU_ACTION_NAME", "snapshot")
+    assert etcd_retry.bounded_timeout(300) == 300
@@ -0,0 +1,100 @@
+import json
+from unittest import mock
+
+import pytest
+
+import etcd_rolling
+from etcd_records import ClusterProbe, EndpointHealth, EndpointStatus
+from etcd_rolling import RollingRestart, caught_up
+
+
+@pytest.fixture
+def leader_data():
+    data = {}
+
+    def leader_set(settings):
+        for key, value in settings.items():
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+
+    with mock.patch.object(etcd_rolling, "leader_get", side_effect=data.get):
+        with mock.patch.object(etcd_rolling, "leader_set", side_effect=leader_set):
+            with mock.patch.object(etcd_rolling, "local_unit", return_value="etcd/0"):
+                yield data
+
+
+@pytest.fixture
+def peers():
+    """Relation data of the cluster peer relation, keyed by unit."""
+    data = {"etcd/0": {}, "etcd/1": {}, "etcd/2": {}}
+    with mock.patch.object(etcd_rolling, "relation_ids", return_value=["cluster:1"]):
+        with mock.patch.object(
+            etcd_rolling,
+            "related_units",
+            return_value=[u for u in data if u != "etcd/0"],
+        ):
+            with mock.patch.object(
+                etcd_rolling,
+                "relation_get",
+                side_effect=lambda key, unit, rid: data[unit].get(key),
+            ):
+                yield data
+
+
+def test_start_puts_leader_last(leader_data, peers):
+    plan = RollingRestart.start(etcd_rolling.peer_units())
+    assert plan.queue == ["etcd/1", "etcd/2", "etcd/0"]
+    assert plan.current == "etcd/1"
+    saved = json.loads(leader_data["rolling_restart"])
+    assert saved == {"id": plan.id, "queue": plan.queue}
+    assert RollingRestart.load().queue == plan.queue
+
+
+def test_advance_until_done(leader_data, peers):
+    plan = RollingRestart.start(["etcd/1"])
+    assert not plan.done("etcd/1")
+    peers["etcd/1"]["rolling-restart"] = plan.id
+    assert plan.done("etcd/1")
+    plan.advance()
+    assert plan.current == "etcd/0"
+    plan.advance()
+    assert plan.current is None
+    assert RollingRestart.load() is None
+
+
+def test_stale_acknowledgement_is_ignored(leader_data, peers):
+    peers["etcd/1"]["rolling-restart"] = "previous-plan"
+    plan = RollingRestart.start(["etcd/1"])
+    assert not plan.done("etcd/1")
+
+
+def test_reconcile_after_leader_change(leader_data, peers):
+    # etcd/0 took over leadership from etcd/2 while etcd/3 departed
+    plan = RollingRestart("abc", ["etcd/0", "etcd/3", "etcd/1", "etcd/2"])
+    assert plan.reconcile(["etcd/0", "etcd/1", "etcd/2"])
+    assert plan.queue == ["etcd/1", "etcd/2", "etcd/0"]
+    assert not plan.reconcile(["etcd/0", "etcd/1", "etcd/2"])
+
+
+def test_acknowledge(peers):
+    with mock.patch.object(etcd_rolling, "relation_set") as relation_set:
+        etcd_rolling.acknowledge("abc")
+    relation_set.assert_called_once_with("cluster:1", {"rolling-restart": "abc"})
+
+
+def _probe(healthy, raft_indexes):
+    probe = ClusterProbe([])
+    probe.health = [EndpointHealth("https://10.0.0.1:2379", healthy)]
+    for index in raft_indexes:
+        probe.status.append(
+            EndpointStatus("https://10.0.0.1:2379", {"raftIndex": index})
+        )
+    return probe
+
+
+def test_caught_up():
+    assert caught_up(_probe(True, [1000, 990]))
+    assert not caught_up(_probe(False, [1000, 1000]))
+    assert not caught_up(_probe(True, [1000, 10]))
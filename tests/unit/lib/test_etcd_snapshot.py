@@ -0,0 +1,160 @@
+import hashlib
+import shutil
+import tarfile
+from unittest import mock
+
+import pytest
+
+from etcd_snapshot import (
+    SnapshotError,
+    archive_name,
+    extract_db,
+    restore_archive,
+    swap_dir,
+    write_archive,
+)
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / "db"
+    path.write_bytes(b"bbolt" * 100000)
+    return path
+
+
+@pytest.mark.parametrize(
+    "codec",
+    [
+        "gzip",
+        "none",
+        pytest.param(
+            "zstd",
+            marks=pytest.mark.skipif(
+                not shutil.which("zstd"), reason="zstd is not installed"
+            ),
+        ),
+    ],
+)
+def test_write_archive(tmp_path, db, codec):
+    archive = tmp_path / archive_name("etcd-snapshot", codec)
+    size, sha256 = write_archive(str(archive), {"db": str(db)}, codec)
+    data = archive.read_bytes()
+    assert size == len(data)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    if codec != "zstd":
+        with tarfile.open(str(archive)) as tar:
+            assert tar.getnames() == ["db"]
+            assert tar.extractfile("db").read() == db.read_bytes()
+
+
+def test_gzip_compresses(tmp_path, db):
+    size, _ = write_archive(str(tmp_path / "a.tar.gz"), {"db": str(db)}, "gzip")
+    assert size < db.stat().st_size
+
+
+def test_unknown_codec(tmp_path, db):
+    with pytest.raises(SnapshotError):
+        archive_name("etcd-snapshot", "lz4")
+    with pytest.raises(SnapshotError):
+        write_archive(str(tmp_path / "a.tar"), {"db": str(db)}, "lz4")
+
+
+def snapshot_db(path, corrupt=False):
+    """Write a db the way snapshot save does, with its sha256 appended."""
+    data = b"bbolt page" * 2048
+    data += b"\0" * (-len(data) % 512)
+    digest = hashlib.sha256(data).digest()
+    if corrupt:
+        data = data[:-1] + b"x"
+    path.write_bytes(data + digest)
+    return data
+
+
+requires_zstd = pytest.mark.skipif(
+    not shutil.which("zstd"), reason="zstd is not installed"
+)
+
+
+@pytest.mark.parametrize(
+    "codec", ["gzip", "none", pytest.param("zstd", marks=requires_zstd)]
+)
+def test_extract_db(tmp_path, codec):
+    data = snapshot_db(tmp_path / "db")
+    archive = tmp_path / archive_name("snapshot", codec)
+    write_archive(str(archive), {"db": str(tmp_path / "db")}, codec)
+    dest = tmp_path / "restored"
+    assert extract_db(str(archive), str(dest)) is True
+    assert dest.read_bytes()[: len(data)] == data
+
+
+def test_extract_db_corrupt(tmp_path):
+    snapshot_db(tmp_path / "db", corrupt=True)
+    archive = tmp_path / "snapshot.tar.gz"
+    write_archive(str(archive), {"db": str(tmp_path / "db")})
+    with pytest.raises(SnapshotError):
+        extract_db(str(archive), str(tmp_path / "restored"))
+
+
+@pytest.mark.parametrize("data", [b"not a tarball", b"\x1f\x8b truncated"])
+def test_extract_db_not_an_archive(tmp_path, data):
+    # e.g. a bare db given as the snapshot resource
+    archive = tmp_path / "snapshot.db"
+    archive.write_bytes(data)
+    with pytest.raises(SnapshotError):
+        extract_db(str(archive), str(tmp_path / "restored"))
+
+
+def test_extract_db_without_hash(tmp_path, db):
+    archive = tmp_path / "snapshot.tar.gz"
+    write_archive(str(archive), {"./db": str(db)})
+    assert extract_db(str(archive), str(tmp_path / "restored")) is False
+
+
+def test_extract_db_v2_backup(tmp_path):
+    backup = tmp_path / "backup"
+    (backup / "member" / "wal").mkdir(parents=True)
+    (backup / "member" / "wal" / "0.wal").write_bytes(b"wal")
+    archive = tmp_path / "snapshot.tar.gz"
+    write_archive(str(archive), {".": str(backup)})
+    assert extract_db(str(archive), str(tmp_path / "restored")) is None
+
+
+def test_swap_dir(tmp_path):
+    current = tmp_path / "member"
+    current.mkdir()
+    (current / "old").write_text("old")
+    new = tmp_path / "restore" / "member"
+    new.mkdir(parents=True)
+    (new / "new").write_text("new")
+    swap_dir(str(new), str(current))
+    assert [p.name for p in current.iterdir()] == ["new"]
+    assert not new.exists()
+    assert not (tmp_path / "member.pre-restore").exists()
+
+
+def test_restore_archive(tmp_path):
+    snapshot_db(tmp_path / "db")
+    archive = tmp_path / "snapshot.tar.gz"
+    write_archive(str(archive), {"db": str(tmp_path / "db")})
+    data_dir = tmp_path / "data"
+    (data_dir / "member").mkdir(parents=True)
+
+    def restore(cmd, env):
+        assert env["ETCDCTL_API"] == "3"
+        restored = [arg.split("=", 1)[1] for arg in cmd if arg.startswith("--data-dir")]
+        (tmp_path / restored[0] / "member" / "snap").mkdir(parents=True)
+
+    with mock.patch("etcd_snapshot.check_call", side_effect=restore) as check_call:
+        assert restore_archive(
+            str(archive),
+            str(data_dir),
+            "etcd0",
+            "etcd0=https://10.0.0.1:2380,etcd1=https://10.0.0.2:2380",
+            "token",
+            "https://10.0.0.1:2380",
+        )
+    cmd = check_call.call_args[0][0]
+    assert "--name=etcd0" in cmd
+    assert "--initial-cluster-token=token" in cmd
+    assert [p.name for p in data_dir.iterdir()] == ["member"]
+    assert (data_dir / "member" / "snap").is_dir()
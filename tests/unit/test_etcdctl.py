@@ -1,4 +1,7 @@
+import json
 import pytest
+import threading
+from subprocess import CalledProcessError, TimeoutExpired
 from unittest.mock import patch, MagicMock
 
 from charms.unit_test import MockKV
@@ -8,27 +11,91 @@ import etcd_lib
 
 from etcdctl import (
     EtcdCtl,
+    etcd_version,
     etcdctl_command,
     get_connection_string,
+    modern_etcdctl,
 )  # noqa
 
 from etcd_databag import EtcdDatabag
+from etcd_records import ClusterProbe, EndpointHealth, EndpointStatus, Member
 
+from etcd_restore import ParallelRestore
+from etcd_rolling import RollingRestart
 from reactive.etcd import (
+    advance_parallel_restore,
+    advance_rolling_restart,
+    check_cluster_health,
     clear_flag,
+    configure_scheduled_snapshots,
+    designate_snapshot_unit,
     endpoint_from_flag,
     force_rejoin_requested,
     force_rejoin,
+    parallel_restore_requested,
     GRAFANA_DASHBOARD_NAME,
     host,
     pre_series_upgrade,
     post_series_upgrade,
     register_grafana_dashboard,
     register_prometheus_jobs,
+    render_if_changed,
+    rerender_config,
+    restart_etcd,
     status,
 )
 
 
+MEMBER_LIST_JSON = json.dumps(
+    {
+        "members": [
+            {
+                "ID": 9063564952394763424,
+                "name": "etcd22",
+                "peerURLs": ["https://10.113.96.220:2380"],
+                "clientURLs": ["https://10.113.96.220:2379"],
+            }
+        ]
+    }
+)
+
+MEMBER_ADD_JSON = json.dumps(
+    {
+        "member": {"ID": 2, "peerURLs": ["https://127.0.0.1:1313"]},
+        "members": [
+            {"ID": 1, "name": "etcd11", "peerURLs": ["https://10.113.96.26:2380"]},
+            {"ID": 2, "peerURLs": ["https://127.0.0.1:1313"]},
+        ],
+    }
+)
+
+ENDPOINT_STATUS_JSON = json.dumps(
+    [
+        {
+            "Endpoint": "https://10.0.0.1:2379",
+            "Status": {
+                "header": {"member_id": 1, "revision": 99, "raft_term": 4},
+                "version": "3.5.9",
+                "dbSize": 20480,
+                "dbSizeInUse": 10240,
+                "leader": 1,
+                "raftIndex": 1234,
+                "raftTerm": 4,
+                "raftAppliedIndex": 1234,
+            },
+        },
+        {
+            "Endpoint": "https://10.0.0.2:2379",
+            "Status": {
+                "header": {"member_id": 2, "revision": 99, "raft_term": 4},
+                "leader": 1,
+                "raftIndex": 1230,
+            },
+        },
+    ]
+)
+
+
 @pytest.fixture
 def config():
     kv = MockKV()
@@ -47,7 +114,8 @@ class TestEtcdCtl:
 
     def test_register(self, etcdctl):
         with patch("etcdctl.EtcdCtl.run") as spcm:
-            etcdctl.register(
+            spcm.return_value = MEMBER_ADD_JSON
+            reg = etcdctl.register(
                 {
                     "cluster_address": "127.0.0.1",
                     "unit_name": "etcd0",
@@ -56,41 +124,374 @@ class TestEtcdCtl:
                 }
             )
             spcm.assert_called_with(
-                "member add etcd0 https://127.0.0.1:1313",
-                api=2,
+                [
+                    "member",
+                    "add",
+                    "etcd0",
+                    "--peer-urls=https://127.0.0.1:1313",
+                    "--write-out=json",
+                ],
                 endpoints="http://127.1.1.1:1212",
             )
+            assert reg["cluster"] == (
+                "etcd11=https://10.113.96.26:2380,etcd0=https://127.0.0.1:1313"
+            )
 
     def test_unregister(self, etcdctl):
         with patch("etcdctl.EtcdCtl.run") as spcm:
             etcdctl.unregister("br1212121212")
 
             spcm.assert_called_with(
-                ["member", "remove", "br1212121212"], api=2, endpoints=None
+                ["member", "remove", "br1212121212"], endpoints=None
             )
 
     def test_member_list(self, etcdctl):
         with patch("etcdctl.EtcdCtl.run") as comock:
-            comock.return_value = "7dc8404daa2b8ca0: name=etcd22 peerURLs=https://10.113.96.220:2380 clientURLs=https://10.113.96.220:2379\n"  # noqa
+            comock.return_value = MEMBER_LIST_JSON
             members = etcdctl.member_list()
-            assert members["etcd22"]["unit_id"] == "7dc8404daa2b8ca0"
-            assert members["etcd22"]["peer_urls"] == "https://10.113.96.220:2380"
-            assert members["etcd22"]["client_urls"] == "https://10.113.96.220:2379"
-
-    def test_member_list_with_unstarted_member(self, etcdctl):
-        """Validate we receive information only about members we can parse
-        from the current status string"""
-        # 57fa5c39949c138e[unstarted]: peerURLs=http://10.113.96.80:2380
-        # bb0f83ebb26386f7: name=etcd9 peerURLs=https://10.113.96.178:2380 clientURLs=https://10.113.96.178:2379
+            assert members[0].unit_id == "7dc8404daa2b8ca0"
+            assert members[0].name == "etcd22"
+            assert members[0].peer_urls == ["https://10.113.96.220:2380"]
+            assert members[0].client_urls == ["https://10.113.96.220:2379"]
+
+    def test_member_list_with_unstarted_members(self, etcdctl):
+        """Validate that several pending joins are all reported"""
         with patch("etcdctl.EtcdCtl.run") as comock:
-            comock.return_value = "57fa5c39949c138e[unstarted]: peerURLs=http://10.113.96.80:2380]\nbb0f83ebb26386f7: name=etcd9 peerURLs=https://10.113.96.178:2380 clientURLs=https://10.113.96.178:2379\n"  # noqa
+            comock.return_value = json.dumps(
+                {
+                    "members": [
+                        {
+                            "ID": 6339480827853542286,
+                            "peerURLs": ["https://10.0.0.8:2380"],
+                        },
+                        {
+                            "ID": 13479137258076604151,
+                            "peerURLs": ["https://10.0.0.9:2380"],
+                        },
+                        {
+                            "ID": 9063564952394763424,
+                            "name": "etcd22",
+                            "peerURLs": ["https://10.113.96.220:2380"],
+                            "clientURLs": ["https://10.113.96.220:2379"],
+                            "isLearner": True,
+                        },
+                    ]
+                }
+            )
             members = etcdctl.member_list()
-            assert members["etcd9"]["unit_id"] == "bb0f83ebb26386f7"
-            assert members["etcd9"]["peer_urls"] == "https://10.113.96.178:2380"
-            assert members["etcd9"]["client_urls"] == "https://10.113.96.178:2379"
-            assert "unstarted" in members.keys()
-            assert members["unstarted"]["unit_id"] == "57fa5c39949c138e"
-            assert "10.113.96.80:2380" in members["unstarted"]["peer_urls"]
+            unstarted = [m for m in members if not m.started]
+            assert [m.unit_id for m in unstarted] == [
+                "57fa5c39949c138e",
+                "bb0f83ebb26386f7",
+            ]
+            assert unstarted[1].peer_urls == ["https://10.0.0.9:2380"]
+            assert members[2].is_learner
+
+    def test_cluster_health_reports_unhealthy_members(self, etcdctl):
+        """etcdctl exits non-zero when a member is unhealthy; the records for
+        the members it could check are still returned"""
+        output = json.dumps(
+            [
+                {"endpoint": "https://10.0.0.1:2379", "health": True, "took": "2.5ms"},
+                {
+                    "endpoint": "https://10.0.0.2:2379",
+                    "health": False,
+                    "took": "5s",
+                    "error": "context deadline exceeded",
+                },
+            ]
+        )
+        with patch("etcdctl.EtcdCtl.run") as comock:
+            comock.side_effect = EtcdCtl.CommandFailed(output)
+            health = etcdctl.cluster_health()
+        assert [h.healthy for h in health] == [True, False]
+        assert health[0].took == pytest.approx(0.0025)
+        assert health[1].error == "context deadline exceeded"
+
+    def test_cluster_health_unreachable(self, etcdctl):
+        with patch("etcdctl.EtcdCtl.run") as comock:
+            comock.side_effect = EtcdCtl.CommandFailed()
+            health = etcdctl.cluster_health()
+        assert len(health) == 1
+        assert not health[0].healthy
+
+    def test_cluster_health_before_3_4(self, etcdctl):
+        """etcdctl 3.2 and 3.3 have no JSON health output nor --cluster, so
+        the members are listed and the text output parsed"""
+        output = (
+            "https://10.0.0.1:2379 is healthy: "
+            "successfully committed proposal: took = 2.5ms\n"
+            "https://10.0.0.2:2379 is unhealthy: "
+            "failed to commit proposal: context deadline exceeded\n"
+            "Error: unhealthy cluster\n"
+        )
+        members = [
+            Member(1, "etcd0", client_urls=["https://10.0.0.1:2379"]),
+            Member(2, "etcd1", client_urls=["https://10.0.0.2:2379"]),
+            Member(3, "", peer_urls=["https://10.0.0.3:2380"]),
+        ]
+        with patch("etcdctl.etcd_version", return_value="3.3.27"), patch.object(
+            EtcdCtl, "member_list", return_value=members
+        ), patch("etcdctl.EtcdCtl.run") as comock:
+            comock.side_effect = EtcdCtl.CommandFailed(output)
+            health = etcdctl.cluster_health()
+            comock.assert_called_once_with(
+                ["endpoint", "health"],
+                endpoints="https://10.0.0.1:2379,https://10.0.0.2:2379",
+                timeout=10,
+            )
+        assert [h.healthy for h in health] == [True, False]
+        assert health[0].took == pytest.approx(0.0025)
+        assert health[1].error == "failed to commit proposal: context deadline exceeded"
+
+    def test_endpoint_status_before_3_4(self, etcdctl):
+        members = [Member(1, "etcd0", client_urls=["https://10.0.0.1:2379"])]
+        with patch("etcdctl.etcd_version", return_value="3.2.32"), patch.object(
+            EtcdCtl, "member_list", return_value=members
+        ), patch("etcdctl.EtcdCtl.run") as comock:
+            comock.return_value = ENDPOINT_STATUS_JSON
+            etcdctl.endpoint_status(cluster=True)
+            comock.assert_called_with(
+                ["endpoint", "status", "--write-out=json"],
+                endpoints="https://10.0.0.1:2379",
+                timeout=10,
+            )
+
+    def test_modern_etcdctl(self):
+        with patch("etcdctl.etcd_version", return_value="3.4.22"):
+            assert modern_etcdctl()
+        modern_etcdctl.cache_clear()
+        with patch("etcdctl.etcd_version", side_effect=OSError):
+            assert modern_etcdctl()
+
+    def test_endpoint_status(self, etcdctl):
+        with patch("etcdctl.EtcdCtl.run") as comock:
+            comock.return_value = ENDPOINT_STATUS_JSON
+            status = etcdctl.endpoint_status(cluster=True)
+            comock.assert_called_with(
+                ["endpoint", "status", "--write-out=json", "--cluster"],
+                endpoints=None,
+                timeout=10,
+            )
+        assert status[0].is_leader
+        assert status[0].raft_index == 1234
+        assert status[0].db_size == 20480
+        assert status[0].fragmentation == pytest.approx(0.5)
+        assert not status[1].is_leader
+
+    def test_alarm_list(self, etcdctl):
+        with patch("etcdctl.EtcdCtl.run") as comock:
+            comock.return_value = json.dumps(
+                {"alarms": [{"memberID": 9063564952394763424, "alarm": 1}]}
+            )
+            alarms = etcdctl.alarm_list()
+        assert [a.name for a in alarms] == ["NOSPACE"]
+        assert alarms[0].member_id == 9063564952394763424
+
+    def test_alarm_list_garbled(self, etcdctl):
+        with patch("etcdctl.EtcdCtl.run", return_value="Error: garbled"):
+            with pytest.raises(EtcdCtl.CommandFailed) as e:
+                etcdctl.alarm_list()
+        assert e.value.output == "Error: garbled"
+
+    def test_member_list_is_memoized(self, etcdctl):
+        """Repeated reads within a hook, from any instance, reuse the first
+        result for the same endpoint"""
+        with patch("etcdctl.EtcdCtl.run") as comock:
+            comock.return_value = MEMBER_LIST_JSON
+            stats = EtcdCtl.cache_stats()
+            etcdctl.member_list()
+            EtcdCtl().member_list()
+            assert comock.call_count == 1
+            etcdctl.member_list("https://10.113.96.220:2379")
+            assert comock.call_count == 2
+            after = EtcdCtl.cache_stats()
+            assert after["hits"] - stats["hits"] == 1
+            assert after["misses"] - stats["misses"] == 2
+
+    def test_memoized_skips_failures(self, etcdctl):
+        """Failed and unhealthy reads are made again, and each backend has
+        results of its own"""
+        with patch("etcdctl.EtcdCtl.run") as comock:
+            comock.side_effect = EtcdCtl.CommandFailed()
+            with pytest.raises(EtcdCtl.CommandFailed):
+                etcdctl.member_list()
+            # endpoint health reports a member it cannot reach as unhealthy
+            etcdctl.endpoint_health()
+            comock.side_effect = None
+            comock.return_value = MEMBER_LIST_JSON
+            etcdctl.member_list()
+            comock.return_value = json.dumps(
+                [{"endpoint": "https://127.0.0.1:2379", "health": True}]
+            )
+            assert etcdctl.endpoint_health()[0].healthy
+            etcdctl.endpoint_health()
+            etcdctl.member_list()
+            assert comock.call_count == 4
+
+        native = EtcdCtl(backend="etcdctl")
+        native.native = MagicMock()
+        native.native.member_list.return_value = []
+        assert native.member_list() == []
+        native.native.member_list.assert_called_once()
+
+    def test_mutation_invalidates_cache(self, etcdctl):
+        """Membership changes drop cached reads, even when they fail"""
+        with patch("etcdctl.EtcdCtl.run") as comock:
+            comock.return_value = MEMBER_LIST_JSON
+            etcdctl.member_list()
+            comock.side_effect = EtcdCtl.CommandFailed()
+            with pytest.raises(EtcdCtl.CommandFailed):
+                etcdctl.unregister("7dc8404daa2b8ca0")
+            comock.side_effect = None
+            etcdctl.member_list()
+            assert comock.call_count == 3
+
+    @patch("time.sleep")
+    def test_transfer_leadership(self, sleep, etcdctl):
+        """A leader hands off to the most caught up healthy follower and
+        waits for the member to report the new leader"""
+        members = [
+            Member(1, "etcd0", client_urls=["https://10.0.0.1:2379"]),
+            Member(2, "etcd1", client_urls=["https://10.0.0.2:2379"]),
+            Member(3, "etcd2", client_urls=["https://10.0.0.3:2379"]),
+        ]
+        probe = ClusterProbe(members)
+        probe.health = [
+            EndpointHealth("https://10.0.0.1:2379", True),
+            EndpointHealth("https://10.0.0.2:2379", True),
+            EndpointHealth("https://10.0.0.3:2379", False),
+        ]
+        probe.status = [
+            EndpointStatus(m.client_urls[0], {"header": {"member_id": m.id}})
+            for m in members
+        ]
+        probe.status[1].raft_applied_index = 10
+        probe.status[2].raft_applied_index = 20
+
+        def local(leader):
+            return [
+                EndpointStatus(
+                    "https://127.0.0.1:2379",
+                    {"header": {"member_id": 1}, "leader": leader},
+                )
+            ]
+
+        with patch.object(EtcdCtl, "endpoint_status") as endpoint_status, patch.object(
+            EtcdCtl, "probe_cluster", return_value=probe
+        ), patch.object(EtcdCtl, "move_leader") as move_leader:
+            endpoint_status.side_effect = [local(1), local(1), local(2)]
+            # etcd2 is further ahead but unhealthy
+            assert etcdctl.transfer_leadership() == members[1]
+            move_leader.assert_called_once_with("2", "https://127.0.0.1:2379")
+            assert endpoint_status.call_count == 3
+
+            move_leader.reset_mock()
+            endpoint_status.side_effect = [local(2)]
+            assert etcdctl.transfer_leadership() is None
+            move_leader.assert_not_called()
+
+    def test_probe_cluster(self, etcdctl):
+        """Every started member is probed, and a member that does not answer
+        within the deadline is reported as unreachable"""
+        members = [
+            Member(1, "etcd0", client_urls=["https://10.0.0.1:2379"]),
+            Member(2, "etcd1", client_urls=["https://10.0.0.2:2379"]),
+            Member(3, "etcd2", client_urls=["https://10.0.0.3:2379"]),
+            Member(4, peer_urls=["https://10.0.0.4:2380"]),
+        ]
+        release = threading.Event()
+
+        def health(endpoint, timeout):
+            assert timeout == 0.25
+            if endpoint == "https://10.0.0.3:2379":
+                # etcdctl gives up a little after its own timeout
+                release.wait(timeout * 3)
+            return [EndpointHealth(endpoint, True, took=0.002 * int(endpoint[-6]))]
+
+        def status(endpoint, timeout):
+            member_id = int(endpoint[-6])
+            return [
+                EndpointStatus(
+                    endpoint,
+                    {
+                        "header": {"member_id": member_id},
+                        "leader": 1,
+                        "raftIndex": 100 - member_id,
+                        "dbSize": 1024 * member_id,
+                    },
+                )
+            ]
+
+        with patch.object(EtcdCtl, "member_list", return_value=members), patch.object(
+            EtcdCtl, "endpoint_health", side_effect=health
+        ), patch.object(EtcdCtl, "endpoint_status", side_effect=status):
+            probe = etcdctl.probe_cluster(timeout=0.5)
+
+        assert probe.unreachable == ["https://10.0.0.3:2379"]
+        assert not probe.healthy
+        assert probe.leader.name == "etcd0"
+        assert probe.raft_lag == 1
+        assert probe.max_db_size == 2048
+        assert probe.slowest.endpoint == "https://10.0.0.2:2379"
+
+    def test_check_cluster_health_garbled_member_list(self, etcdctl):
+        """Output that is not JSON is reported like a failed command"""
+        with patch("etcdctl.EtcdCtl.run", return_value="Error: garbled"):
+            with pytest.raises(EtcdCtl.CommandFailed) as e:
+                etcdctl.member_list()
+            assert e.value.output == "Error: garbled"
+            status.blocked.reset_mock()
+            check_cluster_health()
+        status.blocked.assert_called_once_with("Errored with 0 known peers")
+        status.blocked.reset_mock()
+
+    def test_check_cluster_health_quota_problem(self):
+        """A quota that cannot be applied blocks the unit with the reason"""
+        probe = ClusterProbe([Member(1, "etcd0")])
+        problem = "quota_backend_bytes 1.0GiB is below the 3.0GiB database"
+        status.blocked.reset_mock()
+        with patch.object(EtcdCtl, "probe_cluster", return_value=probe), patch.object(
+            EtcdDatabag, "quota_problem", problem
+        ):
+            check_cluster_health()
+        status.blocked.assert_called_once_with(problem)
+        status.blocked.reset_mock()
+
+    def test_check_cluster_health_etcd_2(self):
+        status.blocked.reset_mock()
+        with patch.object(reactive.etcd, "etcd_version", return_value="2.3.8"):
+            check_cluster_health()
+        status.blocked.assert_called_once_with(
+            "etcd 2.x is not supported, upgrade to etcd 3."
+        )
+        status.blocked.reset_mock()
+
+    def test_check_cluster_health_status(self):
+        probe = ClusterProbe([Member(1, "etcd0"), Member(2, "etcd1")])
+        probe.health = [
+            EndpointHealth("https://10.0.0.1:2379", True, took=0.003),
+            EndpointHealth("https://10.0.0.2:2379", True, took=0.012),
+        ]
+        probe.status = [
+            EndpointStatus("a", {"header": {"member_id": 1}, "leader": 1}),
+            EndpointStatus(
+                "b",
+                {
+                    "header": {"member_id": 2},
+                    "leader": 1,
+                    "raftIndex": 3,
+                    "dbSize": 3 * 1024 * 1024,
+                },
+            ),
+        ]
+        status.active.reset_mock()
+        with patch.object(EtcdCtl, "probe_cluster", return_value=probe):
+            check_cluster_health()
+        status.active.assert_called_once_with(
+            "Healthy with 2 known peers "
+            "(leader etcd0, raft lag 3, db 3.0MiB, slowest 12ms)"
+        )
 
     def test_etcd_v2_version(self, etcdctl):
         """Validate that etcdctl can parse versions for both etcd v2 and
@@ -110,6 +511,36 @@ class TestEtcdCtl:
             ver = etcdctl.version()
             assert ver == "3.0.17"
 
+    def test_etcd_version_cached_by_snap_revision(self, etcdctl, tmp_path):
+        """The version is read from snap metadata once per snap revision"""
+        meta = tmp_path / "meta"
+        meta.mkdir()
+        (meta / "snap.yaml").write_text("name: etcd\nversion: 3.5.9\n")
+        kv = MockKV()
+        with patch("etcdctl.ETCD_SNAP_DIR", str(tmp_path)), patch(
+            "etcdctl.snap_revision", return_value="233"
+        ), patch("etcdctl.unitdata.kv", return_value=kv), patch(
+            "etcdctl.check_output"
+        ) as comock:
+            assert etcd_version() == "3.5.9"
+            (meta / "snap.yaml").write_text("name: etcd\nversion: 3.5.10\n")
+            assert etcd_version() == "3.5.9"
+            comock.assert_not_called()
+        assert kv.get("etcd.version") == {"revision": "233", "version": "3.5.9"}
+
+    def test_etcd_version_reprobed_on_refresh(self, etcdctl):
+        """A new snap revision triggers detection again, falling back to
+        etcdctl when the snap metadata has no usable version"""
+        kv = MockKV()
+        kv.set("etcd.version", {"revision": "233", "version": "3.5.9"})
+        with patch("etcdctl.snap_revision", return_value="240"), patch(
+            "etcdctl.snap_version", return_value=None
+        ), patch("etcdctl.unitdata.kv", return_value=kv), patch(
+            "etcdctl.check_output", return_value=b"etcdctl version: 3.5.10\n"
+        ):
+            assert etcd_version() == "3.5.10"
+        assert kv.get("etcd.version") == {"revision": "240", "version": "3.5.10"}
+
     def test_etcdctl_command(self):
         """Validate sane results from etcdctl_command"""
         assert isinstance(etcdctl_command(), str)
@@ -138,6 +569,76 @@ edc0dsa81479d7e8[unstarted]: peerURLs=https://10.113.96.124:2380  # noqa""".stri
             api_version = comock.call_args[1].get("env").get("ETCDCTL_API")
             assert api_version == "3"
 
+    def test_run_applies_timeouts(self, etcdctl):
+        with patch("etcdctl.run") as comock:
+            etcdctl.run("member list", timeout=7)
+            command = comock.call_args[0][0]
+            assert "--dial-timeout=2s" in command
+            assert "--command-timeout=7s" in command
+            assert comock.call_args[1]["timeout"] == 8
+
+    def test_run_clamps_timeouts_to_a_second(self, etcdctl):
+        with patch("etcdctl.run") as comock:
+            etcdctl.run("member list", timeout=0.4)
+            command = comock.call_args[0][0]
+            assert "--dial-timeout=1s" in command
+            assert "--command-timeout=1s" in command
+
+    def test_snapshot_save_unbounded_in_actions(self, etcdctl, monkeypatch):
+        """A multi-GB snapshot streams for as long as it takes in an action"""
+        monkeypatch.setenv("JUJU_ACTION_NAME", "snapshot")
+        with patch("etcdctl.run") as comock:
+            etcdctl.snapshot_save("/tmp/db")
+            assert "--command-timeout=8760h" in comock.call_args[0][0]
+            assert comock.call_args[1]["timeout"] is None
+            etcdctl.snapshot_save("/tmp/db", timeout=600)
+            assert "--command-timeout=600s" in comock.call_args[0][0]
+
+    def test_snapshot_save_bounded_in_hooks(self, etcdctl):
+        with patch("etcdctl.run") as comock, patch(
+            "etcd_retry.remaining_budget", return_value=42
+        ):
+            etcdctl.snapshot_save("/tmp/db")
+            assert "--command-timeout=42s" in comock.call_args[0][0]
+            assert comock.call_args[1]["timeout"] == 43
+
+    def test_run_cluster_errors_spare_the_breaker(self, etcdctl):
+        """A remote member being down must not open the local circuit"""
+        error = CalledProcessError(1, "etcdctl", "[]", "context deadline exceeded")
+        with patch("etcdctl.run", side_effect=error) as comock:
+            for _ in range(5):
+                with pytest.raises(EtcdCtl.CommandFailed) as e:
+                    etcdctl.run(["endpoint", "health", "--cluster"])
+                assert not isinstance(e.value, EtcdCtl.CircuitOpen)
+            assert comock.call_count == 5
+        assert e.value.output == "[]"
+        assert e.value.stderr == "context deadline exceeded"
+
+    def test_run_timeout_trips_breaker(self, etcdctl):
+        """After repeated timeouts an endpoint is no longer dialed"""
+        endpoint = "https://10.0.0.9:2379"
+        with patch("etcdctl.run") as comock:
+            comock.side_effect = TimeoutExpired("etcdctl", 10)
+            for _ in range(3):
+                with pytest.raises(EtcdCtl.CommandFailed) as e:
+                    etcdctl.run("member list", endpoints=endpoint)
+                assert not isinstance(e.value, EtcdCtl.CircuitOpen)
+            with pytest.raises(EtcdCtl.CircuitOpen):
+                etcdctl.run("member list", endpoints=endpoint)
+            assert comock.call_count == 3
+            # other endpoints are unaffected
+            comock.side_effect = None
+            etcdctl.run("member list")
+            assert comock.call_count == 4
+
+    def test_run_respects_hook_budget(self, etcdctl):
+        with patch("etcdctl.run") as comock, patch(
+            "etcd_retry.remaining_budget", return_value=0
+        ):
+            with pytest.raises(EtcdCtl.CircuitOpen):
+                etcdctl.run("member list")
+            comock.assert_not_called()
+
     def test_get_connection_string(self):
         """Validate the get_connection_string function
         gives a sane return.
@@ -193,6 +694,49 @@ edc0dsa81479d7e8[unstarted]: peerURLs=https://10.113.96.124:2380  # noqa""".stri
         )
         reactive.etcd.set_flag.assert_called_with("prometheus.configured")
 
+    def test_register_prometheus_job_metrics_port(self, mocker, config):
+        """Prometheus scrapes the dedicated metrics listener when set."""
+        prometheus_mock = MagicMock()
+        etcd_cluster_mock = MagicMock()
+        etcd_cluster_mock.get_db_ingress_addresses.return_value = ["10.0.0.2"]
+        endpoint_from_flag.side_effect = [prometheus_mock, etcd_cluster_mock]
+        read_tls_cert = mocker.patch.object(reactive.etcd, "read_tls_cert")
+        mocker.patch.object(
+            reactive.etcd, "get_ingress_address", return_value="10.0.0.1"
+        )
+        config.set("metrics_port", 9379)
+        config.set("metrics_scheme", "http")
+        config.set("channel", "3.4/stable")
+
+        register_prometheus_jobs()
+
+        targets = ["10.0.0.2:9379", "10.0.0.1:9379"]
+        prometheus_mock.register_job.assert_called_with(
+            job_name="etcd",
+            job_data={"scheme": "http", "static_configs": [{"targets": targets}]},
+        )
+        read_tls_cert.assert_not_called()
+
+    def test_register_prometheus_job_invalid_scheme(self, mocker, config):
+        """An unknown metrics_scheme falls back to https like the listener"""
+        prometheus_mock = MagicMock()
+        etcd_cluster_mock = MagicMock()
+        etcd_cluster_mock.get_db_ingress_addresses.return_value = []
+        endpoint_from_flag.side_effect = [prometheus_mock, etcd_cluster_mock]
+        read_tls_cert = mocker.patch.object(reactive.etcd, "read_tls_cert")
+        mocker.patch.object(
+            reactive.etcd, "get_ingress_address", return_value="10.0.0.1"
+        )
+        config.set("metrics_port", 9379)
+        config.set("metrics_scheme", "HTTP")
+        config.set("channel", "3.4/stable")
+
+        register_prometheus_jobs()
+
+        job_data = prometheus_mock.register_job.call_args[1]["job_data"]
+        assert job_data["scheme"] == "https"
+        assert read_tls_cert.call_count == 3
+
     def test_series_upgrade(self, mocker):
         mocker.patch.object(
             etcd_lib,
@@ -234,6 +778,8 @@ edc0dsa81479d7e8[unstarted]: peerURLs=https://10.113.96.124:2380  # noqa""".stri
             "get_ingress_addresses",
             return_value=["10.0.0.1", "2001:0dc8::0001"],
         )
+        # Rejoin succeeds on the second attempt
+        mocker.patch.object(reactive.etcd, "is_flag_set", side_effect=[False, True])
         data_dir = "/foo/bar"
         path_exists.return_value = True
         path_join.return_value = data_dir
@@ -242,4 +788,284 @@ edc0dsa81479d7e8[unstarted]: peerURLs=https://10.113.96.124:2380  # noqa""".stri
         host.service_stop.assert_called_with(EtcdDatabag().etcd_daemon)
         clear_flag.assert_called_with("etcd.registered")
         rmtree.assert_called_with(data_dir)
-        register_node.assert_called()
+        assert register_node.call_count == 2
+        sleep.assert_called_once()
+
+    def test_render_if_changed(self, mocker, tmp_path):
+        """Config is only rewritten when its content changes."""
+        target = tmp_path / "etcd.conf.yml"
+        target.write_text("name: etcd0\nheartbeat-interval: 100\n")
+        render = mocker.patch.object(reactive.etcd, "render")
+        write_file = mocker.patch.object(reactive.etcd, "write_file")
+        log = mocker.patch.object(reactive.etcd, "log")
+
+        render.return_value = "name: etcd0\nheartbeat-interval: 100\n"
+        assert not render_if_changed("etcd3.conf", str(target), {})
+        write_file.assert_not_called()
+
+        render.return_value = "name: etcd0\nheartbeat-interval: 200\n"
+        assert render_if_changed("etcd3.conf", str(target), {})
+        write_file.assert_called_once_with(
+            str(target), render.return_value.encode("utf-8"), owner="root", group="root"
+        )
+        log.assert_called_with("{} changed: heartbeat-interval".format(target))
+
+    def test_rerender_config_skips_restart(self, mocker):
+        """An unchanged config does not restart etcd."""
+        mocker.patch.object(reactive.etcd, "render_config", return_value=False)
+        mocker.patch.object(reactive.etcd, "set_app_version")
+        host.service_restart.reset_mock()
+        rerender_config()
+        host.service_restart.assert_not_called()
+
+    def test_restart_etcd_moves_ports(self, mocker):
+        """Ports only move once the member restarted on the new ones"""
+        bag = MagicMock(etcd_daemon="snap.etcd.etcd", port=2381, metrics_port=0)
+        mocker.patch.object(reactive.etcd, "hand_off_leadership")
+        mocker.patch.object(
+            reactive.etcd.hookenv,
+            "opened_ports",
+            return_value=["2379/tcp", "2381/tcp", "9000-9100/tcp"],
+        )
+        host.service_restart.reset_mock()
+
+        def close(port):
+            assert host.service_restart.called
+
+        close_port = mocker.patch.object(reactive.etcd, "close_port", side_effect=close)
+        open_port = mocker.patch.object(reactive.etcd, "open_port")
+        restart_etcd(bag)
+        close_port.assert_called_once_with(2379)
+        open_port.assert_called_once_with(2381)
+
+    def test_advance_rolling_restart(self, mocker):
+        """The leader waits for acknowledgement and health, then restarts
+        itself last."""
+        plan = RollingRestart("abc", ["etcd/1", "etcd/0"])
+        mocker.patch.object(RollingRestart, "load", return_value=plan)
+        mocker.patch.object(RollingRestart, "save")
+        mocker.patch.object(RollingRestart, "reconcile")
+        done = mocker.patch.object(RollingRestart, "done", return_value=False)
+        mocker.patch.object(reactive.etcd, "peer_units", return_value=["etcd/1"])
+        mocker.patch.object(reactive.etcd.hookenv, "local_unit", return_value="etcd/0")
+        mocker.patch.object(reactive.etcd, "render_config")
+        probe = mocker.patch.object(EtcdCtl, "probe_cluster")
+        probe.return_value.healthy = True
+        probe.return_value.raft_lag = 0
+        restart = mocker.patch.object(reactive.etcd, "restart_and_wait")
+
+        advance_rolling_restart()
+        assert plan.queue == ["etcd/1", "etcd/0"]
+        restart.assert_not_called()
+
+        done.return_value = True
+        advance_rolling_restart()
+        assert plan.queue == []
+        restart.assert_called_once()
+
+    @patch("time.sleep")
+    def test_advance_rolling_restart_waits_for_catch_up(self, sleep, mocker):
+        """The leader polls a lagging cluster rather than giving up the hook"""
+        plan = RollingRestart("abc", ["etcd/1", "etcd/0"])
+        mocker.patch.object(RollingRestart, "load", return_value=plan)
+        mocker.patch.object(RollingRestart, "save")
+        mocker.patch.object(RollingRestart, "reconcile")
+        mocker.patch.object(RollingRestart, "done", return_value=True)
+        mocker.patch.object(reactive.etcd, "peer_units", return_value=["etcd/1"])
+        mocker.patch.object(reactive.etcd.hookenv, "local_unit", return_value="etcd/0")
+        mocker.patch.object(reactive.etcd, "render_config")
+        lagging = MagicMock(healthy=True, raft_lag=5000)
+        ready = MagicMock(healthy=True, raft_lag=0)
+        probe = mocker.patch.object(EtcdCtl, "probe_cluster")
+        probe.side_effect = [lagging, EtcdCtl.CommandFailed(), ready, ready]
+        mocker.patch.object(reactive.etcd, "restart_and_wait")
+
+        advance_rolling_restart()
+        assert plan.queue == []
+        assert sleep.call_count == 2
+
+    def test_parallel_restore_requested(self, mocker):
+        """Followers stop when asked, then restore with the leader's layout"""
+        restore = ParallelRestore(
+            "abc",
+            "etcd0=https://10.0.0.1:2380,etcd1=https://10.0.0.2:2380",
+            "token",
+            "f00",
+        )
+        mocker.patch.object(ParallelRestore, "load", return_value=restore)
+        ack = mocker.patch.object(ParallelRestore, "acknowledge")
+        mocker.patch.object(
+            reactive.etcd.hookenv, "resource_get", return_value="/snap.tar.gz"
+        )
+        mocker.patch.object(reactive.etcd, "file_hash", return_value="f00")
+        mocker.patch.object(reactive.etcd, "render_config")
+        restore_archive = mocker.patch.object(reactive.etcd, "restore_archive")
+        mocker.patch.dict("os.environ", {"JUJU_UNIT_NAME": "etcd/1"})
+        host.service_start.reset_mock()
+
+        parallel_restore_requested()
+        host.service_stop.assert_called()
+        ack.assert_called_once_with()
+        restore_archive.assert_not_called()
+        host.service_start.assert_not_called()
+
+        ack.reset_mock()
+        restore.phase = ParallelRestore.RESTORE
+        parallel_restore_requested()
+        ack.assert_called_once_with()
+        args = restore_archive.call_args[0]
+        assert args[0] == "/snap.tar.gz"
+        assert args[2:] == (
+            "etcd1",
+            restore.initial_cluster,
+            "token",
+            "https://10.0.0.2:2380",
+        )
+        host.service_start.assert_called()
+
+        restore_archive.reset_mock()
+        restore.phase = ParallelRestore.STOP
+        ack.reset_mock()
+        reactive.etcd.file_hash.return_value = "bad"
+        parallel_restore_requested()
+        ack.assert_not_called()
+        restore.phase = ParallelRestore.RESTORE
+        parallel_restore_requested()
+        restore_archive.assert_not_called()
+
+    def test_advance_parallel_restore(self, mocker):
+        """The leader restores only once every member has stopped"""
+        restore = ParallelRestore(
+            "abc",
+            "etcd0=https://10.0.0.1:2380,etcd1=https://10.0.0.2:2380",
+            "token",
+            "f00",
+            requested=1000.0,
+        )
+        mocker.patch.object(ParallelRestore, "load", return_value=restore)
+        mocker.patch.object(ParallelRestore, "save")
+        mocker.patch.object(reactive.etcd, "peer_units", return_value=["etcd/1"])
+        stopped = mocker.patch.object(
+            ParallelRestore, "acknowledged", return_value=False
+        )
+        mocker.patch.object(
+            reactive.etcd.hookenv, "resource_get", return_value="/snap.tar.gz"
+        )
+        mocker.patch.object(reactive.etcd, "file_hash", return_value="f00")
+        mocker.patch.object(reactive.etcd, "render_config")
+        restore_archive = mocker.patch.object(reactive.etcd, "restore_archive")
+        mocker.patch.dict("os.environ", {"JUJU_UNIT_NAME": "etcd/0"})
+
+        mocker.patch("etcd_restore.time.time", return_value=1060.0)
+        advance_parallel_restore()
+        restore_archive.assert_not_called()
+        assert restore.phase == ParallelRestore.STOP
+
+        stopped.return_value = True
+        advance_parallel_restore()
+        assert restore_archive.call_args[0][2] == "etcd0"
+        assert restore.phase == ParallelRestore.RESTORE
+        host.service_start.assert_called()
+
+    @pytest.mark.parametrize("phase", [ParallelRestore.RESTORE, ParallelRestore.ABORT])
+    def test_advance_parallel_restore_clears(self, mocker, phase):
+        """The leader clears the restore once every member started again"""
+        restore = ParallelRestore(
+            "abc",
+            "etcd0=https://10.0.0.1:2380,etcd1=https://10.0.0.2:2380",
+            "token",
+            "f00",
+            phase=phase,
+            advanced=1000.0,
+        )
+        mocker.patch.object(ParallelRestore, "load", return_value=restore)
+        mocker.patch.object(reactive.etcd, "peer_units", return_value=["etcd/1"])
+        done = mocker.patch.object(ParallelRestore, "acknowledged", return_value=False)
+        clear = mocker.patch.object(ParallelRestore, "clear")
+        restore_archive = mocker.patch.object(reactive.etcd, "restore_archive")
+        mocker.patch("etcd_restore.time.time", return_value=1060.0)
+
+        advance_parallel_restore()
+        clear.assert_not_called()
+        done.return_value = True
+        advance_parallel_restore()
+        clear.assert_called_once_with()
+        restore_archive.assert_not_called()
+
+        # A member that never reports back does not keep it forever
+        clear.reset_mock()
+        done.return_value = False
+        mocker.patch("etcd_restore.time.time", return_value=10000.0)
+        advance_parallel_restore()
+        clear.assert_called_once_with()
+
+    def test_advance_parallel_restore_timeout(self, mocker):
+        """The leader aborts when a member does not stop in time"""
+        restore = ParallelRestore(
+            "abc",
+            "etcd0=https://10.0.0.1:2380,etcd1=https://10.0.0.2:2380",
+            "token",
+            "f00",
+            requested=1000.0,
+        )
+        mocker.patch.object(ParallelRestore, "load", return_value=restore)
+        mocker.patch.object(ParallelRestore, "save")
+        mocker.patch.object(reactive.etcd, "peer_units", return_value=["etcd/1"])
+        mocker.patch.object(ParallelRestore, "acknowledged", return_value=False)
+        restore_archive = mocker.patch.object(reactive.etcd, "restore_archive")
+        mocker.patch("etcd_restore.time.time", return_value=10000.0)
+        host.service_start.reset_mock()
+        advance_parallel_restore()
+        restore_archive.assert_not_called()
+        assert restore.phase == ParallelRestore.ABORT
+        host.service_start.assert_called()
+
+    def test_designate_snapshot_unit(self, mocker):
+        """The leader hands scheduled snapshots to a raft follower."""
+        mocker.patch.object(reactive.etcd, "config", return_value="@daily")
+        mocker.patch.object(reactive.etcd, "peer_units", return_value=["etcd/1"])
+        mocker.patch.object(reactive.etcd.hookenv, "local_unit", return_value="etcd/0")
+        mocker.patch.object(reactive.etcd, "leader_get", return_value="etcd/0")
+        leader_set = mocker.patch.object(reactive.etcd, "leader_set")
+        probe = mocker.patch.object(EtcdCtl, "probe_cluster")
+        probe.return_value.leader = Member(1, "etcd0")
+        hook_name = mocker.patch.object(reactive.etcd.hookenv, "hook_name")
+
+        # Other hooks do not probe the cluster again
+        hook_name.return_value = "cluster-relation-changed"
+        designate_snapshot_unit()
+        probe.assert_not_called()
+        leader_set.assert_not_called()
+
+        hook_name.return_value = "cluster-relation-departed"
+        designate_snapshot_unit()
+        leader_set.assert_called_once_with({"snapshot_unit": "etcd/1"})
+
+    def test_configure_scheduled_snapshots(self, mocker):
+        """Only the designated unit installs the snapshot timer."""
+        options = {
+            "snapshot_schedule": "30 2 * * *",
+            "snapshot_compression": "gzip",
+            "snapshot_format": "archive",
+            "snapshot_target_dir": "/srv/snapshots",
+            "snapshot_retention_count": 7,
+            "snapshot_retention_days": 0,
+            "port": 2379,
+        }
+        mocker.patch.object(reactive.etcd, "config", side_effect=options.get)
+        mocker.patch.object(reactive.etcd.hookenv, "local_unit", return_value="etcd/1")
+        mocker.patch.object(reactive.etcd, "leader_get", return_value="etcd/1")
+        mocker.patch.object(reactive.etcd, "data_changed", return_value=True)
+        install = mocker.patch.object(reactive.etcd, "install_snapshot_timer")
+        remove = mocker.patch.object(reactive.etcd, "remove_snapshot_timer")
+        configure_scheduled_snapshots()
+        settings, timer = install.call_args[0]
+        assert settings["target"] == "/srv/snapshots"
+        assert timer["on_calendar"] == "*-*-* 02:30:00"
+        remove.assert_not_called()
+
+        install.reset_mock()
+        reactive.etcd.leader_get.return_value = "etcd/2"
+        configure_scheduled_snapshots()
+        install.assert_not_called()
+        remove.assert_called_once()